@@ -0,0 +1,60 @@
+"""Compare the binary wire codec against the legacy pickle codec
+
+Run from the repository root: python -m benchmarks.codec_bench
+"""
+import argparse
+import json
+import timeit
+
+from utils.codec import CODECS
+from utils.constants import SERVER_NAME
+from utils.messaging import RegisterRequest, LoginRequest, UserMessage, ServerMessage
+
+
+def sample_messages(history: int) -> dict:
+    chats = [UserMessage("alice", "bob", f"message number {i}") for i in range(history)]
+    for seq, msg in enumerate(chats):
+        msg.seq = seq
+    summary = {"cgraph": {"alice": {"chats": {"bob": chats}}}, "cursors": {("alice", "bob"): 0}}
+    return {
+        "RegisterRequest": RegisterRequest("alice", SERVER_NAME, "password"),
+        "LoginRequest": LoginRequest("alice", SERVER_NAME, "password", {("alice", "bob"): 41}),
+        "UserMessage": UserMessage("alice", "bob", "Hello Bob, how are you doing today?"),
+        "ServerMessage": ServerMessage(SERVER_NAME, "alice", "Hello there!", -1, "12345"),
+        f"ServerMessage[{history} msgs]": ServerMessage(SERVER_NAME, "alice", "Login successful.", 0, "12345", summary),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=20000, help="Iterations per measurement")
+    parser.add_argument("--history", type=int, default=50, help="Messages in the login summary sample")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+    args = parser.parse_args()
+
+    results = []
+    for msg_name, msg in sample_messages(args.history).items():
+        number = max(1, args.number // (args.history if "msgs" in msg_name else 1))
+        for codec in CODECS.values():
+            payload = codec.encode(msg)
+            view = memoryview(payload)
+            encode_us = 1e6 * timeit.timeit(lambda: codec.encode(msg), number=number) / number
+            decode_us = 1e6 * timeit.timeit(lambda: codec.decode(view), number=number) / number
+            results.append({
+                "message": msg_name,
+                "codec": codec.name,
+                "bytes": len(payload),
+                "encode_us": round(encode_us, 2),
+                "decode_us": round(decode_us, 2),
+            })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'message':<28}{'codec':<8}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+        for r in results:
+            print(f"{r['message']:<28}{r['codec']:<8}{r['bytes']:>8}{r['encode_us']:>12}{r['decode_us']:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""Load test the server's message path with many simulated clients
+
+Starts a ChatServer with the stub LLM in a scratch directory and drives it
+with asyncio clients that register, log in, befriend their neighbours and
+exchange messages. Reports registration and login rates, login time
+against history size, message throughput, end-to-end latency and the
+server's memory growth.
+
+Run from the repository root: python -m benchmarks.load
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+
+from server import ChatServer
+from utils.chat import ChatGraph
+from utils.constants import SERVER_NAME, DURABILITY_MODES, CHAT_GRAPH_SHARDS
+from utils.log import setup_logging
+from utils.messaging import receive_message, send_message, RegisterRequest, LoginRequest, UserMessage, MessageBatch
+
+
+PASSWORD = "password"
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summary_ms(seconds) -> dict:
+    return {
+        "p50_ms": round(1000 * percentile(seconds, 0.50), 3),
+        "p99_ms": round(1000 * percentile(seconds, 0.99), 3),
+        "max_ms": round(1000 * max(seconds, default=0.0), 3),
+    }
+
+
+def rss_mb(pid: int) -> float | None:
+    # Resident memory of a process, only available on Linux
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def serve(port: int, workdir: str, options: dict):
+    """Entry point of the server process"""
+    os.chdir(workdir)
+    setup_logging("ERROR")
+    server = ChatServer("localhost", port, llm="stub", **options)
+    try:
+        asyncio.run(server.start())
+    except KeyboardInterrupt:
+        pass
+
+
+class ServerProcess:
+    """ChatServer running in a child process"""
+
+    def __init__(self, port: int, workdir: str, options: dict):
+        self.port = port
+        self.workdir = workdir
+        self.options = options
+        self.process = None
+
+    async def start(self) -> float:
+        """Start the server, returning the seconds until it accepts connections"""
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(target=serve, args=(self.port, self.workdir, self.options))
+        started = time.perf_counter()
+        self.process.start()
+        while True:
+            try:
+                _, writer = await asyncio.open_connection("localhost", self.port)
+                writer.close()
+                return time.perf_counter() - started
+            except OSError:
+                if not self.process.is_alive():
+                    raise RuntimeError("Server failed to start")
+                await asyncio.sleep(0.05)
+
+    def rss_mb(self) -> float | None:
+        return rss_mb(self.process.pid)
+
+    def stop(self) -> None:
+        # Interrupt like Ctrl+C so that the server commits and closes its files
+        os.kill(self.process.pid, signal.SIGINT)
+        self.process.join(60)
+
+
+class Client:
+    """Simulated user timing the messages it receives"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+        self.latencies = []  # Seconds from send to receipt
+
+    async def request(self, port: int, msg):
+        self.reader, self.writer = await asyncio.open_connection("localhost", port)
+        await send_message(msg, self.writer)
+        return await receive_message(self.reader)
+
+    async def receive(self):
+        try:
+            while True:
+                msg = await receive_message(self.reader)
+                for received in (msg.messages if type(msg) == MessageBatch else [msg]):
+                    if type(received) == UserMessage:
+                        # Senders stamp their messages with the shared perf counter
+                        sent = int(received.content.split(" ", 1)[0])
+                        self.latencies.append((time.perf_counter_ns() - sent) / 1e9)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+
+    def close(self) -> None:
+        if self.receiver is not None:
+            self.receiver.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def run_requests(clients, make_request, port: int, concurrency: int, keep: bool) -> dict:
+    """Send one session request per client, at most concurrency at a time"""
+    semaphore = asyncio.Semaphore(concurrency)
+    times = []
+
+    async def one(client):
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.request(port, make_request(client))
+            times.append(time.perf_counter() - started)
+            if keep and response.status == 0:
+                client.receiver = asyncio.get_running_loop().create_task(client.receive())
+            else:
+                client.close()
+            return response.status == 0
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[one(client) for client in clients])
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(clients),
+        "failures": results.count(False),
+        "per_second": round(len(clients) / elapsed, 1),
+        **summary_ms(times),
+    }
+
+
+async def seed(workdir: str, names: list, friends: int, history_sizes: list, shards: int) -> float:
+    """Befriend every user with their ring neighbours and create users with long histories"""
+    started = time.perf_counter()
+    graph = ChatGraph(SERVER_NAME, os.path.join(workdir, "data", SERVER_NAME, "cgraph.pkl"), durability="batched", shards=shards)
+    for i, name in enumerate(names):
+        for k in range(1, friends + 1):
+            peer = names[(i + k) % len(names)]
+            if peer != name:
+                await graph.add_friend(name, peer)
+                await graph.add_friend(peer, name)
+    for size in history_sizes:
+        user, peer = f"history{size}", f"history{size}peer"
+        await asyncio.gather(graph.add_user(user, PASSWORD), graph.add_user(peer, PASSWORD))
+        await graph.add_friend(user, peer)
+        await graph.add_friend(peer, user)
+        for start in range(0, size, 1000):
+            await graph.log_msgs([
+                UserMessage(user, peer, f"history message {i}") if i % 2 else UserMessage(peer, user, f"history message {i}")
+                for i in range(start, min(size, start + 1000))
+            ], check_valid=False)
+    await graph.close()
+    return time.perf_counter() - started
+
+
+async def login_vs_history(port: int, history_sizes: list, repeats: int) -> list:
+    results = []
+    for size in history_sizes:
+        times = []
+        for _ in range(repeats):
+            client = Client(f"history{size}")
+            started = time.perf_counter()
+            response = await client.request(port, LoginRequest(client.name, SERVER_NAME, PASSWORD))
+            times.append(time.perf_counter() - started)
+            assert response.status == 0, response
+            client.close()
+            # Let the server notice the logout before logging in again
+            await asyncio.sleep(0.05)
+        results.append({"history": size, "median_ms": round(1000 * sorted(times)[len(times) // 2], 3)})
+    return results
+
+
+async def exchange(clients, neighbours: dict, messages: int, rate: float, timeout: float) -> dict:
+    """Every client sends messages to random friends, optionally paced to rate per second"""
+
+    async def send(client):
+        peers = neighbours[client.name]
+        for _ in range(messages):
+            msg = UserMessage(client.name, random.choice(peers), f"{time.perf_counter_ns()} load test message")
+            await send_message(msg, client.writer)
+            if rate > 0:
+                await asyncio.sleep(1 / rate)
+
+    expected = len(clients) * messages
+    received = lambda: sum(len(client.latencies) for client in clients)
+    started = time.perf_counter()
+    await asyncio.gather(*[send(client) for client in clients])
+    deadline = time.perf_counter() + timeout
+    while (received() < expected) and (time.perf_counter() < deadline):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    latencies = [latency for client in clients for latency in client.latencies]
+    return {
+        "sent": expected,
+        "delivered": len(latencies),
+        "duration_s": round(elapsed, 3),
+        "msgs_per_sec": round(len(latencies) / elapsed, 1),
+        **summary_ms(latencies),
+    }
+
+
+async def run(args, workdir: str) -> dict:
+    port = args.port or free_port()
+    options = {"durability": args.durability, "shards": args.shards, "workers": args.workers}
+    names = [f"user{i}" for i in range(args.clients)]
+    results = {"config": vars(args)}
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+        results["commit"] = commit.stdout.strip() or None
+    except OSError:
+        results["commit"] = None
+
+    # Register everyone over the wire
+    server = ServerProcess(port, workdir, options)
+    await server.start()
+    clients = [Client(name) for name in names]
+    make_request = lambda client: RegisterRequest(client.name, SERVER_NAME, PASSWORD)
+    results["register"] = await run_requests(clients, make_request, port, args.concurrency, keep=False)
+    server.stop()
+
+    # Befriend neighbours offline, then restart with the grown graph
+    results["seed_s"] = round(await seed(workdir, names, args.friends, args.history, args.shards), 3)
+    server = ServerProcess(port, workdir, options)
+    try:
+        results["startup_s"] = round(await server.start(), 3)
+        memory = {"idle": server.rss_mb()}
+
+        clients = [Client(name) for name in names]
+        make_request = lambda client: LoginRequest(client.name, SERVER_NAME, PASSWORD)
+        results["login"] = await run_requests(clients, make_request, port, args.concurrency, keep=True)
+        results["login_vs_history"] = await login_vs_history(port, args.history, args.repeats)
+        memory["logged_in"] = server.rss_mb()
+
+        neighbours = {name: [] for name in names}
+        for i, name in enumerate(names):
+            for k in range(1, args.friends + 1):
+                peer = names[(i + k) % len(names)]
+                if peer != name:
+                    neighbours[name].append(peer)
+                    neighbours[peer].append(name)
+        results["messages"] = await exchange(clients, neighbours, args.messages, args.rate, args.timeout)
+        memory["after_messages"] = server.rss_mb()
+        if None not in memory.values():
+            memory["growth"] = round(memory["after_messages"] - memory["idle"], 1)
+        results["memory_mb"] = memory
+        for client in clients:
+            client.close()
+        # Let the server log everyone out before interrupting it
+        await asyncio.sleep(1.0)
+    finally:
+        server.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=1000, help="Simulated users")
+    parser.add_argument("--friends", type=int, default=2, help="Ring neighbours each user befriends on either side")
+    parser.add_argument("--messages", type=int, default=20, help="Messages sent by every user")
+    parser.add_argument("--rate", type=float, default=0.0, help="Messages per second per user, 0 sends as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=200, help="Registrations or logins in flight at once")
+    parser.add_argument("--history", type=int, nargs="*", default=[0, 100, 1000, 10000], help="History sizes to time logins for")
+    parser.add_argument("--repeats", type=int, default=3, help="Logins per history size")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait for outstanding deliveries")
+    parser.add_argument("--durability", choices=DURABILITY_MODES, default="immediate")
+    parser.add_argument("--shards", type=int, default=CHAT_GRAPH_SHARDS)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("-p", "--port", type=int, default=0, help="Server port, 0 picks a free one")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory with the server's data")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+    parser.add_argument("--out", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    # Every client holds a socket, and so does the server for each of them
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    workdir = tempfile.mkdtemp(prefix="messaging-load-")
+    try:
+        results = asyncio.run(run(args, workdir))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for section in ("register", "login", "messages"):
+            print(f"{section:<10}" + "  ".join(f"{k}={v}" for k, v in results[section].items()))
+        print(f"{'history':<10}" + "  ".join(f"{r['history']}: {r['median_ms']} ms" for r in results["login_vs_history"]))
+        print(f"{'memory':<10}" + "  ".join(f"{k}={v} MB" for k, v in results["memory_mb"].items()))
+        print(f"{'startup':<10}{results['startup_s']} s, seeded in {results['seed_s']} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Compare the memory, scan and serialization costs of chat history representations
+
+Cold chat logs keep only their newest messages in memory and map the rest from segment files.
+
+Run from the repository root: python -m benchmarks.memory
+"""
+import argparse
+import datetime
+import json
+import os
+import pickle
+import tempfile
+import timeit
+import tracemalloc
+
+from utils.chatlog import ChatLog
+from utils.messaging import UserMessage
+
+
+class DictMessage:
+    """A user message with a __dict__, as messages were stored before slots"""
+
+    def __init__(self, sender: str, recipient: str, content: str):
+        self.sender = sender
+        self.recipient = recipient
+        self.timestamp = datetime.datetime.now(datetime.timezone.utc)
+        self.seq = None
+        self.content = content
+
+
+def build(kind: str, chats: int, history: int, hot: int = 0, dirpath: str | None = None) -> dict:
+    # Cold ChatLogs keep their newest hot messages in memory and the rest in segments under dirpath
+    if kind == "cold":
+        dirpath = tempfile.mkdtemp(dir=dirpath)
+    graph = {}
+    for c in range(chats):
+        sender, recipient = f"user{c}", f"user{c + 1}"
+        msgs = []
+        for seq in range(history):
+            cls = DictMessage if kind == "dict" else UserMessage
+            msg = cls(sender, recipient, f"message number {seq} from {sender}")
+            msg.seq = seq
+            msgs.append(msg)
+        if kind in ("chatlog", "cold"):
+            msgs = ChatLog(msgs)
+            if (kind == "cold") and (history > hot):
+                msgs.seal(history - hot, os.path.join(dirpath, f"{c}.cold"))
+        graph[(sender, recipient)] = msgs
+    return graph
+
+
+def resident(*args) -> int:
+    # Building ChatLogs from messages peaks higher than what they keep, so only count what is retained.
+    # Mapped segments live in the page cache and are not counted.
+    tracemalloc.start()
+    graph = build(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del graph
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=100, help="Chats in the sample graph")
+    parser.add_argument("--history", type=int, default=1000, help="Messages in every chat")
+    parser.add_argument("--page", type=int, default=50, help="Messages in a history page")
+    parser.add_argument("--hot", type=int, default=100, help="Messages of every chat kept in memory by cold chat logs")
+    parser.add_argument("-n", "--number", type=int, default=5, help="Iterations per timing")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+    args = parser.parse_args()
+
+    results = []
+    tmpdir = tempfile.TemporaryDirectory()
+    for kind in ("dict", "slots", "chatlog", "cold"):
+        memory = resident(kind, args.chats, args.history, args.hot, tmpdir.name)
+        graph = build(kind, args.chats, args.history, args.hot, tmpdir.name)
+        number = args.number
+
+        def page():
+            for msgs in graph.values():
+                msgs[-args.page:]
+
+        def scan():
+            # Read every content as the search index does, ChatLogs without building messages
+            for msgs in graph.values():
+                if isinstance(msgs, ChatLog):
+                    for _, content in msgs.contents():
+                        pass
+                else:
+                    for msg in msgs:
+                        msg.content
+
+        payload = pickle.dumps(graph, protocol=pickle.HIGHEST_PROTOCOL)
+        results.append({
+            "storage": kind,
+            "messages": args.chats * args.history,
+            "memory_mb": round(memory / 2**20, 2),
+            "page_ms": round(1e3 * timeit.timeit(page, number=number) / number, 2),
+            "scan_ms": round(1e3 * timeit.timeit(scan, number=number) / number, 2),
+            "dump_ms": round(1e3 * timeit.timeit(lambda: pickle.dumps(graph, protocol=pickle.HIGHEST_PROTOCOL), number=number) / number, 2),
+            "load_ms": round(1e3 * timeit.timeit(lambda: pickle.loads(payload), number=number) / number, 2),
+            "pickle_mb": round(len(payload) / 2**20, 2),
+        })
+        del graph
+    tmpdir.cleanup()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        columns = ("memory_mb", "page_ms", "scan_ms", "dump_ms", "load_ms", "pickle_mb")
+        print(f"{'storage':<10}" + "".join(f"{c:>12}" for c in columns))
+        for r in results:
+            print(f"{r['storage']:<10}" + "".join(f"{r[c]:>12}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
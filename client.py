@@ -1,31 +1,53 @@
 import argparse
 import asyncio
+import collections
 import dataclasses
 import inspect
+import logging
+import os
+import random
 import urwid
 
 from typing import Any, Tuple
 
-from utils.chat import ChatGraph
+from utils.chat import ChatGraph, is_room
 from utils.constants import (
-    APP_NAME,
-    APP_VERSION,
     SERVER_NAME,
     SERVER_DEFAULT_HOST,
     SERVER_DEFAULT_PORT,
     SERVER_DISPLAY_NAME,
+    HISTORY_PAGE_SIZE,
+    SEARCH_PAGE_SIZE,
+    CLIENT_INBOX_SIZE,
+    CLIENT_SCROLLBACK,
+    CLIENT_MAX_FPS,
+    CLIENT_OUTBOX_SIZE,
+    CLIENT_RECONNECT_DELAYS,
+    ROOM_PREFIX,
     AppStates,
     HELP_TEXT
 )
+from utils.codec import BinaryCodec
+from utils.log import setup_logging
 from utils.messaging import (
     receive_message,
     send_message,
     RegisterRequest,
     LoginRequest,
+    ResumeRequest,
+    LogoutRequest,
+    HistoryRequest,
+    SearchRequest,
+    RoomRequest,
     UserMessage,
+    ServerMessage,
+    MessageBatch,
 )
 
 
+log = logging.getLogger("client")
+
+
 class CommandBox(urwid.Edit):
     signals = urwid.Edit.signals + ["submit"]
 
@@ -42,6 +64,91 @@ class CommandBox(urwid.Edit):
             return super().keypress(size, key)
 
 
+class ScrollbackWalker(urwid.ListWalker):
+    """Ring buffer of display entries for a ListBox
+
+    Holds at most cap entries, dropping the oldest ones first. Text widgets
+    are only created for entries the ListBox scrolls to. Scrolling past the
+    first entry pages older entries in from the older(n) callable, if set,
+    until the buffer is full. Positions are absolute and keep their
+    meaning while entries are dropped or paged in.
+    """
+
+    def __init__(self, cap: int = CLIENT_SCROLLBACK):
+        self.entries = collections.deque(maxlen=cap)
+        self.widgets = {}  # position -> widget, created when first shown
+        self.first = 0  # position of entries[0]
+        self.focus = 0
+        self.older = None
+
+    def _end(self) -> int:
+        return self.first + len(self.entries)
+
+    def __getitem__(self, position: int) -> urwid.Text:
+        if not self.first <= position < self._end():
+            raise IndexError(position)
+        widget = self.widgets.get(position)
+        if widget is None:
+            widget = self.widgets[position] = urwid.Text(self.entries[position - self.first])
+        return widget
+
+    def next_position(self, position: int) -> int:
+        if position + 1 >= self._end():
+            raise IndexError(position)
+        return position + 1
+
+    def prev_position(self, position: int) -> int:
+        if position - 1 < self.first and not self.page_older():
+            raise IndexError(position)
+        return position - 1
+
+    def set_focus(self, position: int) -> None:
+        self.focus = position
+        self._modified()
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.widgets.clear()
+        self.first = self.focus = 0
+        self.older = None
+        self._modified()
+
+    def append(self, text: str) -> None:
+        self.extend([text])
+
+    def extend(self, texts: list) -> None:
+        # Keep following the newest entry unless scrolled up
+        follow = self.focus >= self._end() - 1
+        for text in texts:
+            if len(self.entries) == self.entries.maxlen:
+                self.widgets.pop(self.first, None)
+                self.first += 1
+            self.entries.append(text)
+        self.focus = self._end() - 1 if follow else max(self.focus, self.first)
+        self._modified()
+
+    def page_older(self, n: int = HISTORY_PAGE_SIZE) -> bool:
+        """Prepend up to n older entries, False if there are none or the buffer is full"""
+        room = self.entries.maxlen - len(self.entries)
+        if self.older is None or room == 0:
+            return False
+        texts = self.older(min(n, room))
+        empty = not self.entries
+        for text in reversed(texts):
+            self.entries.appendleft(text)
+            self.first -= 1
+        if empty and texts:
+            self.focus = self._end() - 1
+        return len(texts) > 0
+
+    def scroll(self, delta: int) -> None:
+        target = self.focus + delta
+        while target < self.first and self.page_older():
+            pass
+        if self.entries:
+            self.set_focus(min(max(target, self.first), self._end() - 1))
+
+
 # AppState class
 @dataclasses.dataclass
 class AppState:
@@ -51,6 +158,8 @@ class AppState:
     reader = None
     writer = None
     chat_graph = None
+    resume: str | None = None  # Token to resume the session with after a dropped connection
+    sent: int = 0  # Client id of the last message sent in this session
 
 
 # AppAttributes class
@@ -62,7 +171,7 @@ class AppAttributes:
 
 # Client class
 class ChatClient:
-    def __init__(self, host: str = SERVER_DEFAULT_HOST, port: int = SERVER_DEFAULT_PORT):
+    def __init__(self, host: str = SERVER_DEFAULT_HOST, port: int = SERVER_DEFAULT_PORT, scrollback: int = CLIENT_SCROLLBACK, fps: int = CLIENT_MAX_FPS):
         # App state and attributes
         self.app_attributes = AppAttributes(host=host, port=port)
         self.app_state = AppState()
@@ -71,17 +180,34 @@ class ChatClient:
         self.evl = asyncio.new_event_loop()
         asyncio.set_event_loop(self.evl)
 
+        # Receiver tasks, running while logged in
+        self.receiver_tasks = []
+
+        # Sent messages to replay if the connection drops, and the task reconnecting then
+        self.outbox = collections.deque(maxlen=CLIENT_OUTBOX_SIZE)
+        self.reconnect_task = None
+
+        # Last search request, to page through its results
+        self.last_search = None
+
+        # Redraws are coalesced into frames
+        self.frame_interval = 1 / fps
+        self.last_redraw = 0.0
+        self.redraw_handle = None
+
         # UI widgets
-        self.display = urwid.Text(HELP_TEXT, align="left")
+        self.scrollback = ScrollbackWalker(scrollback)
+        self.scrollback.append(HELP_TEXT)
+        self.display = urwid.ListBox(self.scrollback)
         self.display_box = urwid.LineBox(self.display)
         self.chats = urwid.Text("", align="center")
-        self.chats_box = urwid.LineBox(self.chats)
+        self.chats_box = urwid.LineBox(urwid.Filler(self.chats, valign="top"))
         self.main = urwid.Columns([self.chats_box, self.display_box])
         self.div = urwid.Divider()
         self.command = CommandBox("Command: ", edit_text="")
         self.command_box = urwid.LineBox(self.command)
-        self.pile = urwid.Pile([self.main, self.div, self.command_box])
-        self.top = urwid.Filler(self.pile, valign="top")
+        self.pile = urwid.Pile([self.main, ("pack", self.div), ("pack", self.command_box)], focus_item=2)
+        self.top = self.pile
 
         # Signals
         urwid.connect_signal(self.command, "submit", self.executor_wrapper)
@@ -96,6 +222,11 @@ class ChatClient:
             "exit": self.exit,
             "register": self.register,
             "back": self.back,
+            "history": self.history,
+            "chat": self.chat,
+            "room": self.room,
+            "search": self.search,
+            "more": self.more,
         }
 
     def _generate_help_str(self) -> str:
@@ -110,49 +241,248 @@ class ChatClient:
 
     def help(self):
         """Get help text with all commands and their descriptions"""
-        self.display.set_text(self._generate_help_str())
+        self.show(self._generate_help_str())
 
     def attributes(self):
         """Display all app attributes"""
         attributes_str = "ATTRIBUTES:\n"
         for attr_name, attr_val in dataclasses.asdict(self.app_attributes).items():
             attributes_str += f"{attr_name}: {attr_val}\n"
-        self.display.set_text(self.display.text + "\n\n" + attributes_str)
+        self.scrollback.append(attributes_str)
 
     def set(self, attr: str, val: Any):
         """Set an app attribute to a value"""
         if attr in self.app_attributes.__dict__:
             setattr(self.app_attributes, attr, val)
-            self.display.set_text(self.display.text + "\n\n" + f"{attr} set to {val}" + "\n")
+            self.scrollback.append(f"{attr} set to {val}")
         else:
-            self.display.set_text(self.display.text + "\n\n" + f"Unknown attribute: {attr}" + "\n")
+            self.scrollback.append(f"Unknown attribute: {attr}")
 
     def login(self):
         """Log in"""
         if self.app_state.state != AppStates.LOGIN:
-            self.display.set_text("Enter your username:")
+            self.show("Enter your username:")
             self.app_state.state = AppStates.LOGIN_START
 
     def logout(self):
         """Log out"""
+        # Forget the cached session token so that the next login asks for the password
+        if self.app_state.username is not None:
+            session_path = self._cache_path(self.app_state.username, "session")
+            if os.path.exists(session_path):
+                os.remove(session_path)
+        # Have the server revoke the session's tokens before the connection closes
+        if (self.app_state.state == AppStates.LOGIN) and (self.app_state.writer is not None) and (self.reconnect_task is None):
+            writer, self.app_state.writer = self.app_state.writer, None
+            asyncio.ensure_future(self.send_logout(LogoutRequest(self.app_state.username, SERVER_NAME), writer), loop=self.evl)
+        self.end_session()
+        self.show("Logged out.")
+
+    @staticmethod
+    async def send_logout(msg, writer) -> None:
+        try:
+            await send_message(msg, writer)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def end_session(self) -> None:
+        self.stop_receiver()
+        if self.reconnect_task is not None:
+            self.reconnect_task.cancel()
+            self.reconnect_task = None
+        if self.app_state.writer is not None:
+            self.app_state.writer.close()
+        # Flush the locally cached chat graph
+        if self.app_state.chat_graph is not None:
+            asyncio.ensure_future(self.app_state.chat_graph.close(), loop=self.evl)
+        self.outbox.clear()
         self.app_state = AppState()
-        self.display.set_text("Logged out.")
+
+    def disconnected(self) -> None:
+        if self.reconnect_task is not None:
+            return
+        if self.app_state.resume is None:
+            self.end_session()
+            self.show(f"{SERVER_DISPLAY_NAME} disconnected!")
+            return
+        # Keep the session and its chat graph while reconnecting
+        self.stop_receiver()
+        self.app_state.writer.close()
+        self.app_state.reader = self.app_state.writer = None
+        self.scrollback.append(f"{SERVER_DISPLAY_NAME} disconnected! Reconnecting..")
+        self.reconnect_task = self.evl.create_task(self.reconnect())
+
+    async def reconnect(self) -> None:
+        delay, max_delay = CLIENT_RECONNECT_DELAYS
+        while True:
+            # Back off exponentially with jitter so that clients don't all come back at once
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(2 * delay, max_delay)
+            msg = ResumeRequest(self.app_state.username, SERVER_NAME, self.app_state.resume, self.app_state.chat_graph.last_seen())
+            try:
+                reader, writer, response = await self.open_session(msg)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                continue
+            if response.status == 0:
+                break
+            writer.close()
+            if isinstance(response.metadata, dict) and response.metadata.get("expired"):
+                self.reconnect_task = None
+                self.end_session()
+                self.show(f"{SERVER_DISPLAY_NAME}: {response.content}")
+                self.schedule_redraw()
+                return
+            # The server may not have noticed the dropped connection yet
+
+        # Catch up on what happened meanwhile and pick the session up again
+        self.reconnect_task = None
+        self.app_state.reader, self.app_state.writer = reader, writer
+        self.app_state.resume = response.metadata["resume"]
+        await self.app_state.chat_graph.merge_delta(response.metadata)
+        self.start_receiver()
+
+        # Replay the messages the server did not receive before the connection dropped
+        received = response.metadata["received"]
+        pending = [m for m in self.outbox if (received is None) or (m.client_id > received)]
+        self.outbox.clear()
+        self.scrollback.append(f"{SERVER_DISPLAY_NAME}: {response.content}" + (f" Resending {len(pending)} messages." if pending else ""))
+        self.schedule_redraw()
+        for msg in pending:
+            self.outbox.append(msg)
+            try:
+                await send_message(msg, writer)
+            except (ConnectionError, OSError):
+                self.disconnected()
+                return
 
     def exit(self) -> None:
-        """Log out and exit the app"""
-        self.logout()
+        """Exit the app, staying logged in for the next start unless logged out first"""
+        self.end_session()
         raise urwid.ExitMainLoop()
 
     def register(self):
         """Create a new username and password"""
         if self.app_state.state != AppStates.LOGIN:
-            self.display.set_text("Registering new user..\nEnter your username:")
+            self.show("Registering new user..\nEnter your username:")
             self.app_state.state = AppStates.REG_START
 
     def back(self):
         """Go back"""
         pass
 
+    def history(self):
+        """Load older messages of the current chat"""
+        if self.app_state.state == AppStates.LOGIN and self.app_state.writer is not None:
+            asyncio.ensure_future(self.request_history(), loop=self.evl)
+
+    def chat(self, name: str):
+        """Switch the current chat to a user or a #room"""
+        if self.app_state.state == AppStates.LOGIN:
+            self.app_state.recipient = name
+            self.show_chat()
+
+    def room(self, action: str, name: str):
+        """Create, join or leave a #room"""
+        if self.app_state.state != AppStates.LOGIN or self.app_state.writer is None:
+            return
+        if action not in RoomRequest.ACTIONS or not is_room(name):
+            self.scrollback.append(f"Usage: :room <{'|'.join(RoomRequest.ACTIONS)}> {ROOM_PREFIX}<name>")
+            return
+        msg = RoomRequest(self.app_state.username, SERVER_NAME, action, name)
+        asyncio.ensure_future(send_message(msg, self.app_state.writer), loop=self.evl)
+
+    def search(self, term: str, user: str | None = None):
+        """Search your chats, or only the one with a user or #room, for a keyword"""
+        if self.app_state.state != AppStates.LOGIN or self.app_state.writer is None:
+            return
+        self.last_search = SearchRequest(self.app_state.username, SERVER_NAME, term, user, 0, SEARCH_PAGE_SIZE)
+        asyncio.ensure_future(send_message(self.last_search, self.app_state.writer), loop=self.evl)
+
+    def more(self):
+        """Show the next page of search results"""
+        if self.app_state.state != AppStates.LOGIN or self.app_state.writer is None or self.last_search is None:
+            return
+        last = self.last_search
+        self.last_search = SearchRequest(last.sender, SERVER_NAME, last.query, last.peer, last.offset + last.limit, last.limit)
+        asyncio.ensure_future(send_message(self.last_search, self.app_state.writer), loop=self.evl)
+
+    async def request_history(self) -> None:
+        username = self.app_state.username
+        recipient = self.app_state.recipient
+        cursors = self.app_state.chat_graph.cursors
+        if is_room(recipient):
+            before = {recipient: cursors.get(recipient, 0)}
+        else:
+            before = {
+                (username, recipient): cursors.get((username, recipient), 0),
+                (recipient, username): cursors.get((recipient, username), 0),
+            }
+        msg = HistoryRequest(username, SERVER_NAME, recipient, before, HISTORY_PAGE_SIZE)
+        await send_message(msg, self.app_state.writer)
+
+    def _cache_path(self, username: str, filename: str = "cgraph.pkl") -> str:
+        host, port = self.app_attributes.host, self.app_attributes.port
+        return os.path.join("data", f"{host}_{port}", username, filename)
+
+    def _save_session(self, token: str | None) -> None:
+        if token is None:
+            return
+        path = self._cache_path(self.app_state.username, "session")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            f.write(token)
+
+    def _format_msg(self, msg) -> str:
+        sender = SERVER_DISPLAY_NAME if msg.sender == SERVER_NAME else msg.sender
+        if is_room(msg.recipient):
+            return f"[{msg.recipient}] {sender}: {msg.content}"
+        return f"{sender}: {msg.content}"
+
+    def show(self, text: str) -> None:
+        self.display_box.set_title("")
+        self.scrollback.clear()
+        self.scrollback.append(text)
+
+    def show_chat(self) -> None:
+        # Start from the latest page and page older messages in on scrolling up
+        msgs = self._chat_msgs()
+        remaining = len(msgs)
+
+        def older(n):
+            nonlocal remaining
+            start = max(0, remaining - n)
+            page, remaining = msgs[start:remaining], start
+            return [self._format_msg(m) for m in page]
+
+        self.display_box.set_title(f"Chatting with {self.app_state.recipient}")
+        self.scrollback.clear()
+        self.scrollback.older = older
+        self.scrollback.page_older()
+
+    def scroll(self, key: str) -> None:
+        if key in ("page up", "page down"):
+            rows = self.urwid_loop.screen.get_cols_rows()[1]
+            self.scrollback.scroll(max(1, rows // 2) * (-1 if key == "page up" else 1))
+
+    def _chat_msgs(self) -> list:
+        # Merge both directions of the current chat in time order
+        username = self.app_state.username
+        recipient = self.app_state.recipient
+        chat_graph = self.app_state.chat_graph
+        if is_room(recipient):
+            msgs = list(chat_graph.rooms.get(recipient, {"messages": []})["messages"])
+        else:
+            cgraph = chat_graph.cgraph
+            msgs = list(cgraph[username]["chats"].get(recipient, []))
+            if recipient != username:
+                msgs += cgraph.get(recipient, {"chats": {}})["chats"].get(username, [])
+        # Add own messages of this session the server hasn't numbered for the local graph yet
+        msgs += [m for m in self.outbox if (m.recipient == recipient) and (m.seq is None)]
+        msgs.sort(key=lambda m: m.timestamp)
+        return msgs
+
     def executor_wrapper(self, text: str) -> None:
         asyncio.ensure_future(self.executor(text), loop=self.evl)
 
@@ -165,58 +495,102 @@ class ChatClient:
             if cmd in self.commands:
                 self.commands[cmd](*args)
             else:
-                self.display.set_text(self.display.text + "\n\n" + f"Unknown command: {cmd}" + "\n")
+                self.scrollback.append(f"Unknown command: {cmd}")
         # Text mode
         else:
             # REG_START or LOGIN_START
             if self.app_state.state in [AppStates.REG_START, AppStates.LOGIN_START]:
                 self.app_state.username = text
-                self.display.set_text("Enter your password:")
-                self.app_state.state = (AppStates.REG_USER if self.app_state.state == AppStates.REG_START else AppStates.LOGIN_USER)
+                # Skip the password if a cached session token still logs the user in
+                if (self.app_state.state == AppStates.LOGIN_START) and await self.token_login():
+                    pass
+                else:
+                    self.show("Enter your password:")
+                    self.app_state.state = (AppStates.REG_USER if self.app_state.state == AppStates.REG_START else AppStates.LOGIN_USER)
             # REG_USER or LOGIN_USER
             elif self.app_state.state in [AppStates.REG_USER, AppStates.LOGIN_USER]:
                 password = text
                 register = (self.app_state.state == AppStates.REG_USER)
-                success, response, metadata = await self.authenticate_user(self.app_state.username, password, register)
-                self.display.set_text(f"{SERVER_DISPLAY_NAME}: {response}")
+                # Load the locally cached chat graph to only fetch what is new
+                datapath = self._cache_path(self.app_state.username)
+                chat_graph = None
+                if (not register) and os.path.exists(datapath):
+                    chat_graph = ChatGraph(self.app_state.username, datapath=datapath)
+                last_seen = chat_graph.last_seen() if chat_graph is not None else None
+                success, response, metadata = await self.authenticate_user(self.app_state.username, password, register, last_seen)
+                self.show(f"{SERVER_DISPLAY_NAME}: {response}")
                 if success:
                     assert self.app_state.username is not None
                     assert self.app_state.reader is not None
                     assert self.app_state.writer is not None
-                    # Sync chat_graph with server version
-                    self.app_state.chat_graph = ChatGraph(self.app_state.username, datapath=None)
-                    await self.app_state.chat_graph.load_cgraph(metadata)
-                    self.app_state.state = AppStates.LOGIN
+                    await self.begin_session(chat_graph, metadata)
                 else:
                     self.app_state = AppState()  # Reset app_state
             # LOGIN
             elif self.app_state.state == AppStates.LOGIN:
-                msg = UserMessage(self.app_state.username, self.app_state.recipient, text)
-                try:
-                    # Send message
-                    await send_message(msg, self.app_state.writer)
-                    self.display.set_text(self.display.text + "\n" + f"{self.app_state.username}: {text}")
-                except:
-                    self.app_state = AppState()
-                    self.display.set_text(f"{SERVER_DISPLAY_NAME} disconnected!")
+                self.app_state.sent += 1
+                msg = UserMessage(self.app_state.username, self.app_state.recipient, text, self.app_state.sent)
+                self.outbox.append(msg)
+                self.scrollback.append(f"{self.app_state.username}: {text}")
+                # Send message, or keep it for the reconnect to replay
+                if self.app_state.writer is not None:
+                    try:
+                        await send_message(msg, self.app_state.writer)
+                    except (ConnectionError, OSError):
+                        self.disconnected()
             # LOGOUT
             else:  # self.app_state.state in [AppStates.LOGOUT]
                 pass
 
         # Redraw UI
-        self.evl.call_soon(self.urwid_loop.draw_screen)
-
-    async def authenticate_user(self, username: str, password: str, register: bool = False) -> Tuple[bool, str, dict]:
-        # Connect to server
-        self.app_state.reader, self.app_state.writer = await asyncio.open_connection(self.app_attributes.host, self.app_attributes.port)
-
+        self.schedule_redraw()
+
+    async def token_login(self) -> bool:
+        username = self.app_state.username
+        session_path = self._cache_path(username, "session")
+        if not os.path.exists(session_path):
+            return False
+        with open(session_path) as f:
+            token = f.read()
+        datapath = self._cache_path(username)
+        chat_graph = ChatGraph(username, datapath=datapath) if os.path.exists(datapath) else None
+        last_seen = chat_graph.last_seen() if chat_graph is not None else None
+        try:
+            reader, writer, response = await self.open_session(ResumeRequest(username, SERVER_NAME, token, last_seen))
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            response = None
+        if (response is None) or (response.status != 0):
+            if chat_graph is not None:
+                await chat_graph.close()
+            if response is None:
+                return False
+            writer.close()
+            if isinstance(response.metadata, dict) and response.metadata.get("expired"):
+                os.remove(session_path)
+            return False
+        self.app_state.reader, self.app_state.writer = reader, writer
+        self.show(f"{SERVER_DISPLAY_NAME}: {response.content}")
+        await self.begin_session(chat_graph, response.metadata)
+        return True
+
+    async def begin_session(self, chat_graph, metadata: dict) -> None:
+        # Sync chat_graph with server version
+        if chat_graph is None:
+            chat_graph = ChatGraph(self.app_state.username, datapath=self._cache_path(self.app_state.username))
+        self.app_state.chat_graph = chat_graph
+        await self.app_state.chat_graph.merge_delta(metadata)
+        self.app_state.resume = metadata.get("resume")
+        self._save_session(metadata.get("session"))
+        self.app_state.state = AppStates.LOGIN
+        self.start_receiver()
+
+    async def authenticate_user(self, username: str, password: str, register: bool = False, last_seen: dict | None = None) -> Tuple[bool, str, dict]:
         # Send server request
-        msg_class = RegisterRequest if register else LoginRequest
-        msg = msg_class(username, SERVER_NAME, password)
-        await send_message(msg, self.app_state.writer)
-
-        # Get response from server
-        response = await receive_message(self.app_state.reader)
+        if register:
+            msg = RegisterRequest(username, SERVER_NAME, password)
+        else:
+            msg = LoginRequest(username, SERVER_NAME, password, last_seen)
+        self.app_state.reader, self.app_state.writer, response = await self.open_session(msg)
         status = response.status
         content = response.content
         metadata = response.metadata
@@ -225,21 +599,115 @@ class ChatClient:
         # Return response
         return success, content, metadata
 
-    async def continuous_receiver(self):
+    async def open_session(self, msg) -> tuple:
+        # Connect to server
+        reader, writer = await asyncio.open_connection(self.app_attributes.host, self.app_attributes.port)
+        try:
+            await send_message(msg, writer)
+            # Get response from server
+            response = await receive_message(reader, allowed_codecs=(BinaryCodec.name,))
+        except Exception:
+            writer.close()
+            raise
+        return reader, writer, response
+
+    def start_receiver(self) -> None:
+        # Reading pauses while the inbox is full, so TCP flow control slows the server down
+        inbox = asyncio.Queue(maxsize=CLIENT_INBOX_SIZE)
+        self.receiver_tasks = [
+            self.evl.create_task(self.receive_loop(self.app_state.reader, inbox)),
+            self.evl.create_task(self.dispatch_loop(inbox)),
+        ]
+
+    def stop_receiver(self) -> None:
+        current = asyncio.current_task(self.evl) if self.evl.is_running() else None
+        for task in self.receiver_tasks:
+            if task is not current:
+                task.cancel()
+        self.receiver_tasks = []
+
+    async def receive_loop(self, reader, inbox: asyncio.Queue) -> None:
+        try:
+            while True:
+                await inbox.put(await receive_message(reader, allowed_codecs=(BinaryCodec.name,)))
+        except Exception as e:
+            # Any frame that can't be read leaves the stream out of step, so treat it as a disconnect
+            if not isinstance(e, (asyncio.IncompleteReadError, ConnectionError)):
+                log.warning("Receiving failed: %r", e)
+            # Tell the dispatcher once it has shown everything received before
+            await inbox.put(None)
+
+    async def dispatch_loop(self, inbox: asyncio.Queue) -> None:
         while True:
-            if self.app_state.state == AppStates.LOGIN:
+            # Apply a burst of messages at once and draw them in one frame
+            msgs = [await inbox.get()]
+            while not inbox.empty():
+                msgs.append(inbox.get_nowait())
+            for msg in msgs:
+                if msg is None:
+                    self.disconnected()
+                    self.schedule_redraw()
+                    return
+                # A message that fails to apply must not stop the ones after it
                 try:
-                    msg = await receive_message(self.app_state.reader)
-                    self.display.set_text(self.display.text + "\n" + f"{SERVER_DISPLAY_NAME}: {msg.content}")
-                    self.evl.call_soon(self.urwid_loop.draw_screen)
-                except:
-                    pass
-            else:
-                await asyncio.sleep(0.1)
+                    await self.handle_incoming(msg)
+                except Exception:
+                    log.exception("Handling %r failed", msg)
+                    self.scrollback.append(f"Failed to show a message from {msg.sender}.")
+            self.schedule_redraw()
+
+    def schedule_redraw(self) -> None:
+        # At most one redraw per frame interval, however many updates come in
+        if self.redraw_handle is not None:
+            return
+        delay = max(0.0, self.last_redraw + self.frame_interval - self.evl.time())
+        self.redraw_handle = self.evl.call_later(delay, self.redraw)
+
+    def redraw(self) -> None:
+        self.redraw_handle = None
+        self.last_redraw = self.evl.time()
+        self.urwid_loop.draw_screen()
+
+    async def handle_incoming(self, msg) -> None:
+        if type(msg) == MessageBatch:
+            # Unpack messages queued while offline
+            for queued in msg.messages:
+                await self.app_state.chat_graph.log_synced_msg(queued)
+            self.scrollback.extend([self._format_msg(queued) for queued in msg.messages])
+            return
+        metadata = msg.metadata if type(msg) == ServerMessage and isinstance(msg.metadata, dict) else {}
+        if "logged" in metadata:
+            # Cache an own room message once the server has numbered it
+            client_id, seq = metadata["logged"]
+            for sent in self.outbox:
+                if sent.client_id == client_id:
+                    sent.seq = seq
+                    await self.app_state.chat_graph.log_synced_msg(sent)
+                    break
+        elif "history" in metadata:
+            # Prepend older messages and re-render the current chat
+            await self.app_state.chat_graph.load_history(metadata["history"])
+            self.show_chat()
+            self.scrollback.append(f"{SERVER_DISPLAY_NAME}: {msg.content}")
+        elif "search" in metadata:
+            # Show a page of search results, best matches first
+            found = metadata["search"]
+            self.show(f"{SERVER_DISPLAY_NAME}: {msg.content}")
+            self.scrollback.extend([f"{m.timestamp:%Y-%m-%d %H:%M} {self._format_msg(m)}" for m in found["results"]])
+            if found["offset"] + len(found["results"]) < found["total"]:
+                self.scrollback.append("Type :more for more results")
+        else:
+            if "room" in metadata:
+                # Track rooms joined or left
+                if metadata["action"] == "leave":
+                    await self.app_state.chat_graph.drop_room(metadata["room"])
+                else:
+                    await self.app_state.chat_graph.load_room(metadata["room"], metadata["summary"])
+            await self.app_state.chat_graph.log_synced_msg(msg)
+            self.scrollback.append(self._format_msg(msg))
 
     def start(self):
-        self.receiver_task = self.evl.create_task(self.continuous_receiver())
-        self.urwid_loop = urwid.MainLoop(self.top, event_loop=urwid.AsyncioEventLoop(loop=self.evl))
+        self.urwid_loop = urwid.MainLoop(self.top, event_loop=urwid.AsyncioEventLoop(loop=self.evl), unhandled_input=self.scroll)
         self.urwid_loop.run()
 
 
@@ -248,8 +716,15 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", default=SERVER_DEFAULT_HOST)
     parser.add_argument("-p", "--port", type=int, default=SERVER_DEFAULT_PORT)
+    parser.add_argument("--scrollback", type=int, default=CLIENT_SCROLLBACK, help="Entries kept in the message view")
+    parser.add_argument("--fps", type=int, default=CLIENT_MAX_FPS, help="Screen redraws per second at most")
+    parser.add_argument("--log-file", default="data/client.log", help="Where to log errors, away from the screen")
     args = parser.parse_args()
 
+    # Log away from the screen
+    os.makedirs(os.path.dirname(args.log_file) or ".", exist_ok=True)
+    setup_logging("WARNING", path=args.log_file)
+
     # Create a client
-    client = ChatClient(args.host, args.port)
+    client = ChatClient(args.host, args.port, args.scrollback, args.fps)
     client.start()
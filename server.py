@@ -1,67 +1,404 @@
 import argparse
 import asyncio
+import copy
+import logging
+import multiprocessing
+import time
+import urllib.parse
 
-from utils.llm import LLM
-from utils.chat import ChatGraph
-from utils.connections import ConnectionManager
-from utils.constants import SERVER_NAME, SERVER_DEFAULT_HOST, SERVER_DEFAULT_PORT
+from utils.llm import LLM, LLM_BACKENDS, RateLimitError
+from utils.auth import SessionSigner, LoginStats, load_secret
+from utils.broker import LocalBroker
+from utils.bus import Hub, BusClient, RemoteOutgoingManager
+from utils.cache import ResponseCache
+from utils.chat import ChatGraph, is_room
+from utils.codec import CODECS
+from utils.connections import ConnectionManager, SessionWriter
+from utils.log import setup_logging
+from utils.metrics import metrics
+from utils.constants import (
+    SERVER_NAME,
+    SERVER_DEFAULT_HOST,
+    SERVER_DEFAULT_PORT,
+    DURABILITY_MODES,
+    OVERFLOW_POLICIES,
+    SEND_BUFFER_HIGH,
+    SLOW_CONSUMER_POLICIES,
+    OUTGOING_BATCH_SIZE,
+    HISTORY_PAGE_SIZE,
+    HISTORY_MAX_PAGE_SIZE,
+    SEARCH_MAX_PAGE_SIZE,
+    CHAT_GRAPH_SHARDS,
+    CHAT_HOT_MESSAGES,
+    LOG_LEVELS,
+    STATS_INTERVAL,
+)
 from utils.messaging import (
     receive_message,
     send_message,
     RegisterRequest,
     LoginRequest,
+    ResumeRequest,
+    LogoutRequest,
+    HistoryRequest,
+    SearchRequest,
+    RoomRequest,
     UserMessage,
     ServerMessage,
+    FanoutFrame,
+    MessageBatch,
 )
 from utils.outgoing import OutgoingManager
+from utils.tasks import spawn
+
+
+log = logging.getLogger("server")
 
 
 # Server class
 class ChatServer:
-    def __init__(self, host=SERVER_DEFAULT_HOST, port=SERVER_DEFAULT_PORT):
+    def __init__(
+        self,
+        host=SERVER_DEFAULT_HOST,
+        port=SERVER_DEFAULT_PORT,
+        durability="immediate",
+        llm="openai",
+        llm_cache_size=1024,
+        llm_cache_ttl=3600.0,
+        llm_cache_disk=False,
+        allow_pickle=False,
+        queue_cap=1000,
+        queue_overflow="drop-oldest",
+        send_buffer=SEND_BUFFER_HIGH,
+        slow_consumer="spill",
+        shards=CHAT_GRAPH_SHARDS,
+        workers=1,
+        bus=None,
+        node=None,
+        stats_interval=STATS_INTERVAL,
+        hot_messages=CHAT_HOT_MESSAGES,
+        hot_age=None,
+    ):
+        # Settings shared with worker processes
+        self.options = {
+            "host": host,
+            "port": port,
+            "llm": llm,
+            "llm_cache_size": llm_cache_size,
+            "llm_cache_ttl": llm_cache_ttl,
+            "llm_cache_disk": llm_cache_disk,
+            "allow_pickle": allow_pickle,
+            "send_buffer": send_buffer,
+            "slow_consumer": slow_consumer,
+            "stats_interval": stats_interval,
+        }
         self.host = host
         self.port = port
-        self.llm = LLM()
-        self.chat_graph = ChatGraph(mainuser=SERVER_NAME, datapath=f"data/{SERVER_NAME}/cgraph.pkl")
+        # One worker serves clients itself, any other number makes this process the hub of
+        # that many workers, with none waiting for separate server instances to join
+        self.workers = workers
+        self.bus_path = bus or f"data/{SERVER_NAME}/bus.sock"
+        self.replica = (workers == 1) and (bus is not None)
+        self.node = node or f"{host}:{port}"
+        # Every process serving clients dumps its own metrics
+        self.stats_interval = stats_interval
+        self.stats_path = f"data/{SERVER_NAME}/stats.json"
+        if self.replica:
+            self.stats_path = f"data/{SERVER_NAME}/stats.{urllib.parse.quote(self.node, safe='')}.json"
+        # Pickle frames are only safe to accept from trusted clients
+        self.codecs = list(CODECS) if allow_pickle else [c for c in CODECS if c != "pickle"]
+        # Only processes serving clients answer messages to the server
+        self.llm = None
+        if workers == 1:
+            cache = None
+            if llm_cache_size > 0:
+                cache_path = None
+                if llm_cache_disk:
+                    cache_path = f"data/{SERVER_NAME}/llm_cache"
+                    if self.replica:
+                        cache_path += "." + urllib.parse.quote(self.node, safe="")
+                cache = ResponseCache(maxsize=llm_cache_size, ttl=llm_cache_ttl, path=cache_path)
+            self.llm = LLM(backend=llm, cache=cache)
         self.connection_manager = ConnectionManager()
-        self.outgoing_manager = OutgoingManager()
+        # Sessions buffer up to send_buffer bytes, refilled once down to a quarter of it
+        assert slow_consumer in SLOW_CONSUMER_POLICIES, f"Unknown slow consumer policy: {slow_consumer}"
+        self.send_buffer = send_buffer
+        self.slow_policy = slow_consumer
+        self.spilled = set()  # Users whose new messages wait behind their queued ones
+        self.draining = set()  # Users whose queued messages are being delivered
+        self.deliveries = set()  # Tasks delivering queued messages
+        # Session tokens are signed with a secret shared by all nodes on this host
+        self.signer = SessionSigner(load_secret(f"data/{SERVER_NAME}/secret"))
+        self.login_stats = LoginStats()
+        if not self.replica:
+            self.broker = LocalBroker()
+            self.chat_graph = ChatGraph(
+                mainuser=SERVER_NAME,
+                datapath=f"data/{SERVER_NAME}/cgraph.pkl",
+                durability=durability,
+                shards=shards,
+                hot_messages=hot_messages,
+                hot_age=hot_age,
+            )
+            self.outgoing_manager = OutgoingManager(f"data/{SERVER_NAME}/outgoing", queue_cap, queue_overflow, durability)
+        else:
+            # Nodes of a hub keep a replica of its chat graph, the hub also owns the offline queues
+            self.chat_graph = ChatGraph(mainuser=SERVER_NAME, datapath=None)
+            self.broker = BusClient(self.bus_path, self.chat_graph)
+            self.outgoing_manager = RemoteOutgoingManager(self.broker)
+
+        # Gauges read whenever metrics are dumped
+        metrics.gauge("online_users", lambda: len(self.connection_manager.online) - 1)
+        metrics.gauge("send_buffers", self.connection_manager.send_buffers)
+        metrics.gauge("logins", self.login_stats.stats)
+        if not self.replica:
+            metrics.gauge("chat_graph", self.chat_graph.stats)
+            metrics.gauge("outgoing", self.outgoing_manager.stats)
+        if (self.llm is not None) and (self.llm.cache is not None):
+            metrics.gauge("llm.cache", self.llm.cache.stats)
 
-    async def attempt_delivery(self, msg, enqueue=False):
-        writer = self.connection_manager.get_writer(msg.recipient)
+    async def login(self, username, reader, writer, codec) -> bool:
+        session = SessionWriter(
+            writer, codec, self.send_buffer, self.send_buffer // 4, on_drained=lambda: self.resume_delivery(username)
+        )
+        if not await self.connection_manager.login(username, reader, session, codec):
+            session.stop()
+            return False
+        # Users may be online on another node
+        if not await self.broker.register(username):
+            await self.connection_manager.logout(username)
+            session.stop()
+            return False
+        # Hold back messages to the user until their login response and queued messages are sent
+        self.spilled.add(username)
+        self.draining.add(username)
+        return True
+
+    async def logout(self, username, token=None, received=None, revoke=False):
+        session = self.connection_manager.get_writer(username)
+        if session is not None:
+            session.stop()
+        await self.connection_manager.logout(username)
+        self.spilled.discard(username)
+        self.draining.discard(username)
+        try:
+            # Keep the session resumable up to the last message received, before anyone can log in again
+            if token is not None:
+                await self.broker.suspend_token(token, received)
+                # Redeem it right away when the user logged out so that nobody can resume the session
+                if revoke:
+                    await self.broker.redeem_token(username, token)
+            await self.broker.unregister(username)
+        except ConnectionError as e:
+            log.error("Logout of %s failed: %s", username, e)
+
+    async def route(self, msg, recipient) -> bool:
+        """Hand a message over to the node holding its recipient, False if no other node does"""
+        node = self.connection_manager.get_route(recipient)
+        if (node is None) or (node == self.node):
+            return False
+        try:
+            # Log first so that the recipient gets the message's sequence number
+            if msg.seq is None:
+                await self.chat_graph.log_msg(msg, check_valid=False)
+            routed = await self.broker.deliver(node, recipient, msg)
+        except Exception as e:
+            log.warning("Handover of a message for %s failed: %s", recipient, e)
+            return False
+        if routed:
+            metrics.inc("messages.routed")
+        return routed
+
+    async def attempt_delivery(self, msg, enqueue=False, recipient=None):
+        # Room messages are delivered to each member as the recipient
+        recipient = recipient or msg.recipient
+        session = self.connection_manager.get_writer(recipient)
         success = False
-        if writer is not None:
+        queue = enqueue
+        if session is not None:
             try:
-                await send_message(msg, writer)
-                await self.chat_graph.log_msg(msg, check_valid=False)
-                success = True
-                print(msg)
+                # Log first so that the recipient gets the message's sequence number
+                if msg.seq is None:
+                    await self.chat_graph.log_msg(msg, check_valid=False)
+                # Queued messages go first, and slow sessions refuse new ones
+                if (recipient not in self.spilled) and session.send(msg):
+                    success = True
+                    metrics.inc("messages.delivered")
+                    log.debug("Delivered %s", msg)
+                else:
+                    queue = enqueue and self.slow_consumer(session, recipient)
             except Exception as e:
-                print(e)
-        if not success and enqueue:
-            await self.outgoing_manager.put(msg)
+                log.warning("Delivery to %s failed: %s", recipient, e)
+        elif await self.route(msg, recipient):
+            success = True
+        if not success and queue:
+            await self.enqueue(msg, recipient)
+            # The session may have drained while the message was being queued
+            self.resume_delivery(recipient)
+        return success
+
+    def slow_consumer(self, session, recipient) -> bool:
+        """Apply the slow consumer policy to a session refusing a message, True if it should be queued"""
+        if session.closed or ((recipient in self.spilled) and not session.slow):
+            # Gone, or waiting behind queued messages rather than refused
+            return True
+        metrics.inc(f"slow_consumers.{self.slow_policy}")
+        if self.slow_policy == "spill":
+            # Hold back new messages until the queue has been delivered after the session drains
+            self.spilled.add(recipient)
+            return True
+        elif self.slow_policy == "disconnect":
+            log.info("Disconnecting slow consumer %s", recipient)
+            session.close()
+            return True
+        # Dropped messages are still in the chat graph for the client's next history sync
+        return False
+
+    def resume_delivery(self, username) -> None:
+        """Start delivering a user's queued messages unless their session is slow or already fed"""
+        session = self.connection_manager.get_writer(username)
+        if (
+            (username in self.spilled)
+            and (username not in self.draining)
+            and (session is not None)
+            and not (session.slow or session.closed)
+        ):
+            spawn(self.deliver_outgoing_msgs(username), self.deliveries, log)
+
+    async def enqueue(self, msg, recipient):
+        """Queue a message for an offline recipient, notifying the sender if it is rejected"""
+        metrics.inc("messages.queued")
+        if not await self.outgoing_manager.put(msg, recipient):
+            if msg.sender != SERVER_NAME:
+                response_content = f"Message to {recipient} rejected: their inbox is full."
+                await self.attempt_delivery(ServerMessage(SERVER_NAME, msg.sender, response_content, 1))
+
+    async def fanout_delivery(self, msg, recipients, per_recipient=True, enqueue=False):
+        """Deliver one message to many recipients, encoding it only once per codec"""
+        frame = FanoutFrame(msg, per_recipient=per_recipient)
+        failed = []
+        refused = []
+        for recipient in recipients:
+            session = self.connection_manager.get_writer(recipient)
+            if session is None:
+                failed.append(recipient)
+                continue
+            try:
+                if (recipient in self.spilled) or not session.put(frame.parts(recipient, session.codec)):
+                    refused.append(recipient)
+            except Exception as e:
+                log.warning("Delivery to %s failed: %s", recipient, e)
+                refused.append(recipient)
+        metrics.inc("messages.delivered", len(recipients) - len(failed) - len(refused))
+
+        # Hand over copies for recipients online on other nodes
+        remaining = []
+        for recipient in failed:
+            routed = copy.copy(msg)
+            if per_recipient:
+                routed.recipient = recipient
+            if not await self.route(routed, recipient):
+                remaining.append(recipient)
+        failed = remaining
+
+        # Queue copies for recipients the message could not reach
+        for recipient in refused:
+            session = self.connection_manager.get_writer(recipient)
+            if (session is None) or self.slow_consumer(session, recipient):
+                failed.append(recipient)
+        if enqueue:
+            for recipient in failed:
+                queued = copy.copy(msg)
+                if per_recipient:
+                    queued.recipient = recipient
+                await self.enqueue(queued, recipient)
+                self.resume_delivery(recipient)
+        return failed
+
+    async def broadcast(self, content, status=-1):
+        """Send a server notice to all online users"""
+        recipients = [u for u in list(self.connection_manager.online) if u != SERVER_NAME]
+        notice = ServerMessage(SERVER_NAME, None, content, status)
+        await self.fanout_delivery(notice, recipients)
 
     async def deliver_outgoing_msgs(self, username):
-        while (msg := await self.outgoing_manager.get(username)) is not None:
-            await self.attempt_delivery(msg, enqueue=True)
+        """Move a user's queued messages into their session, unless they are being moved already"""
+        if username in self.draining:
+            return
+        self.draining.add(username)
+        await self.drain_outgoing(username)
+
+    async def drain_outgoing(self, username):
+        # New messages to the user wait behind their queued ones until the queue is empty
+        session = self.connection_manager.get_writer(username)
+        current = lambda: (self.connection_manager.get_writer(username) is session) and not session.closed
+        self.spilled.add(username)
+        try:
+            # Drain in batches, only removing messages from the queue once sent
+            while True:
+                head, batch = await self.outgoing_manager.get_batch(username, OUTGOING_BATCH_SIZE)
+                if not current():
+                    break
+                if not batch:
+                    self.spilled.discard(username)
+                    break
+                # Log the whole batch in one transaction, then send it as one frame
+                await self.chat_graph.log_msgs([msg for msg in batch if msg.seq is None], check_valid=False)
+                frame = MessageBatch(SERVER_NAME, username, batch)
+                if (not current()) or not session.send(frame):
+                    # Resumed once the session drains
+                    break
+                metrics.inc("messages.delivered", len(batch))
+                log.debug("Delivered %s", frame)
+                # Acknowledge by number, older messages may have been dropped while sending
+                await self.outgoing_manager.ack(username, head + len(batch))
+        except Exception as e:
+            # Stop if the user went away again
+            log.info("Delivery of queued messages to %s stopped: %s", username, e)
+        finally:
+            # A new session of the user has its own drain
+            if self.connection_manager.get_writer(username) is session:
+                self.draining.discard(username)
+
+    async def handle_room_request(self, msg, session_id):
+        room = msg.room
+        metadata = None
+        if msg.action == "create":
+            success = await self.chat_graph.create_room(room, msg.sender)
+            content = f"Created room {room}." if success else f"Cannot create room {room}."
+        elif msg.action == "join":
+            success = await self.chat_graph.join_room(room, msg.sender)
+            content = f"Joined room {room}." if success else f"Cannot join room {room}."
+        else:
+            success = await self.chat_graph.leave_room(room, msg.sender)
+            content = f"Left room {room}." if success else f"Cannot leave room {room}."
+        if success:
+            metadata = {"room": room, "action": msg.action}
+            if msg.action != "leave":
+                metadata["summary"] = self.chat_graph.get_room_summary(room, HISTORY_PAGE_SIZE)
+        return ServerMessage(SERVER_NAME, msg.sender, content, 0 if success else 1, session_id, metadata)
 
     async def handle_client(self, reader, writer):
         # Get the client ID (peername) from the transport object
         client_id = writer.transport.get_extra_info("peername")
         session_id = str(client_id[1])
-        print(f"New client connected: {session_id}")
+        log.info("New client connected: %s", session_id)
 
         # Authenticate user
         username = None
+        token = None
+        received = None  # Client id of the last message received from the client
         while not username:
             try:
-                # Read message
-                msg = await receive_message(reader)
-                print(msg)
+                # Read message and reply with the codec the client chose
+                msg, codec = await receive_message(reader, return_codec=True, allowed_codecs=self.codecs)
+                log.debug("Received %s", msg)
 
                 # Attempt to authenticate user
                 success = False
                 response_content = None
                 metadata = None
+                started = time.monotonic()
                 if type(msg) == RegisterRequest:
                     registered = await self.chat_graph.add_user(msg.sender, msg.password)
                     if not registered:
@@ -69,7 +406,7 @@ class ChatServer:
                             f"Username {msg.sender} is taken. Try another one."
                         )
                     else:
-                        logged_in = await self.connection_manager.login(msg.sender, reader, writer)
+                        logged_in = await self.login(msg.sender, reader, writer, codec)
                         if not logged_in:
                             response_content = f"Can only log in from a single session. Username {msg.sender} is already logged in from a different session."
                         else:
@@ -78,24 +415,58 @@ class ChatServer:
                             )
                             username = msg.sender
                             success = True
-                            metadata = self.chat_graph.get_user_graph(username)
+                            metadata = self.chat_graph.get_user_summary(username, HISTORY_PAGE_SIZE)
                 elif type(msg) == LoginRequest:
-                    verified = self.chat_graph.verify_login(msg.sender, msg.password)
+                    verified = await self.chat_graph.verify_login(msg.sender, msg.password)
                     if not verified:
                         response_content = f"Incorrect username or password."
                     else:
-                        logged_in = await self.connection_manager.login(msg.sender, reader, writer)
+                        logged_in = await self.login(msg.sender, reader, writer, codec)
                         if not logged_in:
                             response_content = f"Can only log in from a single session. Username {msg.sender} is already logged in from a different session."
                         else:
                             response_content = f"Login successful."
                             username = msg.sender
                             success = True
-                            metadata = self.chat_graph.get_user_graph(username)
+                            # Only send what the client's cached graph is missing
+                            metadata = self.chat_graph.get_user_delta(username, msg.last_seen or {}, HISTORY_PAGE_SIZE)
+                elif type(msg) == ResumeRequest:
+                    # Resume a dropped session, or start a new one with a signed session token. Check the
+                    # token before logging in so that nobody can hold a username without credentials, and
+                    # only redeem it once logged in so that it can be retried while the old session lingers.
+                    signed = self.chat_graph.exists_user(msg.sender) and self.signer.verify(msg.sender, msg.token, self.chat_graph.session_key(msg.sender))
+                    valid = self.chat_graph.exists_user(msg.sender) and (signed or await self.broker.check_token(msg.sender, msg.token))
+                    logged_in = valid and await self.login(msg.sender, reader, writer, codec)
+                    session = None
+                    if logged_in:
+                        session = await self.broker.redeem_token(msg.sender, msg.token)
+                        if (session is None) and signed:
+                            session = {"received": None}
+                        if session is None:
+                            # The resume token expired or was redeemed meanwhile
+                            await self.logout(msg.sender)
+                    if not valid or (logged_in and session is None):
+                        response_content = f"Session expired. Log in again."
+                        metadata = {"expired": True}
+                    elif not logged_in:
+                        response_content = f"Can only log in from a single session. Username {msg.sender} is already logged in from a different session."
+                    else:
+                        response_content = f"Session resumed." if session["received"] is not None else f"Login successful."
+                        username = msg.sender
+                        success = True
+                        metadata = self.chat_graph.get_user_delta(username, msg.last_seen or {}, HISTORY_PAGE_SIZE)
+                        # Let the client replay only what was lost with the connection
+                        metadata["received"] = received = session["received"]
                 else:
                     success = False
                     response_content = f"Bad request."
                     metadata = None
+                if type(msg) in (RegisterRequest, LoginRequest, ResumeRequest):
+                    self.login_stats.record(type(msg).__name__, success, time.monotonic() - started)
+                if success:
+                    token = await self.broker.issue_token(username)
+                    metadata["resume"] = token
+                    metadata["session"] = self.signer.sign(username, self.chat_graph.session_key(username))
 
                 # Respond back
                 response = ServerMessage(
@@ -108,29 +479,81 @@ class ChatServer:
                 )
 
                 # Do not use attempt_delivery below since the user is not yet
-                # logged in or may not even be registered
-                await send_message(response, writer)
-                print(response)
+                # logged in or may not even be registered. Once logged in the
+                # response goes through the session, ahead of messages to them
+                if success:
+                    await self.reply(username, response)
+                else:
+                    await send_message(response, writer, codec)
+                log.debug("Sent %s", response)
 
             except Exception as e:
-                print(e)
+                self.log_disconnect(e)
                 if username:
-                    await self.connection_manager.logout(username)
-                print(f"[{session_id}] logged out.")
+                    await self.logout(username, token, received)
+                log.info("[%s] logged out.", session_id)
                 return
 
         # Deliver pending outgoing messages
         if username:
-            await self.deliver_outgoing_msgs(username)
+            await self.drain_outgoing(username)
 
         # Chat loop
         while username:
             try:
                 # Read message
-                msg = await receive_message(reader)
-                assert type(msg) == UserMessage
+                msg = await receive_message(reader, allowed_codecs=self.codecs)
+                received_at = time.perf_counter()
                 assert msg.sender == username
-                print(msg)
+                # Sequence numbers are only ever assigned by the server
+                msg.seq = None
+                if getattr(msg, "client_id", None) is not None:
+                    received = msg.client_id
+                metrics.inc("messages.received")
+                log.debug("Received %s", msg)
+
+                # Serve older history pages directly to the requesting session
+                if type(msg) == HistoryRequest:
+                    limit = max(1, min(msg.limit, HISTORY_MAX_PAGE_SIZE))
+                    pages = self.chat_graph.get_history(username, msg.peer, msg.before, limit)
+                    if pages is None:
+                        response = ServerMessage(SERVER_NAME, username, f"No chat with {msg.peer}", 1, session_id)
+                    else:
+                        count = sum(len(msgs) for _, msgs in pages.values())
+                        response_content = f"Loaded {count} older messages with {msg.peer}."
+                        response = ServerMessage(SERVER_NAME, username, response_content, 0, session_id, {"history": pages})
+                    await self.reply(username, response)
+                    continue
+
+                # Search the user's chats
+                if type(msg) == SearchRequest:
+                    limit = max(1, min(msg.limit, SEARCH_MAX_PAGE_SIZE))
+                    found = self.chat_graph.search(username, msg.query, msg.peer, max(0, msg.offset), limit)
+                    if found is None:
+                        response = ServerMessage(SERVER_NAME, username, f"No chat with {msg.peer}", 1, session_id)
+                    else:
+                        shown = len(found["results"])
+                        response_content = f"Found {found['total']} messages matching '{msg.query}'"
+                        if shown > 0:
+                            response_content += f", showing {found['offset'] + 1}-{found['offset'] + shown}"
+                        response = ServerMessage(SERVER_NAME, username, response_content + ".", 0, session_id, {"search": found})
+                    await self.reply(username, response)
+                    continue
+
+                # End the session for good, revoking its signed and resume tokens
+                if type(msg) == LogoutRequest:
+                    await self.chat_graph.revoke_sessions(username)
+                    await self.logout(username, token, received, revoke=True)
+                    log.info("%s[%s] logged out.", username, session_id)
+                    username = None
+                    continue
+
+                # Manage room membership
+                if type(msg) == RoomRequest:
+                    response = await self.handle_room_request(msg, session_id)
+                    await self.reply(username, response)
+                    continue
+                assert type(msg) == UserMessage
 
                 # Take action on the message
                 if msg.recipient == SERVER_NAME:
@@ -138,34 +561,171 @@ class ChatServer:
                     log_status = await self.chat_graph.log_msg(msg, check_valid=True)
 
                     # Respond back to client
-                    response_content = await self.llm.query(msg.content) if log_status else "Invalid message"
                     response_status = -1 if log_status else 1
+                    if log_status:
+                        try:
+                            response_content = await self.llm.query(msg.content, username=username)
+                        except RateLimitError as e:
+                            response_content, response_status = str(e), 1
+                        except Exception as e:
+                            log.error("AI response failed: %s", e)
+                            response_content, response_status = "AI response failed", 1
+                    else:
+                        response_content = "Invalid message"
                     response = ServerMessage(SERVER_NAME, username, response_content, response_status, session_id)
                     await self.attempt_delivery(response, enqueue=True)
+                elif is_room(msg.recipient):
+                    if self.chat_graph.is_msg_valid(msg):
+                        # Store once, then fan out to the other members
+                        await self.chat_graph.log_msg(msg, check_valid=False)
+                        members = self.chat_graph.get_room_members(msg.recipient) - {username}
+                        await self.fanout_delivery(msg, sorted(members), per_recipient=False, enqueue=True)
+                        metrics.observe("messages.fanout_latency", time.perf_counter() - received_at)
+                        # Tell the sender the sequence number of their message so that their cached room stays in sequence
+                        if msg.client_id is not None:
+                            await self.reply(username, ServerMessage(SERVER_NAME, username, "", 0, session_id, {"logged": (msg.client_id, msg.seq)}))
+                    else:
+                        response_content = f"Invalid message attempt to {msg.recipient}"
+                        response = ServerMessage(SERVER_NAME, username, response_content, 1, session_id)
+                        await self.attempt_delivery(response, enqueue=True)
                 else:
                     # Check msg validity
                     if self.chat_graph.is_msg_valid(msg):
-                        # Attempt delivery to recipient
-                        await self.attempt_delivery(msg, enqueue=True)
+                        # Attempt delivery to recipient, timing it from the receipt of the message
+                        if await self.attempt_delivery(msg, enqueue=True):
+                            metrics.observe("messages.deliver_latency", time.perf_counter() - received_at)
                     else:
                         # Notify sender of invalid message
                         response_content = f"Invalid message attempt to {msg.recipient}"
                         response = ServerMessage(SERVER_NAME, username, response_content, 1, session_id)
                         await self.attempt_delivery(response, enqueue=True)
             except Exception as e:
-                print(e)
-                await self.connection_manager.logout(username)
-                print(f"{username}[{session_id}] logged out.")
+                self.log_disconnect(e)
+                await self.logout(username, token, received)
+                log.info("%s[%s] logged out.", username, session_id)
                 username = None
 
+    async def reply(self, username, response):
+        """Send a response to a request of a user's own session, waiting while their connection is backed up"""
+        session = self.connection_manager.get_writer(username)
+        if (session is None) or not session.send(response, force=True):
+            raise ConnectionError(f"Session of {username} is closed")
+        await session.flush()
+
+    @staticmethod
+    def log_disconnect(e):
+        # Clients going away is business as usual, anything else is not
+        if isinstance(e, (asyncio.IncompleteReadError, ConnectionError)):
+            log.debug("Connection closed: %s", e)
+        else:
+            log.warning("Session failed: %r", e)
+
+    async def dump_stats(self):
+        """Dump metrics to the stats file periodically, logging a summary of each dump"""
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            try:
+                # Gauges read state the event loop mutates, so only the file write runs in the executor
+                snapshot = metrics.snapshot()
+                await asyncio.get_running_loop().run_in_executor(None, metrics.write, self.stats_path, snapshot)
+            except Exception as e:
+                log.error("Dumping metrics failed: %s", e)
+                continue
+            counters, histograms = snapshot["counters"], snapshot["histograms"]
+            log.info(
+                "%s online, %d received, %d delivered, %d queued, p99 delivery %.1f ms",
+                snapshot["gauges"].get("online_users", 0),
+                counters.get("messages.received", 0),
+                counters.get("messages.delivered", 0),
+                counters.get("messages.queued", 0),
+                histograms.get("messages.deliver_latency", {}).get("p99_ms", 0.0),
+            )
+
     async def start(self):
-        # Create server
-        server = await asyncio.start_server(self.handle_client, self.host, self.port)
-        print(f"Server started on port {self.port}")
+        if self.workers != 1:
+            await self.start_hub()
+            return
+
+        # Follow the presence of users on all nodes
+        await self.broker.connect(self.node, self.deliver_routed, self.connection_manager.set_route)
+
+        # Create server, nodes of a hub on this host may share the port
+        server = await asyncio.start_server(self.handle_client, self.host, self.port, reuse_port=self.replica)
+        log.info("Server started on port %s%s", self.port, f" (node {self.node})" if self.replica else "")
+        if self.stats_interval > 0:
+            stats_task = asyncio.get_running_loop().create_task(self.dump_stats())
+
+        # Start serving clients until the broker goes away
+        try:
+            async with server:
+                await self.broker.wait_closed()
+        finally:
+            # Let online users know before going away
+            await self.broadcast("Server is shutting down.")
+            sessions = [session for _, session, _ in self.connection_manager.online.values() if session is not None]
+            if sessions:
+                await asyncio.wait([asyncio.create_task(session.flush()) for session in sessions], timeout=1.0)
+            # Commit pending chat graph mutations before exiting
+            await self.chat_graph.close()
+            await self.outgoing_manager.close()
+            self.llm.close()
+            await self.broker.close()
+            if self.stats_interval > 0:
+                stats_task.cancel()
+            snapshot = metrics.dump(self.stats_path)
+            if not self.replica:
+                log.info("Chat graph: %s", snapshot["gauges"]["chat_graph"])
+            log.info("Logins: %s", snapshot["gauges"]["logins"])
+
+    async def deliver_routed(self, msg, recipient):
+        # Messages handed over by other nodes are queued if their recipient left meanwhile
+        await self.attempt_delivery(msg, enqueue=True, recipient=recipient)
+
+    async def start_hub(self):
+        """Serve as the hub of worker processes or separately started server instances"""
+        hub = Hub(self.bus_path, self.chat_graph, self.outgoing_manager)
+        await hub.start()
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(
+                target=run_worker, args=(self.options, hub.path, f"{self.host}:{self.port}#{i}", logging.getLogger().level)
+            )
+            for i in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+        if processes:
+            log.info("Server started on port %s with %d workers", self.port, self.workers)
+        else:
+            log.info("Hub started on %s", hub.path)
+        if self.stats_interval > 0:
+            stats_task = asyncio.get_running_loop().create_task(self.dump_stats())
+
+        loop = asyncio.get_running_loop()
+        try:
+            if processes:
+                await asyncio.gather(*[loop.run_in_executor(None, process.join) for process in processes])
+            else:
+                await hub.server.serve_forever()
+        finally:
+            # Closing the hub shuts the nodes down, wait for workers before committing the chat graph
+            await hub.close()
+            await asyncio.gather(*[loop.run_in_executor(None, process.join) for process in processes])
+            await self.chat_graph.close()
+            await self.outgoing_manager.close()
+            if self.stats_interval > 0:
+                stats_task.cancel()
+            log.info("Chat graph: %s", metrics.dump(self.stats_path)["gauges"]["chat_graph"])
+
 
-        # Start serving clients
-        async with server:
-            await server.serve_forever()
+def run_worker(options, bus, node, log_level):
+    """Entry point of worker processes"""
+    setup_logging(log_level)
+    server = ChatServer(**options, bus=bus, node=node)
+    try:
+        asyncio.run(server.start())
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
@@ -173,8 +733,46 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", default=SERVER_DEFAULT_HOST)
     parser.add_argument("-p", "--port", type=int, default=SERVER_DEFAULT_PORT)
+    parser.add_argument("--durability", choices=DURABILITY_MODES, default="immediate")
+    parser.add_argument("--llm", choices=list(LLM_BACKENDS), default="openai")
+    parser.add_argument("--llm-cache-size", type=int, default=1024, help="0 disables the AI response cache")
+    parser.add_argument("--llm-cache-ttl", type=float, default=3600.0, help="Seconds before cached AI responses expire")
+    parser.add_argument("--llm-cache-disk", action="store_true", help="Also keep cached AI responses on disk")
+    parser.add_argument("--allow-pickle", action="store_true", help="Also accept clients using the legacy pickle wire format, only for trusted networks")
+    parser.add_argument("--queue-cap", type=int, default=1000, help="Max queued messages per offline user")
+    parser.add_argument("--queue-overflow", choices=OVERFLOW_POLICIES, default="drop-oldest")
+    parser.add_argument("--send-buffer", type=int, default=SEND_BUFFER_HIGH, help="Bytes buffered per session before it counts as a slow consumer")
+    parser.add_argument("--slow-consumer", choices=SLOW_CONSUMER_POLICIES, default="spill", help="Queue, drop or disconnect on messages to slow consumers")
+    parser.add_argument("--shards", type=int, default=CHAT_GRAPH_SHARDS, help="Shards of the chat graph")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes accepting clients on the port")
+    parser.add_argument("--hub", action="store_true", help="Only run the hub for server instances started with --broker")
+    parser.add_argument("--broker", help="Unix socket of a hub to join as one of its server instances")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="INFO", help="DEBUG also logs every message")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL, help="Seconds between metrics dumps, 0 only dumps at exit")
+    parser.add_argument("--hot-messages", type=int, default=CHAT_HOT_MESSAGES, help="Messages of every chat kept in memory, 0 keeps all")
+    parser.add_argument("--hot-age", type=float, default=0, help="Also move messages older than this many seconds out of memory, 0 never does")
     args = parser.parse_args()
+    setup_logging(args.log_level)
 
     # Create and start the server
-    server = ChatServer(args.host, args.port)
+    server = ChatServer(
+        args.host,
+        args.port,
+        args.durability,
+        args.llm,
+        args.llm_cache_size,
+        args.llm_cache_ttl,
+        args.llm_cache_disk,
+        args.allow_pickle,
+        args.queue_cap,
+        args.queue_overflow,
+        args.send_buffer,
+        args.slow_consumer,
+        args.shards,
+        0 if args.hub else args.workers,
+        args.broker,
+        stats_interval=args.stats_interval,
+        hot_messages=args.hot_messages or None,
+        hot_age=args.hot_age or None,
+    )
     asyncio.run(server.start())
@@ -0,0 +1,35 @@
+import asyncio
+
+from utils.bus import BusClient, Hub
+from utils.chat import ChatGraph
+from utils.constants import SERVER_NAME, COLD_SEGMENT_MESSAGES
+from utils.messaging import UserMessage
+
+
+def test_replicas_follow_cold_segments(tmp_path):
+    async def run():
+        graph = ChatGraph(SERVER_NAME, str(tmp_path / "cgraph.pkl"), hot_messages=10)
+        hub = Hub(str(tmp_path / "bus.sock"), graph, None)
+        await hub.start()
+        replica = ChatGraph(SERVER_NAME, None)
+        bus = BusClient(hub.path, replica)
+        await bus.connect("node", None, lambda username, node: None)
+
+        await replica.add_user("alice", "password")
+        await replica.add_user("bob", "password")
+        await replica.add_friend("alice", "bob")
+        await replica.add_friend("bob", "alice")
+        await replica.log_msgs([UserMessage("alice", "bob", f"hello {i}") for i in range(COLD_SEGMENT_MESSAGES + 10)])
+        graph.dump()
+        await graph.close()
+        await asyncio.sleep(0.1)
+
+        chats = replica.cgraph["alice"]["chats"]["bob"]
+        result = chats.offset, chats[0].content, chats[-1].content
+        await bus.close()
+        await hub.close()
+        return result
+
+    offset, first, last = asyncio.run(run())
+    assert offset == COLD_SEGMENT_MESSAGES
+    assert (first, last) == ("hello 0", f"hello {COLD_SEGMENT_MESSAGES + 9}")
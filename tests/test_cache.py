@@ -0,0 +1,30 @@
+import asyncio
+
+from utils.cache import ResponseCache
+
+
+def test_disk_tier(tmp_path):
+    path = str(tmp_path / "cache" / "responses")
+
+    async def run():
+        cache = ResponseCache(maxsize=1, path=path)
+        await cache.put("a", "first")
+        await cache.put("b", "second")
+        # "a" was evicted from memory and comes back from disk
+        found = await cache.get("a")
+        cache.close()
+        cache = ResponseCache(maxsize=1, path=path)
+        found = (found, await cache.get("b"), await cache.get("c"))
+        stats = cache.stats()
+        cache.close()
+        return found, stats
+
+    found, stats = asyncio.run(run())
+    assert found == ("first", "second", None)
+    assert (stats["disk_hits"], stats["misses"]) == (1, 1)
+
+
+def test_key_normalizes_prompt():
+    key = ResponseCache.make_key("What now?")
+    assert key == ResponseCache.make_key("  what   NOW? ")
+    assert key != ResponseCache.make_key("What now?", sys_prompt="Be brief")
@@ -0,0 +1,92 @@
+import asyncio
+
+from utils.auth import SessionSigner
+from utils.chat import ChatGraph
+from utils.constants import SERVER_NAME, COLD_SEGMENT_MESSAGES
+from utils.messaging import UserMessage
+
+
+def test_repair_interrupted_mutations(tmp_path):
+    datapath = str(tmp_path / "cgraph.pkl")
+
+    async def run():
+        graph = ChatGraph(SERVER_NAME, datapath, shards=8)
+        await graph.add_user("alice", "password")
+        await graph.add_user("bob", "password")
+        await graph.add_friend("bob", "alice")
+        await graph.create_room("#room", "alice")
+        # Crash after only the first shard of each mutation committed
+        await graph._commit(("add_node", "carol", {"password": "", "chats": {SERVER_NAME: [], "carol": []}}))
+        await graph._commit(("del_node", "alice"))
+        await graph.close()
+
+        graph = ChatGraph(SERVER_NAME, datapath, shards=8)
+        await graph.close()
+        return graph
+
+    graph = asyncio.run(run())
+    assert "carol" in graph.cgraph[SERVER_NAME]["chats"]
+    assert "alice" not in graph.cgraph[SERVER_NAME]["chats"]
+    assert "alice" not in graph.cgraph["bob"]["chats"]
+    assert not graph.exists_room("#room")
+
+
+def test_revoke_sessions(tmp_path):
+    signer = SessionSigner(b"secret")
+
+    async def run():
+        graph = ChatGraph(SERVER_NAME, str(tmp_path / "cgraph.pkl"))
+        await graph.add_user("alice", "password")
+        token = signer.sign("alice", graph.session_key("alice"))
+        verified = [signer.verify("alice", token, graph.session_key("alice"))]
+        await graph.revoke_sessions("alice")
+        verified.append(signer.verify("alice", token, graph.session_key("alice")))
+        # Tokens of a deleted user don't log in whoever registers their name next
+        token = signer.sign("alice", graph.session_key("alice"))
+        await graph.del_user("alice")
+        await graph.add_user("alice", "password")
+        verified.append(signer.verify("alice", token, graph.session_key("alice")))
+        await graph.close()
+        return verified
+
+    assert asyncio.run(run()) == [True, False, False]
+
+
+def test_tier_writes_segments_off_the_loop(tmp_path):
+    async def run():
+        graph = ChatGraph(SERVER_NAME, str(tmp_path / "cgraph.pkl"), hot_messages=10)
+        await graph.add_user("alice", "password")
+        await graph.add_user("bob", "password")
+        await graph.add_friend("alice", "bob")
+        await graph.add_friend("bob", "alice")
+        chats = graph.cgraph["alice"]["chats"]["bob"]
+        await graph.log_msgs([UserMessage("alice", "bob", f"hello {i}") for i in range(COLD_SEGMENT_MESSAGES + 10)])
+        graph.dump()
+        # The chat keeps its messages in memory until the segment is written
+        offsets = [chats.offset]
+        await graph.close()
+        offsets.append(chats.offset)
+        return offsets, [msg.content for msg in chats[:2]]
+
+    offsets, contents = asyncio.run(run())
+    assert offsets == [0, COLD_SEGMENT_MESSAGES]
+    assert contents == ["hello 0", "hello 1"]
+
+
+def test_del_user_in_rooms(tmp_path):
+    async def run():
+        graph = ChatGraph(SERVER_NAME, str(tmp_path / "cgraph.pkl"))
+        for username in ("alice", "bob"):
+            await graph.add_user(username, "password")
+        await graph.create_room("#shared", "alice")
+        await graph.join_room("#shared", "bob")
+        await graph.create_room("#alone", "alice")
+        deleted = await graph.del_user("alice")
+        await graph.close()
+        return graph, deleted
+
+    graph, deleted = asyncio.run(run())
+    assert deleted and not graph.exists_user("alice")
+    assert graph.get_room_members("#shared") == {"bob"}
+    assert not graph.exists_room("#alone")
+    assert "alice" not in graph.user_rooms
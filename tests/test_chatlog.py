@@ -0,0 +1,43 @@
+from utils.chatlog import ChatLog
+from utils.constants import SERVER_NAME
+from utils.messaging import RoomRequest, ServerMessage, UserMessage
+
+
+def _msgs():
+    msgs = []
+    for i in range(10):
+        if i == 4:
+            msg = ServerMessage(SERVER_NAME, "bob", f"m{i}", 0, metadata={"n": i})
+        elif i == 7:
+            # Kept as an object rather than in columns
+            msg = RoomRequest("alice", SERVER_NAME, "join", f"m{i}")
+        else:
+            msg = UserMessage("alice", "bob", f"m{i}")
+        msg.seq = i
+        msgs.append(msg)
+    return msgs
+
+
+def _name(msg) -> str:
+    return msg.room if isinstance(msg, RoomRequest) else msg.content
+
+
+def test_slices_across_hot_and_cold_segments(tmp_path):
+    msgs = _msgs()
+    log = ChatLog(msgs)
+    log.seal(3, str(tmp_path / "0.seg"))
+    log.seal(3, str(tmp_path / "1.seg"))
+    # Two cold segments of three messages each, four messages in memory
+    assert (log.offset, len(log)) == (6, 10)
+
+    expected = [_name(msg) for msg in msgs]
+    assert [_name(msg) for msg in log] == expected
+    for start in range(11):
+        for stop in range(start, 11):
+            assert [_name(msg) for msg in log[start:stop]] == expected[start:stop]
+    assert [_name(msg) for msg in log[1::3]] == expected[1::3]
+    assert _name(log[-1]) == "m9"
+    assert log[4].metadata == {"n": 4}
+    assert [msg.seq for msg in log[2:8]] == list(range(2, 8))
+    assert list(log.contents(5)) == [(5, "m5"), (6, "m6"), (7, None), (8, "m8"), (9, "m9")]
+    assert log.micros(2) <= log.micros(8)
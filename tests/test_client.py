@@ -0,0 +1,66 @@
+import asyncio
+
+from client import ChatClient
+from utils.chat import ChatGraph
+from utils.messaging import UserMessage, encode_frame
+
+
+def test_dispatch_survives_failing_message():
+    client = ChatClient()
+    handled = []
+    disconnects = []
+
+    async def handle_incoming(msg):
+        if msg.content == "bad":
+            raise KeyError("metadata")
+        handled.append(msg.content)
+
+    client.handle_incoming = handle_incoming
+    client.disconnected = lambda: disconnects.append(True)
+    client.schedule_redraw = lambda: None
+
+    inbox = asyncio.Queue()
+    for msg in (UserMessage("alice", "bob", "bad"), UserMessage("alice", "bob", "good"), None):
+        inbox.put_nowait(msg)
+    client.evl.run_until_complete(asyncio.wait_for(client.dispatch_loop(inbox), 1))
+    assert handled == ["good"]
+    assert disconnects == [True]
+
+
+def test_undecodable_frame_disconnects():
+    client = ChatClient()
+
+    async def run():
+        inbox = asyncio.Queue()
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"\x00\x00\x00\x02\xff\xff")
+        await asyncio.wait_for(client.receive_loop(reader, inbox), 1)
+        return inbox.get_nowait()
+
+    assert client.evl.run_until_complete(run()) is None
+
+
+def test_chat_shows_own_unsynced_messages(tmp_path):
+    client = ChatClient()
+    client.app_state.username = "alice"
+    client.app_state.recipient = "bob"
+    client.app_state.chat_graph = ChatGraph("alice", str(tmp_path / "cgraph.pkl"))
+    client.evl.run_until_complete(client.app_state.chat_graph.add_user("bob"))
+    client.outbox.append(UserMessage("alice", "bob", "hi bob", 1))
+    client.outbox.append(UserMessage("alice", "carol", "hi carol", 2))
+    contents = [msg.content for msg in client._chat_msgs()]
+    client.evl.run_until_complete(client.app_state.chat_graph.close())
+    assert contents == ["hi bob"]
+
+
+def test_refuses_pickle_frames():
+    client = ChatClient()
+
+    async def run():
+        inbox = asyncio.Queue()
+        reader = asyncio.StreamReader()
+        reader.feed_data(encode_frame(UserMessage("alice", "bob", "hello"), "pickle"))
+        await asyncio.wait_for(client.receive_loop(reader, inbox), 1)
+        return inbox.get_nowait()
+
+    assert client.evl.run_until_complete(run()) is None
@@ -0,0 +1,58 @@
+from utils.codec import BinaryCodec, MAGIC, MESSAGE_TYPES
+from utils.constants import SERVER_NAME
+from utils.messaging import (
+    HistoryRequest,
+    LoginRequest,
+    LogoutRequest,
+    MessageBatch,
+    RegisterRequest,
+    ResumeRequest,
+    RoomRequest,
+    SearchRequest,
+    ServerMessage,
+    UserMessage,
+)
+
+
+def test_user_message_client_id():
+    msg = BinaryCodec.decode(BinaryCodec.encode(UserMessage("alice", "bob", "hello", 7)))
+    assert (msg.content, msg.client_id) == ("hello", 7)
+
+
+def test_decode_version_1_frame():
+    # Version 1 frames end user messages at their content
+    frame = BinaryCodec.encode(UserMessage("alice", "bob", "hello"))
+    msg = BinaryCodec.decode(bytes((MAGIC, 1)) + frame[2:-1])
+    assert (msg.sender, msg.content, msg.client_id) == ("alice", "hello", None)
+
+
+def _fields(msg) -> dict:
+    names = [name for cls in type(msg).__mro__ for name in getattr(cls, "__slots__", ())]
+    return {name: getattr(msg, name) for name in names}
+
+
+def test_round_trip_every_message_type():
+    user_msg = UserMessage("alice", "bob", "hello", 3)
+    user_msg.seq = 12
+    msgs = [
+        RegisterRequest("alice", SERVER_NAME, "pw"),
+        LoginRequest("alice", SERVER_NAME, "pw", {("alice", "bob"): 4}),
+        user_msg,
+        ServerMessage(SERVER_NAME, "alice", "ok", 0, "session", {"friends": ["bob"], "online": {"bob"}}),
+        HistoryRequest("alice", SERVER_NAME, "bob", {("alice", "bob"): 50}, 20),
+        RoomRequest("alice", SERVER_NAME, "join", "#room"),
+        MessageBatch(SERVER_NAME, "alice", [UserMessage("bob", "alice", "hi"), UserMessage("bob", "alice", "ünïcode")]),
+        ResumeRequest("alice", SERVER_NAME, "token", None),
+        SearchRequest("alice", SERVER_NAME, "hello", None, 20, 10),
+        LogoutRequest("alice", SERVER_NAME),
+    ]
+    assert {type(msg).__name__ for msg in msgs} == set(MESSAGE_TYPES)
+    for msg in msgs:
+        decoded = BinaryCodec.decode(BinaryCodec.encode(msg))
+        assert type(decoded) is type(msg)
+        fields = _fields(decoded)
+        if isinstance(msg, MessageBatch):
+            assert [_fields(m) for m in fields.pop("messages")] == [_fields(m) for m in msg.messages]
+            assert fields == {k: v for k, v in _fields(msg).items() if k != "messages"}
+        else:
+            assert fields == _fields(msg)
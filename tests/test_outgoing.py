@@ -0,0 +1,47 @@
+import asyncio
+
+from utils.messaging import UserMessage
+from utils.outgoing import OutgoingManager
+from utils.storage import read_records
+
+
+def test_ack_after_overflow_keeps_newer_messages():
+    async def run():
+        manager = OutgoingManager(max_per_user=2)
+        for content in ("m0", "m1"):
+            await manager.put(UserMessage("alice", "bob", content))
+        head, batch = await manager.get_batch("bob", 2)
+        # A full drop-oldest queue drops a peeked message while the batch is being sent
+        await manager.put(UserMessage("alice", "bob", "m2"))
+        await manager.ack("bob", head + len(batch))
+        return [msg.content for msg in manager.outgoing_msgs["bob"]]
+
+    assert asyncio.run(run()) == ["m2"]
+
+
+def test_persisted_queue(tmp_path):
+    async def run():
+        manager = OutgoingManager(str(tmp_path))
+        for content in ("m0", "m1", "m2"):
+            await manager.put(UserMessage("alice", "bob", content))
+        head, batch = await manager.get_batch("bob", 2)
+        await manager.ack("bob", head + len(batch))
+        await manager.close()
+        return [msg.content for msg in OutgoingManager(str(tmp_path)).outgoing_msgs["bob"]]
+
+    assert asyncio.run(run()) == ["m2"]
+
+
+def test_queue_writes_are_committed_off_the_loop(tmp_path):
+    async def run():
+        manager = OutgoingManager(str(tmp_path), durability="batched")
+        await manager.put(UserMessage("alice", "bob", "m0"))
+        # put returns once the record is on disk
+        committed = [arg.content for _, arg in read_records(manager._path("bob"))]
+        manager_async = OutgoingManager(str(tmp_path / "async"), durability="async")
+        await manager_async.put(UserMessage("alice", "bob", "m1"))
+        await manager_async.close()
+        await manager.close()
+        return committed, [msg.content for msg in OutgoingManager(str(tmp_path / "async")).outgoing_msgs["bob"]]
+
+    assert asyncio.run(run()) == (["m0"], ["m1"])
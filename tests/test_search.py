@@ -0,0 +1,25 @@
+from utils.messaging import UserMessage
+from utils.search import SearchIndex, tokenize
+
+
+def message(content: str, seq: int) -> UserMessage:
+    msg = UserMessage("alice", "bob", content)
+    msg.seq = seq
+    return msg
+
+
+def test_drop_then_query():
+    index = SearchIndex()
+    index.add(("alice", "bob"), message("hello big world", 0))
+    index.add(("bob", "alice"), message("hello", 0))
+    index.drop([("alice", "bob")])
+    assert index.messages == 1
+    assert set(index.query(tokenize("hello world"), [("bob", "alice")])) == {(("bob", "alice"), 0)}
+
+
+def test_save_and_load(tmp_path):
+    index = SearchIndex()
+    index.add(("alice", "bob"), message("hello world", 0))
+    index.save(str(tmp_path / "search.pkl"))
+    loaded = SearchIndex.load(str(tmp_path / "search.pkl"))
+    assert (loaded.messages, loaded.counts) == (1, {("alice", "bob"): 1})
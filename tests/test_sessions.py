@@ -0,0 +1,14 @@
+from utils.sessions import SessionTokens
+
+
+def test_check_does_not_redeem():
+    tokens = SessionTokens()
+    token = tokens.issue("alice")
+    # Live sessions can't be resumed
+    assert not tokens.check("alice", token)
+    tokens.suspend(token, 3)
+    assert not tokens.check("bob", token)
+    assert tokens.check("alice", token)
+    assert tokens.check("alice", token)
+    assert tokens.redeem("alice", token) == {"received": 3}
+    assert not tokens.check("alice", token)
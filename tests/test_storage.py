@@ -0,0 +1,47 @@
+import asyncio
+
+from utils.storage import MessageLog, encode_record, read_records
+
+
+def test_replay_after_reopen(tmp_path):
+    async def run():
+        wal = MessageLog(str(tmp_path), segment_size=64)
+        for i in range(10):
+            await wal.append(("add", i))
+        await wal.close()
+        # Small segments roll over, replay still yields every record in order
+        assert len(wal.segments()) > 1
+        return list(MessageLog(str(tmp_path)).replay())
+
+    assert asyncio.run(run()) == [("add", i) for i in range(10)]
+
+
+def test_torn_tail_is_ignored(tmp_path):
+    path = str(tmp_path / "log")
+    with open(path, "wb") as f:
+        f.write(encode_record("first") + encode_record("second"))
+        # A crash left half of a record behind
+        f.write(encode_record("third")[:-3])
+    assert list(read_records(path)) == ["first", "second"]
+
+    # A corrupt record ends the log too
+    record = bytearray(encode_record("fourth"))
+    record[-1] ^= 0xFF
+    with open(path, "wb") as f:
+        f.write(encode_record("first") + bytes(record) + encode_record("fifth"))
+    assert list(read_records(path)) == ["first"]
+
+
+def test_appends_after_torn_tail_start_a_new_segment(tmp_path):
+    async def run():
+        wal = MessageLog(str(tmp_path))
+        await wal.append("first")
+        await wal.close()
+        with open(wal._segment_path(wal.segments()[-1]), "ab") as f:
+            f.write(encode_record("torn")[:-1])
+        wal = MessageLog(str(tmp_path))
+        await wal.append("second")
+        await wal.close()
+        return list(MessageLog(str(tmp_path)).replay())
+
+    assert asyncio.run(run()) == ["first", "second"]
@@ -0,0 +1,24 @@
+import asyncio
+import gc
+import logging
+
+from utils.tasks import spawn
+
+
+def test_spawn_holds_and_logs(caplog):
+    tasks = set()
+
+    async def fail():
+        await asyncio.sleep(0)
+        raise ValueError("boom")
+
+    async def run():
+        spawn(fail(), tasks, logging.getLogger("test"))
+        gc.collect()
+        held = len(tasks)
+        await asyncio.sleep(0.01)
+        return held
+
+    assert asyncio.run(run()) == 1
+    assert not tasks
+    assert "fail failed" in caplog.text
@@ -0,0 +1,118 @@
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import time
+
+from utils.constants import SCRYPT_PARAMS, AUTH_WORKERS, SESSION_TOKEN_TTL
+
+
+# Password hashes are slow on purpose, so they run off the event loop
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="auth")
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=2 * 128 * r * n, dklen=32)
+
+
+def _hash(password: str) -> str:
+    salt = os.urandom(16)
+    key = _scrypt(password, salt, **SCRYPT_PARAMS)
+    b64 = lambda data: base64.b64encode(data).decode()
+    return f"scrypt${SCRYPT_PARAMS['n']}${SCRYPT_PARAMS['r']}${SCRYPT_PARAMS['p']}${b64(salt)}${b64(key)}"
+
+
+def _check(password: str, stored: str) -> bool:
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    _, n, r, p, salt, key = stored.split("$")
+    return hmac.compare_digest(_scrypt(password, base64.b64decode(salt), int(n), int(r), int(p)), base64.b64decode(key))
+
+
+def is_hashed(stored: str) -> bool:
+    """Whether a stored password is hashed, rather than plaintext from graphs saved before hashing"""
+    return stored.startswith("scrypt$")
+
+
+async def hash_password(password: str) -> str:
+    """Salted scrypt hash of a password, with its parameters"""
+    return await asyncio.get_running_loop().run_in_executor(_executor, _hash, password)
+
+
+async def check_password(password: str, stored: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(_executor, _check, password, stored)
+
+
+def load_secret(path: str) -> bytes:
+    """Secret key kept at path, created on first use"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, "wb") as f:
+            f.write(os.urandom(32))
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class SessionSigner:
+    """Signed session tokens, logging their user in until they expire
+
+    Tokens carry their expiry time and an HMAC of it, the username and the
+    user's session key, so any process holding the secret can check them
+    without storing them. Changing the session key revokes all tokens
+    signed with the old one.
+    """
+
+    def __init__(self, secret: bytes, ttl: float = SESSION_TOKEN_TTL):
+        self.secret = secret
+        self.ttl = ttl
+
+    def _sign(self, username: str, key: str, expiry: int) -> str:
+        return hmac.new(self.secret, f"{username}\n{key}\n{expiry}".encode(), hashlib.sha256).hexdigest()
+
+    def sign(self, username: str, key: str) -> str:
+        expiry = int(time.time() + self.ttl)
+        return f"{expiry}.{self._sign(username, key, expiry)}"
+
+    def verify(self, username: str, token: str, key: str) -> bool:
+        expiry, _, signature = token.partition(".")
+        if (not expiry.isdigit()) or (int(expiry) < time.time()):
+            return False
+        return hmac.compare_digest(signature, self._sign(username, key, int(expiry)))
+
+
+class LoginStats:
+    """Counts and latencies of logins by kind"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.attempts = collections.Counter()
+        self.failures = collections.Counter()
+        self.latency = collections.defaultdict(float)  # kind -> total seconds
+        self.max_latency = collections.defaultdict(float)
+
+    def record(self, kind: str, success: bool, seconds: float) -> None:
+        self.attempts[kind] += 1
+        if not success:
+            self.failures[kind] += 1
+        self.latency[kind] += seconds
+        self.max_latency[kind] = max(self.max_latency[kind], seconds)
+
+    def stats(self) -> dict:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return {
+            kind: {
+                "attempts": attempts,
+                "failures": self.failures[kind],
+                "per_second": attempts / elapsed,
+                "avg_latency_ms": 1000 * self.latency[kind] / attempts,
+                "max_latency_ms": 1000 * self.max_latency[kind],
+            }
+            for kind, attempts in sorted(self.attempts.items())
+        }
@@ -0,0 +1,103 @@
+import abc
+import asyncio
+
+from utils.sessions import SessionTokens
+
+
+class Broker(abc.ABC):
+    """Base class for brokers of presence and delivery between server nodes
+
+    Every node announces the users connected to it and is told where all
+    other online users are through on_presence(username, node), with node
+    None once they go offline. Messages for users on another node are
+    handed over with deliver() and arrive there through on_deliver(msg,
+    recipient).
+    """
+
+    def __init__(self):
+        self.node = None
+        self.on_deliver = None
+        self.on_presence = None
+
+    async def connect(self, node, on_deliver, on_presence):
+        self.node = node
+        self.on_deliver = on_deliver
+        self.on_presence = on_presence
+
+    @abc.abstractmethod
+    async def register(self, username) -> bool:
+        """Announce a user connected to this node, False if they are online on any node already"""
+
+    @abc.abstractmethod
+    async def unregister(self, username) -> None:
+        """Announce a user left this node"""
+
+    @abc.abstractmethod
+    async def deliver(self, node, recipient, msg) -> bool:
+        """Hand a message over to the node holding its recipient, False if that node is gone"""
+
+    @abc.abstractmethod
+    async def issue_token(self, username) -> str:
+        """Resume token for a new session of a user"""
+
+    @abc.abstractmethod
+    async def suspend_token(self, token, received) -> None:
+        """Make a session resumable once its connection dropped"""
+
+    @abc.abstractmethod
+    async def check_token(self, username, token) -> bool:
+        """Whether a session can be resumed with a token, without redeeming it"""
+
+    @abc.abstractmethod
+    async def redeem_token(self, username, token) -> dict | None:
+        """State of a session to resume, None if it can't be resumed"""
+
+    @abc.abstractmethod
+    async def wait_closed(self):
+        """Wait until the broker goes away"""
+
+    async def close(self):
+        pass
+
+
+class LocalBroker(Broker):
+    """Broker of a standalone server, the only node there is"""
+
+    def __init__(self):
+        super().__init__()
+        self.online = set()
+        self.tokens = SessionTokens()
+
+    async def register(self, username) -> bool:
+        if username in self.online:
+            return False
+        self.online.add(username)
+        self.on_presence(username, self.node)
+        return True
+
+    async def unregister(self, username) -> None:
+        if username in self.online:
+            self.online.discard(username)
+            self.on_presence(username, None)
+
+    async def deliver(self, node, recipient, msg) -> bool:
+        if node != self.node:
+            return False
+        await self.on_deliver(msg, recipient)
+        return True
+
+    async def issue_token(self, username) -> str:
+        return self.tokens.issue(username)
+
+    async def suspend_token(self, token, received) -> None:
+        self.tokens.suspend(token, received)
+
+    async def check_token(self, username, token) -> bool:
+        return self.tokens.check(username, token)
+
+    async def redeem_token(self, username, token) -> dict | None:
+        return self.tokens.redeem(username, token)
+
+    async def wait_closed(self):
+        # Nothing to lose a connection to
+        await asyncio.get_running_loop().create_future()
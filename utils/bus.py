@@ -0,0 +1,306 @@
+import asyncio
+import itertools
+import logging
+import os
+import pickle
+import struct
+
+from utils.broker import Broker
+from utils.messaging import receive_message
+from utils.sessions import SessionTokens
+from utils.tasks import spawn
+
+
+log = logging.getLogger(__name__)
+
+
+# Offline queue methods nodes may call on the hub
+OUTGOING_METHODS = ("put", "get_batch", "ack")
+
+
+def _frame(obj) -> bytes:
+    # Bus peers are processes of the same deployment on this host, so frames are pickled
+    payload = pickle.dumps(obj)
+    return struct.pack('!I', len(payload)) + payload
+
+
+class Hub:
+    """Hub of a multi-node server, serving nodes over a Unix socket
+
+    Nodes are the worker processes of one server or separate server
+    instances. The hub owns the chat graph, the offline queues, the resume
+    tokens and the routing table of which node holds each online user. Nodes send chat
+    graph mutations to the hub, which applies them in one total order and
+    streams them back to every node so that their replicas stay in sync.
+    """
+
+    def __init__(self, path: str, chat_graph, outgoing_manager):
+        self.path = path
+        self.chat_graph = chat_graph
+        self.outgoing_manager = outgoing_manager
+        self.nodes = {}  # node -> writer
+        self.routes = {}  # username -> node
+        self.tokens = SessionTokens()
+        self.server = None
+        self.replies = set()  # Tasks replying to commits once they are durable
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.chat_graph.on_attach = lambda *args: self.publish(("attach", *args))
+        self.server = await asyncio.start_unix_server(self.handle_node, self.path)
+
+    def send(self, node, obj) -> None:
+        # Write without draining so that frames keep the order they were produced in
+        writer = self.nodes.get(node)
+        if writer is not None:
+            writer.write(_frame(obj))
+
+    def publish(self, obj) -> None:
+        frame = _frame(obj)
+        for writer in self.nodes.values():
+            writer.write(frame)
+
+    def set_route(self, username, node) -> None:
+        if node is None:
+            self.routes.pop(username, None)
+        else:
+            self.routes[username] = node
+        self.publish(("presence", username, node))
+
+    async def handle_node(self, reader, writer):
+        kind, node = await receive_message(reader)
+        assert kind == "hello"
+        if node in self.nodes:
+            log.error("Node %s is already connected", node)
+            writer.close()
+            return
+        # Hand over the current state before the node sees any later update
+        self.nodes[node] = writer
+        self.send(node, ("state", self.chat_graph.cgraph, self.chat_graph.rooms, dict(self.routes)))
+        log.info("Node %s connected", node)
+
+        try:
+            while True:
+                kind, call_id, method, args = await receive_message(reader)
+                try:
+                    if method == "commit":
+                        await self.commit(node, call_id, *args)
+                        continue
+                    result = await self.handle_call(node, method, args)
+                    self.send(node, ("reply", call_id, True, result))
+                except Exception as e:
+                    self.send(node, ("reply", call_id, False, e))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.nodes[node]
+            for username in [u for u, n in self.routes.items() if n == node]:
+                self.set_route(username, None)
+            log.info("Node %s disconnected", node)
+
+    async def commit(self, node, call_id, records):
+        # Apply and publish the records in hub order, then reply once they are durable
+        applied, committed = await self.chat_graph.commit_records(records)
+        self.publish(("records", node, call_id, applied))
+
+        async def reply():
+            try:
+                await committed
+            except Exception as e:
+                self.send(node, ("reply", call_id, False, e))
+                return
+            if len(applied) < len(records):
+                error = ValueError(f"Conflicting chat graph record: {records[len(applied)][0]}")
+                self.send(node, ("reply", call_id, False, error))
+            else:
+                self.send(node, ("reply", call_id, True, None))
+
+        spawn(reply(), self.replies, log)
+
+    async def handle_call(self, node, method, args):
+        if method == "register":
+            username, = args
+            # Users can only hold a single session across all nodes
+            if username in self.routes:
+                return False
+            self.set_route(username, node)
+            return True
+        elif method == "unregister":
+            username, = args
+            if self.routes.get(username) == node:
+                self.set_route(username, None)
+            return True
+        elif method == "deliver":
+            target, recipient, msg = args
+            # Hand the message to the node holding the recipient, which queues it if they left
+            if target not in self.nodes:
+                return False
+            self.send(target, ("deliver", recipient, msg))
+            return True
+        elif method == "issue_token":
+            return self.tokens.issue(*args)
+        elif method == "suspend_token":
+            return self.tokens.suspend(*args)
+        elif method == "check_token":
+            return self.tokens.check(*args)
+        elif method == "redeem_token":
+            return self.tokens.redeem(*args)
+        elif method in OUTGOING_METHODS:
+            return await getattr(self.outgoing_manager, method)(*args)
+        raise ValueError(f"Unknown bus call: {method}")
+
+    async def close(self):
+        # Nodes stop serving once their connection to the hub closes
+        for writer in list(self.nodes.values()):
+            writer.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class BusClient(Broker):
+    """Node side of the bus, brokering through a hub on this host
+
+    Calls into the hub and follows its stream of chat graph records,
+    presence changes and messages handed over by other nodes.
+    """
+
+    def __init__(self, path: str, chat_graph):
+        super().__init__()
+        self.path = path
+        self.chat_graph = chat_graph
+        self.reader = None
+        self.writer = None
+        self.ids = itertools.count()
+        self.calls = {}  # call id -> future
+        self.commits = {}  # call id of own commits -> records waiting to be applied
+        self.listener = None
+        self.deliveries = set()  # Tasks delivering messages handed over by other nodes
+
+    async def connect(self, node, on_deliver, on_presence):
+        """Load the hub's state into the local replicas and start following its updates"""
+        await super().connect(node, on_deliver, on_presence)
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.writer.write(_frame(("hello", node)))
+        kind, cgraph, rooms, routes = await receive_message(self.reader)
+        assert kind == "state"
+        self.chat_graph.load_replica(cgraph, rooms)
+        self.chat_graph.replicate = self.replicate
+        for username, owner in routes.items():
+            self.on_presence(username, owner)
+        self.listener = asyncio.get_running_loop().create_task(self._listen())
+
+    def _call(self, method, *args):
+        if self.listener.done():
+            raise ConnectionError("Lost connection to the hub")
+        call_id = next(self.ids)
+        future = self.calls[call_id] = asyncio.get_running_loop().create_future()
+        self.writer.write(_frame(("call", call_id, method, args)))
+        return call_id, future
+
+    async def call(self, method, *args):
+        _, future = self._call(method, *args)
+        return await future
+
+    async def register(self, username) -> bool:
+        return await self.call("register", username)
+
+    async def unregister(self, username) -> None:
+        await self.call("unregister", username)
+
+    async def deliver(self, node, recipient, msg) -> bool:
+        return await self.call("deliver", node, recipient, msg)
+
+    async def issue_token(self, username) -> str:
+        return await self.call("issue_token", username)
+
+    async def suspend_token(self, token, received) -> None:
+        await self.call("suspend_token", token, received)
+
+    async def check_token(self, username, token) -> bool:
+        return await self.call("check_token", username, token)
+
+    async def redeem_token(self, username, token) -> dict | None:
+        return await self.call("redeem_token", username, token)
+
+    def replicate(self, records) -> asyncio.Future:
+        """Send chat graph records to the hub, applying them locally once it has ordered them"""
+        call_id, future = self._call("commit", records)
+        self.commits[call_id] = records
+        return future
+
+    async def _listen(self):
+        try:
+            while True:
+                frame = await receive_message(self.reader)
+                kind = frame[0]
+                if kind == "records":
+                    _, node, call_id, records = frame
+                    # Apply our own records rather than the hub's copies to keep the
+                    # sequence numbers it assigned on the local message objects
+                    if node == self.node:
+                        records = self.commits.pop(call_id)[: len(records)]
+                    self.chat_graph.apply_records(records)
+                elif kind == "reply":
+                    _, call_id, ok, result = frame
+                    future = self.calls.pop(call_id)
+                    if ok:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(result)
+                elif kind == "attach":
+                    # Drop messages the hub moved to a cold segment from the local replica too
+                    _, key, offset, path, count = frame
+                    self.chat_graph.attach_segment(key, offset, path, count)
+                elif kind == "presence":
+                    _, username, node = frame
+                    self.on_presence(username, node)
+                elif kind == "deliver":
+                    _, recipient, msg = frame
+                    spawn(self.on_deliver(msg, recipient), self.deliveries, log)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            log.error("Lost connection to the hub: %s", e)
+        finally:
+            for future in self.calls.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost connection to the hub"))
+                    future.exception()  # Callers may be gone during shutdown
+            self.calls = {}
+
+    async def wait_closed(self):
+        await asyncio.shield(self.listener)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.listener is not None:
+            await asyncio.gather(self.listener, return_exceptions=True)
+
+
+class RemoteOutgoingManager:
+    """Offline queues of a node, kept by the hub"""
+
+    def __init__(self, bus: BusClient):
+        self.bus = bus
+
+    async def put(self, msg, recipient=None) -> bool:
+        return await self.bus.call("put", msg, recipient)
+
+    async def get_batch(self, username, n: int) -> tuple:
+        return tuple(await self.bus.call("get_batch", username, n))
+
+    async def ack(self, username, end: int) -> None:
+        await self.bus.call("ack", username, end)
+
+    async def get(self, username):
+        head, batch = await self.get_batch(username, 1)
+        if not batch:
+            return None
+        await self.ack(username, head + 1)
+        return batch[0]
+
+    async def close(self) -> None:
+        pass
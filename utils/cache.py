@@ -0,0 +1,98 @@
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import os
+import shelve
+import time
+
+
+class ResponseCache:
+    """LRU response cache with TTL expiry and an optional on-disk tier
+
+    The on-disk tier is a shelve, only ever used from a single thread of its
+    own so that lookups and writes don't block the event loop.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600.0, path: str | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # key -> (expiry time, response)
+
+        # On-disk tier keeps responses across restarts and beyond maxsize
+        self.disk = None
+        self.executor = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.disk = shelve.open(path)
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache")
+
+        # Metrics
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(instruction: str, sys_prompt: str = "") -> str:
+        """Key on the normalized prompt, all the backend is given"""
+        normalize = lambda text: " ".join(text.casefold().split())
+        parts = [normalize(sys_prompt), normalize(instruction)]
+        return hashlib.sha256("\x00".join(parts).encode()).hexdigest()
+
+    async def get(self, key: str) -> str | None:
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+
+        # Fall back to the on-disk tier and promote hits back into memory
+        if self.disk is not None:
+            entry = await asyncio.get_running_loop().run_in_executor(self.executor, self._disk_get, key, now)
+            if entry is not None:
+                self._insert(key, entry)
+                self.disk_hits += 1
+                return entry[1]
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, response: str) -> None:
+        entry = (time.time() + self.ttl, response)
+        self._insert(key, entry)
+        if self.disk is not None:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.disk.__setitem__, key, entry)
+
+    def _disk_get(self, key: str, now: float):
+        # Runs on the cache's thread
+        entry = self.disk.get(key)
+        if (entry is not None) and (entry[0] <= now):
+            del self.disk[key]
+            return None
+        return entry
+
+    def _insert(self, key: str, entry) -> None:
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def close(self) -> None:
+        if self.disk is not None:
+            # Let pending writes finish before closing the shelve
+            self.executor.shutdown(wait=True)
+            self.disk.close()
+            self.disk = None
@@ -1,31 +1,151 @@
 import asyncio
+import contextlib
+import datetime
+import functools
+import logging
 import os
 import pickle
+import secrets
+import shutil
+import time
+import uuid
+import zlib
 
-from utils.constants import SERVER_NAME
+from utils.auth import hash_password, check_password, is_hashed
+from utils.chatlog import ChatLog, ColdSegment
+from utils.constants import SERVER_NAME, HISTORY_MAX_PAGE_SIZE, SEARCH_PAGE_SIZE, ROOM_PREFIX, COLD_SEGMENT_MESSAGES
+from utils.metrics import metrics
+from utils.search import SearchIndex, tokenize
+from utils.storage import MessageLog, load_snapshot, write_snapshot
 
 
-class ChatGraph:
-    """Chat Graph Class"""
+log = logging.getLogger(__name__)
+
+
+def is_room(name: str | None) -> bool:
+    return (name is not None) and name.startswith(ROOM_PREFIX)
+
+
+def shard_of(name: str, shards: int) -> int:
+    """Stable shard index of a user or room name, the same across runs and processes"""
+    return zlib.crc32(name.encode()) % shards
 
-    def __init__(self, mainuser: str, datapath: str):
+
+def chat_key(msg):
+    """Key of the chat a message belongs to: a room name or a (sender, recipient) direction"""
+    return msg.recipient if is_room(msg.recipient) else (msg.sender, msg.recipient)
+
+
+class _Shard:
+    """Partition of a chat graph with its own lock, message log and snapshot file"""
+
+    def __init__(self, datapath: str | None, durability: str):
         self.datapath = datapath
         self.lock = asyncio.Lock()
+        self.log = None
+        self.records_since_dump = 0
+        self.sealing = set()  # Chat logs waiting for a cold segment to be written
+        if datapath is not None:
+            os.makedirs(os.path.dirname(datapath), exist_ok=True)
+            self.log = MessageLog(os.path.join(os.path.dirname(datapath), "log"), durability=durability)
+
+
+class ChatGraph:
+    """Chat Graph Class
+
+    The graph is split into shards by a stable hash of user and room names.
+    Every mutation record belongs to the shard of its first argument, the
+    user owning the chats or the room it changes, so shards log, snapshot
+    and compact independently. A single shard keeps the original layout of
+    one snapshot at datapath with its log next to it.
+
+    The server graph keeps the messages of every chat in a columnar
+    ChatLog, while cached user graphs hold plain lists. Whenever a shard is
+    snapshotted, messages of its chats beyond the newest hot_messages, or
+    older than hot_age seconds, move to cold segment files shared by all
+    shards. The segments are written by the shard's log off the event loop,
+    and later snapshots only hold the newest messages and references to
+    them.
+    """
+
+    def __init__(
+        self,
+        mainuser: str,
+        datapath: str,
+        compact_every: int = 10000,
+        durability: str = "immediate",
+        shards: int = 1,
+        hot_messages: int | None = None,
+        hot_age: float | None = None,
+    ):
+        assert shards >= 1, "A chat graph needs at least one shard"
+        self.datapath = datapath
         self.mainuser = mainuser
+        self.compact_every = compact_every  # Records per shard between snapshots
+        # Messages of every chat kept in memory by count and age, None keeps them all
+        self.hot_messages = hot_messages
+        self.hot_age = hot_age
+        # Chat key -> server index of the oldest message held locally
+        self.cursors = {}
+
+        # Group chats: room -> {"members": set, "messages": list}, and the
+        # reverse index username -> set of rooms
+        self.cgraph = {}
+        self.rooms = {}
+        self.user_rooms = {}
+        # Set on replicas whose mutations are ordered and applied by a hub, see utils.bus
+        self.replicate = None
+        # Set on a hub to tell replicas about chats moved to cold segments: on_attach(key, offset, path, count)
+        self.on_attach = None
+        # Full-text search index of the server graph. Its file is only written on close,
+        # so it is consumed on load and a crash rebuilds it from scratch.
+        self.index = None
+        if mainuser == SERVER_NAME:
+            self.index = SearchIndex()
+            if datapath is not None:
+                self.index = SearchIndex.load(self._index_path())
+                if os.path.exists(self._index_path()):
+                    os.remove(self._index_path())
 
-        # Load existing chat graph
-        if (datapath is not None) and os.path.exists(datapath):
-            with open(datapath, "rb") as f:
-                self.cgraph = pickle.load(f)
+        # Load existing chat graph, resharding it if the shard count changed
+        stored = self._stored_shards() if datapath is not None else shards
+        if (datapath is not None) and os.path.exists(self._shard_paths(stored)[0]):
+            self.shards = [self._load_shard(path, durability) for path in self._shard_paths(stored)]
+            if stored != shards:
+                log.warning("Resharding chat graph from %d to %d shards", stored, shards)
+                self._write_layout(shards)
+                self.shards = [_Shard(path, durability) for path in self._shard_paths(shards)]
+            # Backfill sequence numbers of messages logged before they existed, and
+            # convert chats of snapshots from before columnar storage
+            if self.mainuser == SERVER_NAME:
+                for node in self.cgraph.values():
+                    for peer, chats in node["chats"].items():
+                        if isinstance(chats, list):
+                            for seq, msg in enumerate(chats):
+                                if msg.seq is None:
+                                    msg.seq = seq
+                            node["chats"][peer] = ChatLog(chats)
+                for state in self.rooms.values():
+                    if isinstance(state["messages"], list):
+                        state["messages"] = ChatLog(state["messages"])
+            # Cached user graphs start at the oldest message held
+            else:
+                self.cursors = {key: (chats[0].seq if chats else 0) for key, chats in self._all_chats()}
+            if self.mainuser == SERVER_NAME:
+                self._repair()
+            # Move history past the hot boundary out of memory right away, then drop segments no snapshot refers to
+            for shard in self.shards:
+                if self._tier(shard):
+                    self._dump_shard(shard)
+            self._remove_cold_segments()
         # Or create a new one
         else:
-            if self.mainuser == SERVER_NAME:
-                print(f"ERROR: datapath {datapath} not found!")
-                print(f"WARNING: Creating new chat graph")
+            if (self.mainuser == SERVER_NAME) and (datapath is not None):
+                log.warning("Chat graph %s not found, creating a new one", datapath)
                 self.cgraph = {
                     SERVER_NAME: {
                         "password": "",
-                        "chats": {SERVER_NAME: []},
+                        "chats": {SERVER_NAME: self._new_chat()},
                     }
                 }
             else:
@@ -43,12 +163,137 @@ class ChatGraph:
                     }
                 }
             if datapath:
-                os.makedirs(os.path.dirname(datapath), exist_ok=True)
-                self.dump()
+                self._write_layout(shards)
+                self.shards = [_Shard(path, durability) for path in self._shard_paths(shards)]
+            else:
+                self.shards = [_Shard(None, durability) for _ in range(shards)]
+
+        # Index messages the saved index is missing
+        if self.index is not None:
+            self.index.catch_up(self._all_chats())
 
         # Run basic checks
         self._run_checks()
 
+    def _index_path(self) -> str:
+        return os.path.join(os.path.dirname(self.datapath), "search.pkl")
+
+    def _cold_dir(self) -> str:
+        return os.path.join(os.path.dirname(self.datapath), "cold")
+
+    def _shards_dir(self) -> str:
+        return os.path.join(os.path.dirname(self.datapath), "shards")
+
+    def _stored_shards(self) -> int:
+        """Shard count of the graph on disk, the original unsharded layout has none recorded"""
+        manifest = os.path.join(self._shards_dir(), "count")
+        if not os.path.exists(manifest):
+            return 1
+        with open(manifest) as f:
+            return int(f.read())
+
+    def _shard_paths(self, shards: int) -> list:
+        """Snapshot paths of all shards, each with its message log in a sibling directory"""
+        if shards == 1:
+            return [self.datapath]
+        name = os.path.basename(self.datapath)
+        return [os.path.join(self._shards_dir(), str(shards), str(i), name) for i in range(shards)]
+
+    def _load_shard(self, path: str, durability: str) -> _Shard:
+        shard = _Shard(path, durability)
+        segment, payload = load_snapshot(path)
+        # Older snapshots hold the bare cgraph without rooms
+        cgraph, rooms = (payload, {}) if isinstance(payload, dict) else payload
+        self.cgraph.update(cgraph)
+        for room, state in rooms.items():
+            self._apply(("add_room", room))
+            self.rooms[room]["messages"] = state["messages"]
+            for member in state["members"]:
+                self._apply(("join_room", room, member))
+        # Replay mutations logged after the snapshot
+        for record in shard.log.replay(start=segment):
+            self._apply(record)
+            shard.records_since_dump += 1
+        return shard
+
+    def _write_layout(self, shards: int) -> None:
+        """Write fresh snapshots of the whole graph split into shards and switch over to them"""
+        stored = self._stored_shards()
+        shards_dir = self._shards_dir()
+        if shards == 1:
+            shutil.rmtree(os.path.join(os.path.dirname(self.datapath), "log"), ignore_errors=True)
+        else:
+            shutil.rmtree(os.path.join(shards_dir, str(shards)), ignore_errors=True)
+        for i, path in enumerate(self._shard_paths(shards)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_snapshot(path, 0, pickle.dumps(self._shard_payload(i, shards)))
+
+        # Record the new shard count only once all its snapshots exist, then drop the old layout
+        manifest = os.path.join(shards_dir, "count")
+        if shards == 1:
+            if os.path.exists(manifest):
+                os.remove(manifest)
+        else:
+            with open(manifest + ".tmp", "w") as f:
+                f.write(str(shards))
+            os.replace(manifest + ".tmp", manifest)
+        if stored == shards:
+            return
+        if stored == 1:
+            if os.path.exists(self.datapath):
+                os.remove(self.datapath)
+            shutil.rmtree(os.path.join(os.path.dirname(self.datapath), "log"), ignore_errors=True)
+        else:
+            shutil.rmtree(os.path.join(shards_dir, str(stored)), ignore_errors=True)
+
+    def _shard_index(self, name: str) -> int:
+        return shard_of(name, len(self.shards))
+
+    def _shard_payload(self, index: int, shards: int):
+        """Users and rooms of a shard as a snapshot payload"""
+        cgraph = {username: node for username, node in self.cgraph.items() if shard_of(username, shards) == index}
+        rooms = {room: state for room, state in self.rooms.items() if shard_of(room, shards) == index}
+        return (cgraph, rooms)
+
+    @contextlib.asynccontextmanager
+    async def _locked(self, *names):
+        """Hold the locks of the shards of some users and rooms, or of all shards if none are given"""
+        indices = sorted({self._shard_index(name) for name in names}) if names else range(len(self.shards))
+        async with contextlib.AsyncExitStack() as stack:
+            # Always lock in shard order so that concurrent mutations cannot deadlock
+            started = time.perf_counter()
+            for i in indices:
+                await stack.enter_async_context(self.shards[i].lock)
+            metrics.observe("chat_graph.lock_wait", time.perf_counter() - started)
+            yield
+
+    def _repair(self) -> None:
+        """Finish mutations of the server graph that only partly reached the shard logs before a crash
+
+        The records of one mutation go to the logs of the shards they
+        belong to, so a crash between their commits can leave a user the
+        server hasn't added, or chats and room memberships of a deleted user.
+        """
+        records = []
+        for owner, node in self.cgraph.items():
+            records += [("del_chat", owner, peer) for peer in node["chats"] if peer not in self.cgraph]
+        for username, node in self.cgraph.items():
+            if username not in self.cgraph[SERVER_NAME]["chats"]:
+                records.append(("add_chat", SERVER_NAME, username))
+            if SERVER_NAME not in node["chats"]:
+                records.append(("add_chat", username, SERVER_NAME))
+        for room, state in self.rooms.items():
+            gone = sorted(member for member in state["members"] if member not in self.cgraph)
+            records += [("leave_room", room, member) for member in gone]
+            if gone and (len(gone) == len(state["members"])):
+                records.append(("del_room", room))
+        if not records:
+            return
+        log.warning("Repairing %d records of chat graph mutations interrupted by a crash", len(records))
+        for record in records:
+            self._apply(record)
+        self.dump()
+
     def _run_checks(self):
         """Run basic checks on cgraph"""
         # Check mainuser exists in cgraph
@@ -64,17 +309,293 @@ class ChatGraph:
             for username in self.cgraph:
                 if username != self.mainuser:
                     assert len(self.cgraph[username]["chats"]) == 1
+        # Check room members and the membership index agree
+        for room, state in self.rooms.items():
+            for member in state["members"]:
+                assert room in self.user_rooms.get(member, ()), f"{member} missing from index of {room}"
+
+    def _all_chats(self):
+        """Yield (chat key, message list) for every chat direction and room"""
+        for owner, node in self.cgraph.items():
+            for peer, chats in node["chats"].items():
+                yield (owner, peer), chats
+        for room, state in self.rooms.items():
+            yield room, state["messages"]
+
+    def _new_chat(self, msgs=()):
+        """Message list of a new chat"""
+        return ChatLog(msgs) if self.mainuser == SERVER_NAME else list(msgs)
+
+    def _messages(self, key):
+        """Message list of a chat key, None if it does not exist"""
+        if isinstance(key, str):
+            state = self.rooms.get(key)
+            return state["messages"] if state is not None else None
+        owner, peer = key
+        node = self.cgraph.get(owner)
+        return node["chats"].get(peer) if node is not None else None
+
+    def _apply(self, record):
+        """Apply a single mutation record to cgraph"""
+        op, *args = record
+        if op in ("append", "append_room"):
+            msg = args[-1]
+            chats = self.cgraph[args[0]]["chats"][args[1]] if op == "append" else self.rooms[args[0]]["messages"]
+            # Sequence numbers are assigned when first logged on the server
+            if msg.seq is None:
+                msg.seq = len(chats)
+            chats.append(msg)
+            if self.index is not None:
+                self.index.add(args[0] if op == "append_room" else (args[0], args[1]), msg)
+        elif op == "add_node":
+            username, node = args
+            self.cgraph[username] = {**node, "chats": {peer: self._new_chat(msgs) for peer, msgs in node["chats"].items()}}
+        elif op == "del_node":
+            username, = args
+            if self.index is not None:
+                self.index.drop([(username, peer) for peer in self.cgraph[username]["chats"]])
+            del self.cgraph[username]
+            self.user_rooms.pop(username, None)
+        elif op == "set_password":
+            username, password = args
+            self.cgraph[username]["password"] = password
+        elif op == "set_session_key":
+            username, key = args
+            self.cgraph[username]["session_key"] = key
+        elif op == "add_chat":
+            owner, peer = args
+            self.cgraph[owner]["chats"][peer] = self._new_chat()
+        elif op == "del_chat":
+            owner, peer = args
+            if self.index is not None:
+                self.index.drop([(owner, peer)])
+            del self.cgraph[owner]["chats"][peer]
+        elif op == "add_room":
+            room, = args
+            self.rooms[room] = {"members": set(), "messages": self._new_chat()}
+        elif op == "del_room":
+            room, = args
+            if self.index is not None:
+                self.index.drop([room])
+            for member in self.rooms.pop(room)["members"]:
+                self.user_rooms[member].discard(room)
+        elif op == "join_room":
+            room, username = args
+            self.rooms[room]["members"].add(username)
+            self.user_rooms.setdefault(username, set()).add(room)
+        elif op == "leave_room":
+            room, username = args
+            self.rooms[room]["members"].discard(username)
+            # Replayed shard logs and repairs may leave rooms after the user was deleted
+            self.user_rooms.get(username, set()).discard(room)
+        else:
+            raise ValueError(f"Unknown chat graph record: {op}")
+
+    def _commit(self, *records):
+        """Log mutation records and apply them to cgraph. Must hold the locks of their shards.
+
+        Every record goes to the log of its shard. Returns an awaitable
+        resolved once the records are durable. Await it after releasing the
+        locks so that commits of concurrent mutations can be grouped together.
+        """
+        # Replicas apply records once the hub has ordered them
+        if self.replicate is not None:
+            return self.replicate(records)
+
+        committed = {}
+        for record in records:
+            shard = self.shards[self._shard_index(record[1])]
+            if shard.log is not None:
+                committed[shard] = shard.log.append(record)
+                shard.records_since_dump += 1
+            self._apply(record)
+
+        # Compact the message log of a shard into a fresh snapshot periodically
+        for shard in committed:
+            if shard.records_since_dump >= self.compact_every:
+                self._dump_shard(shard)
+        futures = [future for future in committed.values() if future is not None]
+        return asyncio.gather(*futures) if futures else asyncio.sleep(0)
+
+    def _can_apply(self, record) -> bool:
+        """Whether a record applies cleanly to the current graph"""
+        op, *args = record
+        if op == "append":
+            node = self.cgraph.get(args[0])
+            return (node is not None) and (args[1] in node["chats"])
+        elif op in ("append_room", "del_room", "join_room"):
+            return args[0] in self.rooms
+        elif op == "leave_room":
+            return (args[0] in self.rooms) and (args[1] in self.rooms[args[0]]["members"])
+        elif op == "add_node":
+            return args[0] not in self.cgraph
+        elif op in ("del_node", "set_password", "set_session_key"):
+            return args[0] in self.cgraph
+        elif op == "add_chat":
+            return (args[0] in self.cgraph) and (args[1] not in self.cgraph[args[0]]["chats"])
+        elif op == "del_chat":
+            return (args[0] in self.cgraph) and (args[1] in self.cgraph[args[0]]["chats"])
+        elif op == "add_room":
+            return args[0] not in self.rooms
+        return False
+
+    async def commit_records(self, records):
+        """Commit records sent by a replica, stopping at the first one that conflicts with the graph
+
+        Replicas check mutations against their own copy, which may lag behind
+        concurrent mutations from other replicas. Returns the applied records
+        and an awaitable resolved once they are durable.
+        """
+        applied = []
+        committed = []
+        async with self._locked(*[record[1] for record in records]):
+            # Later records of a mutation may depend on earlier ones, so check each after applying those
+            for record in records:
+                if not self._can_apply(record):
+                    break
+                committed.append(self._commit(record))
+                applied.append(record)
+        return applied, asyncio.gather(*committed)
+
+    def apply_records(self, records):
+        """Apply records already ordered and committed by the hub to a replica"""
+        for record in records:
+            self._apply(record)
+
+    def load_replica(self, cgraph: dict, rooms: dict):
+        """Replace the graph with a copy of the hub's"""
+        self.cgraph = cgraph
+        self.rooms = {}
+        self.user_rooms = {}
+        for room, state in rooms.items():
+            self._apply(("add_room", room))
+            self.rooms[room]["messages"] = state["messages"]
+            for member in state["members"]:
+                self._apply(("join_room", room, member))
+        if self.index is not None:
+            self.index = SearchIndex()
+            self.index.catch_up(self._all_chats())
+
+    def _dump_shard(self, shard: _Shard):
+        # Write a shard snapshot to file and drop the log segments it covers
+        if shard.datapath is not None:
+            # Serializing the shard blocks the event loop, writing it happens in the log's flusher
+            with metrics.timer("chat_graph.dump"):
+                self._tier(shard)
+                index = self.shards.index(shard)
+                shard.log.snapshot(shard.datapath, self._shard_payload(index, len(self.shards)))
+            shard.records_since_dump = 0
 
     def dump(self):
-        # Write cgraph to file
-        if self.datapath is not None:
-            with open(self.datapath, "wb") as f:
-                pickle.dump(self.cgraph, f)
+        for shard in self.shards:
+            self._dump_shard(shard)
+
+    def _tier(self, shard: _Shard) -> int:
+        """Seal messages of a shard's chats past the hot boundary into cold segments, returning how many"""
+        if (shard.datapath is None) or (self.hot_messages is None and self.hot_age is None):
+            return 0
+        cutoff = None
+        if self.hot_age is not None:
+            cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=self.hot_age)
+        cgraph, rooms = self._shard_payload(self.shards.index(shard), len(self.shards))
+        chats = [((owner, peer), chats) for owner, node in cgraph.items() for peer, chats in node["chats"].items()]
+        chats += [(room, state["messages"]) for room, state in rooms.items()]
+        sealed = 0
+        for key, log in chats:
+            if not isinstance(log, ChatLog):
+                continue
+            hot = len(log) - log.offset
+            count = 0 if self.hot_messages is None else hot - self.hot_messages
+            if cutoff is not None:
+                count = max(count, log.older_than(cutoff))
+            # Leave small runs in memory rather than spread a chat over many tiny segments
+            if (count >= COLD_SEGMENT_MESSAGES) and (log not in shard.sealing):
+                os.makedirs(self._cold_dir(), exist_ok=True)
+                segment = ColdSegment(os.path.join(self._cold_dir(), f"{uuid.uuid4().hex}.cold"), count)
+                # The log's flusher writes the segment off the event loop, then the chat switches over to it.
+                # Later snapshots refer to the segment, so until one does the messages stay in the last one.
+                written = shard.log.write_file(segment.path, ColdSegment.pack(log, count))
+                if written is None:
+                    log.attach(segment)
+                else:
+                    shard.sealing.add(log)
+                    written.add_done_callback(functools.partial(self._attach, shard, key, log, segment))
+                sealed += count
+        return sealed
+
+    def _attach(self, shard: _Shard, key, chats: ChatLog, segment: ColdSegment, written: asyncio.Future) -> None:
+        shard.sealing.discard(chats)
+        if written.cancelled() or (written.exception() is not None):
+            # Keep the messages in memory, the partial segment is removed on the next load
+            log.error("Writing cold segment %s failed: %s", segment.path, None if written.cancelled() else written.exception())
+            return
+        offset = chats.offset
+        chats.attach(segment)
+        # Replicas hold the same messages, unless the chat was deleted meanwhile
+        if (self.on_attach is not None) and (self._messages(key) is chats):
+            self.on_attach(key, offset, os.path.abspath(segment.path), segment.count)
+
+    def attach_segment(self, key, offset: int, path: str, count: int) -> bool:
+        """Read messages of a replica's chat from a segment its hub wrote, dropping them from memory"""
+        chats = self._messages(key)
+        # Only switch over if the chat still holds the same messages in memory as the hub's did
+        if (not isinstance(chats, ChatLog)) or (chats.offset != offset) or (len(chats) - offset < count):
+            return False
+        chats.attach(ColdSegment(path, count))
+        return True
+
+    def _remove_cold_segments(self) -> None:
+        """Delete cold segments no chat refers to, left behind by deleted chats or a crash before a snapshot"""
+        if not os.path.isdir(self._cold_dir()):
+            return
+        used = {
+            os.path.basename(segment.path)
+            for _, chats in self._all_chats() if isinstance(chats, ChatLog)
+            for segment in chats.cold
+        }
+        for name in os.listdir(self._cold_dir()):
+            if name.endswith(".cold") and (name not in used):
+                os.remove(os.path.join(self._cold_dir(), name))
+
+    def stats(self) -> dict:
+        """Commit counters summed over the message logs of all shards"""
+        logs = [shard.log.stats() for shard in self.shards if shard.log is not None]
+        if not logs:
+            return {}
+        commits = sum(s["commits"] for s in logs)
+        return {
+            "shards": len(self.shards),
+            "durability": logs[0]["durability"],
+            "commits": commits,
+            "records": sum(s["records"] for s in logs),
+            "pending": sum(s["pending"] for s in logs),
+            "avg_batch_size": sum(s["avg_batch_size"] * s["commits"] for s in logs) / commits if commits else 0.0,
+            "max_batch_size": max(s["max_batch_size"] for s in logs),
+            "avg_commit_latency_ms": sum(s["avg_commit_latency_ms"] * s["commits"] for s in logs) / commits if commits else 0.0,
+            "max_commit_latency_ms": max(s["max_commit_latency_ms"] for s in logs),
+            **self._tier_stats(),
+        }
+
+    def _tier_stats(self) -> dict:
+        """Messages of the server graph held in memory and in cold segments"""
+        chats = [chats for _, chats in self._all_chats() if isinstance(chats, ChatLog)]
+        return {
+            "hot_messages": sum(len(log) - log.offset for log in chats),
+            "hot_bytes": sum(log.nbytes() for log in chats),
+            "cold_messages": sum(log.offset for log in chats),
+            "cold_segments": sum(len(log.cold) for log in chats),
+        }
+
+    async def close(self):
+        # Commit all pending mutations
+        await asyncio.gather(*[shard.log.close() for shard in self.shards if shard.log is not None])
+        if (self.index is not None) and (self.datapath is not None):
+            self.index.save(self._index_path())
 
     def exists_user(self, username: str) -> bool:
         return username in self.cgraph
 
-    def verify_login(self, username: str, password: str) -> bool:
+    async def verify_login(self, username: str, password: str) -> bool:
         # This function is only possible on server's graph
         if self.mainuser != SERVER_NAME:
             return False
@@ -82,26 +603,69 @@ class ChatGraph:
         if username == SERVER_NAME:
             return False
         # Verify login credentials
-        return self.exists_user(username) and self.cgraph[username]["password"] == password
+        if not self.exists_user(username):
+            return False
+        stored = self.cgraph[username]["password"]
+        if not await check_password(password, stored):
+            return False
+        # Hash plaintext passwords of graphs saved before hashing on their first login
+        if not is_hashed(stored):
+            await self.set_password(username, password)
+        return True
+
+    async def set_password(self, username: str, password: str) -> bool:
+        if (self.mainuser != SERVER_NAME) or (not self.exists_user(username)):
+            return False
+        password = await hash_password(password)
+        async with self._locked(username):
+            committed = self._commit(("set_password", username, password))
+        await committed
+        return True
+
+    def session_key(self, username: str) -> str:
+        """Key signed session tokens of a user are bound to"""
+        # Users saved before session keys have an empty one until they log out
+        return self.cgraph[username].get("session_key", "")
+
+    async def revoke_sessions(self, username: str) -> bool:
+        """Invalidate all signed session tokens of a user"""
+        if (self.mainuser != SERVER_NAME) or (not self.exists_user(username)):
+            return False
+        async with self._locked(username):
+            committed = self._commit(("set_session_key", username, secrets.token_hex(16)))
+        await committed
+        return True
+
+    def exists_room(self, room: str) -> bool:
+        return room in self.rooms
+
+    def get_room_members(self, room: str) -> set:
+        return set(self.rooms[room]["members"]) if self.exists_room(room) else set()
 
     async def add_user(self, username: str, password: str | None = None) -> bool:
-        if self.exists_user(username):
+        if self.exists_user(username) or is_room(username):
             return False
+        if (self.mainuser == SERVER_NAME) and (password is not None):
+            password = await hash_password(password)
 
-        async with self.lock:
+        async with self._locked(username, self.mainuser):
+            # The name may have been taken while hashing
+            if self.exists_user(username):
+                return False
             # Add new user
             if self.mainuser == SERVER_NAME:
-                self.cgraph[username] = {
-                    "password": password,
-                    "chats": {SERVER_NAME: [], username: []}
-                }
-                self.cgraph[SERVER_NAME]["chats"][username] = []
+                # A fresh session key so that tokens of an earlier user of the same name don't log in
+                node = {"password": password, "session_key": secrets.token_hex(16), "chats": {SERVER_NAME: [], username: []}}
+                committed = self._commit(
+                    ("add_node", username, node),
+                    ("add_chat", SERVER_NAME, username),
+                )
             else:
-                self.cgraph[username] = {"chats": {}}
-                self.cgraph[self.mainuser]["chats"][username] = []
-
-            # Write cgraph to file
-            self.dump()
+                committed = self._commit(
+                    ("add_node", username, {"chats": {}}),
+                    ("add_chat", self.mainuser, username),
+                )
+        await committed
 
         return True
 
@@ -109,20 +673,20 @@ class ChatGraph:
         if (username == self.mainuser) or (not self.exists_user(username)):
             return False
 
-        async with self.lock:
+        # Deleting a user touches the chats of everyone who added them, so lock all shards
+        async with self._locked():
             # Delete user
             if self.mainuser == SERVER_NAME:
-                for k in self.cgraph:
-                    if username in self.cgraph[k]["chats"]:
-                        del self.cgraph[k]["chats"][username]
-                del self.cgraph[username]
+                records = [("del_chat", k, username) for k in self.cgraph if username in self.cgraph[k]["chats"]]
             else:
-                if username in self.cgraph[self.mainuser]["chats"]:
-                    del self.cgraph[self.mainuser]["chats"][username]
-                del self.cgraph[username]
-
-            # Write cgraph to file
-            self.dump()
+                records = [("del_chat", self.mainuser, username)] if username in self.cgraph[self.mainuser]["chats"] else []
+            # Leave all rooms, deleting those left empty
+            for room in sorted(self.user_rooms.get(username, ())):
+                records.append(("leave_room", room, username))
+                if self.rooms[room]["members"] == {username}:
+                    records.append(("del_room", room))
+            committed = self._commit(*records, ("del_node", username))
+        await committed
 
         return True
 
@@ -132,9 +696,9 @@ class ChatGraph:
                 assert self.exists_user(username)
                 assert self.exists_user(friend)
                 assert friend not in self.cgraph[username]["chats"]
-                async with self.lock:
-                    self.cgraph[username]["chats"][friend] = []
-                    self.dump()
+                async with self._locked(username):
+                    committed = self._commit(("add_chat", username, friend))
+                await committed
                 return True
             except:
                 return False
@@ -146,16 +710,53 @@ class ChatGraph:
                 assert self.exists_user(username)
                 assert self.exists_user(friend)
                 assert friend in self.cgraph[username]["chats"]
-                async with self.lock:
-                    del self.cgraph[username]["chats"][friend]
-                    self.dump()
+                async with self._locked(username):
+                    committed = self._commit(("del_chat", username, friend))
+                await committed
                 return True
             except:
                 return False
         else:
             return False
 
+    async def create_room(self, room: str, username: str) -> bool:
+        # Rooms are created on the server, with the creator as first member
+        if (self.mainuser != SERVER_NAME) or (not is_room(room)) or len(room) <= len(ROOM_PREFIX):
+            return False
+        if self.exists_room(room) or (not self.exists_user(username)):
+            return False
+        async with self._locked(room):
+            committed = self._commit(("add_room", room), ("join_room", room, username))
+        await committed
+        return True
+
+    async def join_room(self, room: str, username: str) -> bool:
+        if (self.mainuser != SERVER_NAME) or (not self.exists_room(room)) or (not self.exists_user(username)):
+            return False
+        if username in self.rooms[room]["members"]:
+            return False
+        async with self._locked(room):
+            committed = self._commit(("join_room", room, username))
+        await committed
+        return True
+
+    async def leave_room(self, room: str, username: str) -> bool:
+        if (self.mainuser != SERVER_NAME) or (not self.exists_room(room)):
+            return False
+        if username not in self.rooms[room]["members"]:
+            return False
+        async with self._locked(room):
+            records = [("leave_room", room, username)]
+            if self.rooms[room]["members"] == {username}:
+                records.append(("del_room", room))
+            committed = self._commit(*records)
+        await committed
+        return True
+
     def is_msg_valid(self, msg) -> bool:
+        # Room messages need a member sender
+        if is_room(msg.recipient):
+            return self.exists_room(msg.recipient) and (msg.sender in self.rooms[msg.recipient]["members"])
         try:
             assert self.exists_user(msg.sender)
             assert self.exists_user(msg.recipient)
@@ -165,15 +766,33 @@ class ChatGraph:
         except:
             return False
 
+    @staticmethod
+    def _log_record(msg):
+        # Room messages are stored once for all members
+        if is_room(msg.recipient):
+            return ("append_room", msg.recipient, msg)
+        return ("append", msg.sender, msg.recipient, msg)
+
     async def log_msg(self, msg, check_valid=True) -> bool:
         valid = self.is_msg_valid(msg) if check_valid else True
         if valid:
-            async with self.lock:
-                self.cgraph[msg.sender]["chats"][msg.recipient].append(msg)
-                self.dump()
+            record = self._log_record(msg)
+            async with self._locked(record[1]):
+                committed = self._commit(record)
+            await committed
             return True
         return False
 
+    async def log_msgs(self, msgs, check_valid=True) -> list:
+        """Log many messages in one transaction, returning the ones logged"""
+        valid = [msg for msg in msgs if (not check_valid) or self.is_msg_valid(msg)]
+        if valid:
+            records = [self._log_record(msg) for msg in valid]
+            async with self._locked(*[record[1] for record in records]):
+                committed = self._commit(*records)
+            await committed
+        return valid
+
     def get_user_graph(self, username) -> dict:
         # Only server can generate graphs for users
         if (self.mainuser != SERVER_NAME) or (not self.exists_user(username)):
@@ -190,12 +809,220 @@ class ChatGraph:
                 }
         return user_cgraph
 
-    async def load_cgraph(self, cgraph: dict) -> bool:
+    def get_user_summary(self, username, last_n: int) -> dict:
+        """Summary of a user's graph with only the last last_n messages of every chat"""
+        return self.get_user_delta(username, {}, last_n)
+
+    def get_user_delta(self, username, last_seen: dict, last_n: int, max_delta: int = HISTORY_MAX_PAGE_SIZE) -> dict:
+        """Messages of a user's graph newer than the last seen sequence number of every chat
+
+        Chats missing from last_seen, or too far behind to catch up with
+        max_delta messages, are reset to their last last_n messages and
+        returned with a cursor to page in older ones.
+        """
+        user_cgraph = self.get_user_graph(username)
+        if user_cgraph is None:
+            return None
+
+        cursors = {}
+
+        def delta(key, chats):
+            seen = last_seen.get(key)
+            if (seen is not None) and (-1 <= seen < len(chats)) and (len(chats) - 1 - seen <= max_delta):
+                return chats[seen + 1:]
+            start = max(0, len(chats) - last_n)
+            cursors[key] = start
+            return chats[start:]
+
+        for owner, node in user_cgraph.items():
+            for peer, chats in node["chats"].items():
+                node["chats"][peer] = delta((owner, peer), chats)
+        rooms = {
+            room: {"members": sorted(self.rooms[room]["members"]), "messages": delta(room, self.rooms[room]["messages"])}
+            for room in sorted(self.user_rooms.get(username, ()))
+        }
+        return {"cgraph": user_cgraph, "rooms": rooms, "cursors": cursors}
+
+    def search(self, username, query: str, peer: str | None = None, offset: int = 0, limit: int = SEARCH_PAGE_SIZE) -> dict:
+        """Page of the messages of a user's chats matching a query, best matches first
+
+        Only searches the chat with peer if given. Returns None if the user
+        has no such chat.
+        """
+        if (self.index is None) or (not self.exists_user(username)):
+            return None
+        chats = self.cgraph[username]["chats"]
+        rooms = self.user_rooms.get(username, set())
+        if peer is None:
+            keys = [(username, p) for p in chats] + [(p, username) for p in chats if p != username] + sorted(rooms)
+        elif is_room(peer):
+            if peer not in rooms:
+                return None
+            keys = [peer]
+        else:
+            if peer not in chats:
+                return None
+            keys = [(username, peer)] + ([(peer, username)] if peer != username else [])
+
+        # Rank by score, then newest first, and only build the messages of the page
+        scores = self.index.query(tokenize(query), keys)
+        hits = sorted(scores, key=lambda hit: (scores[hit], self._micros(*hit)), reverse=True)
+        return {
+            "query": query,
+            "peer": peer,
+            "total": len(hits),
+            "offset": offset,
+            "results": [self._messages(key)[seq] for key, seq in hits[offset: offset + limit]],
+        }
+
+    def _micros(self, key, seq: int) -> int:
+        # Timestamp of a logged message without building it
+        chats = self._messages(key)
+        if isinstance(chats, ChatLog):
+            return chats.micros(seq)
+        return chats[seq].timestamp.timestamp() * 1e6
+
+    def get_room_summary(self, room: str, last_n: int) -> dict:
+        """Members, last last_n messages and cursor of a room"""
+        if not self.exists_room(room):
+            return None
+        messages = self.rooms[room]["messages"]
+        start = max(0, len(messages) - last_n)
+        return {"members": sorted(self.rooms[room]["members"]), "messages": messages[start:], "cursor": start}
+
+    def last_seen(self) -> dict:
+        """Sequence number of the newest message held locally in every chat"""
+        return {
+            key: (chats[-1].seq if chats else self.cursors.get(key, 0) - 1)
+            for key, chats in self._all_chats()
+        }
+
+    def get_history(self, username, peer, before: dict, limit: int) -> dict:
+        """Page of older messages of a room, or of both directions of the chat between username and peer"""
+        # Only server holds full histories
+        if (self.mainuser != SERVER_NAME) or (not self.exists_user(username)):
+            return None
+        if is_room(peer):
+            if username not in self.get_room_members(peer):
+                return None
+            keys = [peer]
+        elif peer not in self.cgraph[username]["chats"]:
+            return None
+        else:
+            keys = list(dict.fromkeys([(username, peer), (peer, username)]))
+
+        pages = {}
+        for key in keys:
+            chats = self._messages(key)
+            if chats is None:
+                continue
+            end = min(before.get(key, len(chats)), len(chats))
+            start = max(0, end - limit)
+            pages[key] = (start, chats[start:end])
+        return pages
+
+    async def load_cgraph(self, cgraph: dict, cursors: dict | None = None) -> bool:
         # Only users can load external cgraphs
         if self.mainuser != SERVER_NAME:
-            async with self.lock:
+            async with self._locked():
                 self.cgraph = cgraph
+                self.cursors = cursors or {}
                 self._run_checks()  # Run sanity checks
                 self.dump()
             return True
         return False
+
+    async def merge_delta(self, delta: dict) -> bool:
+        """Merge a delta from get_user_delta into the locally cached graph"""
+        # Only users can merge external cgraphs
+        if self.mainuser == SERVER_NAME:
+            return False
+
+        async with self._locked():
+            cursors = {}
+
+            def merge(key, msgs):
+                # Reset chats are replaced, others extend the cached copy
+                if key in delta["cursors"]:
+                    cursors[key] = delta["cursors"][key]
+                    return msgs
+                cursors[key] = self.cursors.get(key, 0)
+                return (self._messages(key) or []) + msgs
+
+            cgraph = delta["cgraph"]
+            for owner, node in cgraph.items():
+                for peer, msgs in node["chats"].items():
+                    node["chats"][peer] = merge((owner, peer), msgs)
+            rooms = {
+                room: {"members": set(state["members"]), "messages": merge(room, state["messages"])}
+                for room, state in delta.get("rooms", {}).items()
+            }
+            self.cgraph = cgraph
+            self.rooms = rooms
+            self.user_rooms = {}
+            for room, state in rooms.items():
+                for member in state["members"]:
+                    self.user_rooms.setdefault(member, set()).add(room)
+            self.cursors = cursors
+            self._run_checks()  # Run sanity checks
+            self.dump()
+        return True
+
+    async def load_room(self, room: str, summary: dict) -> bool:
+        """Add or refresh a room in the locally cached graph from get_room_summary"""
+        if self.mainuser == SERVER_NAME:
+            return False
+        async with self._locked(room):
+            if self.exists_room(room):
+                self._apply(("del_room", room))
+            self._apply(("add_room", room))
+            for member in summary["members"]:
+                self._apply(("join_room", room, member))
+            self.rooms[room]["messages"] = list(summary["messages"])
+            self.cursors[room] = summary["cursor"]
+            self.dump()
+        return True
+
+    async def drop_room(self, room: str) -> bool:
+        """Remove a room from the locally cached graph"""
+        if (self.mainuser == SERVER_NAME) or (not self.exists_room(room)):
+            return False
+        async with self._locked(room):
+            self._apply(("del_room", room))
+            self.cursors.pop(room, None)
+            self.dump()
+        return True
+
+    async def log_synced_msg(self, msg) -> bool:
+        """Log a message received from the server if it directly follows the cached copy of its chat"""
+        if (self.mainuser == SERVER_NAME) or (msg.seq is None):
+            return False
+        key = chat_key(msg)
+        chats = self._messages(key)
+        if chats is None:
+            return False
+
+        # Leave gaps to be filled by the next delta sync
+        last_seen = chats[-1].seq if chats else self.cursors.get(key, 0) - 1
+        if msg.seq != last_seen + 1:
+            return False
+        return await self.log_msg(msg, check_valid=False)
+
+    async def load_history(self, pages: dict) -> int:
+        # Only users can prepend older pages fetched from the server
+        if self.mainuser == SERVER_NAME:
+            return 0
+
+        count = 0
+        async with self._locked():
+            for key, (start, msgs) in pages.items():
+                chats = self._messages(key)
+                if chats is None:
+                    continue
+                # Skip messages already held locally
+                cursor = self.cursors.get(key, 0)
+                msgs = msgs[: max(0, cursor - start)]
+                chats[:0] = msgs
+                self.cursors[key] = min(start, cursor)
+                count += len(msgs)
+        return count
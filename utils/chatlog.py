@@ -0,0 +1,343 @@
+import array
+import bisect
+import collections
+import copy
+import datetime
+import mmap
+import pickle
+import struct
+import sys
+
+from utils.constants import COLD_OPEN_SEGMENTS
+from utils.messaging import UserMessage, ServerMessage
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# Kinds of stored messages, any other message is kept as an object
+USER, SERVER, OBJECT = range(3)
+
+# Typed columns of a chat log in the order they are stored in segment files
+COLUMNS = (
+    ("seqs", "q"), ("times", "q"), ("kinds", "B"), ("senders", "I"),
+    ("recipients", "I"), ("sessions", "I"), ("statuses", "b"), ("ends", "Q"),
+)
+
+# Segment header: magic tagged with the byte order of the columns, message count and metadata length
+SEGMENT_MAGIC = b"CHATSEG" + (b"L" if sys.byteorder == "little" else b"B")
+SEGMENT_HEADER = struct.Struct("=8sQQ")
+
+# Columns of recently read segments, least recently used first
+_mapped = collections.OrderedDict()
+
+
+def _micros(timestamp: datetime.datetime) -> int:
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return (timestamp - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _padded(n: int) -> int:
+    # Columns start at multiples of 8 bytes
+    return -(-n // 8) * 8
+
+
+def _build(columns, indices) -> list:
+    """Messages at some indices of a set of columns, built in one pass with the columns held in locals"""
+    names, extras, seqs, times, kinds, senders, recipients, sessions, statuses, ends, arena = columns
+    new_user, new_server = UserMessage.__new__, ServerMessage.__new__
+    msgs = []
+    for i in indices:
+        kind = kinds[i]
+        if kind == OBJECT:
+            msgs.append(copy.copy(extras[i]))
+            continue
+        msg = new_user(UserMessage) if kind == USER else new_server(ServerMessage)
+        msg.sender = names[senders[i]]
+        msg.recipient = names[recipients[i]]
+        msg.timestamp = EPOCH + datetime.timedelta(microseconds=times[i])
+        seq = seqs[i]
+        msg.seq = None if seq < 0 else seq
+        msg.content = str(arena[ends[i - 1] if i else 0: ends[i]], "utf-8")
+        if kind == USER:
+            msg.client_id = None
+        else:
+            session = sessions[i]
+            msg.session = None if session == 0 else names[session - 1]
+            msg.status = statuses[i]
+            msg.metadata = extras.get(i)
+        msgs.append(msg)
+    return msgs
+
+
+def _contents(columns, start: int, stop: int):
+    """Sequence numbers and contents of the messages from start to stop of a set of columns"""
+    _, extras, seqs, _, kinds, _, _, _, _, ends, arena = columns
+    for i in range(start, stop):
+        if kinds[i] == OBJECT:
+            msg = extras[i]
+            yield msg.seq, getattr(msg, "content", None)
+        else:
+            seq = seqs[i]
+            yield (None if seq < 0 else seq), str(arena[ends[i - 1] if i else 0: ends[i]], "utf-8")
+
+
+class ColdSegment:
+    """Immutable file holding the columns of a run of older messages of a chat
+
+    The file holds a header, the pickled names and extras, then every column
+    and the content arena as raw arrays, so that the ends column indexes the
+    contents of any message. It is memory-mapped when first read and only
+    the pages touched are loaded. Mappings are shared by all chat logs and
+    the least recently used are dropped past COLD_OPEN_SEGMENTS.
+    """
+
+    __slots__ = ("path", "count")
+
+    def __init__(self, path: str, count: int):
+        self.path = path
+        self.count = count
+
+    @staticmethod
+    def pack(log: "ChatLog", count: int) -> bytes:
+        """File contents of a segment of the oldest count messages held in memory by a chat log"""
+        meta = pickle.dumps((log.names, {i: v for i, v in log.extras.items() if i < count}))
+        out = bytearray(SEGMENT_HEADER.pack(SEGMENT_MAGIC, count, len(meta)))
+        out += meta
+        out += bytes(_padded(len(out)) - len(out))
+        for name, _ in COLUMNS:
+            data = getattr(log, name)[:count].tobytes()
+            out += data + bytes(_padded(len(data)) - len(data))
+        out += log.arena[: log.ends[count - 1]]
+        return bytes(out)
+
+    @classmethod
+    def write(cls, path: str, log: "ChatLog", count: int) -> "ColdSegment":
+        """Write the oldest count messages held in memory by a chat log, without syncing the file"""
+        with open(path, "xb") as f:
+            f.write(cls.pack(log, count))
+        return cls(path, count)
+
+    def columns(self):
+        """Names, extras, columns and arena of the segment, mapping its file if needed"""
+        columns = _mapped.pop(self.path, None)
+        if columns is None:
+            with open(self.path, "rb") as f:
+                buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            magic, count, meta_len = SEGMENT_HEADER.unpack_from(buffer)
+            if magic != SEGMENT_MAGIC:
+                raise ValueError(f"{self.path} is not a chat segment of this machine's byte order")
+            names, extras = pickle.loads(buffer[SEGMENT_HEADER.size: SEGMENT_HEADER.size + meta_len])
+            offset = _padded(SEGMENT_HEADER.size + meta_len)
+            arrays = []
+            for _, typecode in COLUMNS:
+                size = count * array.array(typecode).itemsize
+                arrays.append(buffer[offset: offset + size].cast(typecode))
+                offset += _padded(size)
+            # Dropped mappings are unmapped once no reader holds their columns any more
+            columns = (names, extras, *arrays, buffer[offset:])
+        _mapped[self.path] = columns
+        while len(_mapped) > COLD_OPEN_SEGMENTS:
+            _mapped.popitem(last=False)
+        return columns
+
+
+class ChatLog:
+    """Messages of one chat stored column by column
+
+    Behaves like a read-only list of messages that can be appended to.
+    Instead of message objects it keeps typed arrays of sequence numbers,
+    timestamps in microseconds since the epoch, kinds, ids of interned
+    sender, recipient and session names and server statuses, plus the utf-8
+    contents packed in one arena. Reading an item builds a new message
+    object, so changes to it don't reach the log. Messages other than user
+    and server messages with string contents, and metadata of server
+    messages, are rare and kept as objects.
+
+    The oldest messages can be sealed into cold segment files, leaving only
+    the newest ones in memory. Indices still count from the oldest message.
+    """
+
+    __slots__ = (
+        "names", "ids", "seqs", "times", "kinds", "senders", "recipients",
+        "sessions", "statuses", "ends", "arena", "extras", "cold", "starts", "offset",
+    )
+
+    def __init__(self, msgs=()):
+        self.names = []  # Interned names, referenced by index
+        self.ids = {}  # name -> index in names
+        self.seqs = array.array("q")  # -1 for None
+        self.times = array.array("q")
+        self.kinds = array.array("B")
+        self.senders = array.array("I")
+        self.recipients = array.array("I")
+        self.sessions = array.array("I")  # 0 for None, else index in names + 1
+        self.statuses = array.array("b")
+        self.ends = array.array("Q")  # End offset of every content in the arena
+        self.arena = bytearray()
+        self.extras = {}  # index -> message object or server message metadata
+        self.cold = []  # Segments of the oldest messages, oldest first
+        self.starts = []  # Index of the first message of every segment
+        self.offset = 0  # Messages in segments, the index of the oldest message in memory
+        self.extend(msgs)
+
+    def _id(self, name) -> int:
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def append(self, msg) -> None:
+        cls = type(msg)
+        kind = USER if cls is UserMessage else SERVER if cls is ServerMessage else OBJECT
+        if (kind != OBJECT) and not (isinstance(msg.content, str) and isinstance(msg.timestamp, datetime.datetime)):
+            kind = OBJECT
+        if (kind == SERVER) and not (isinstance(msg.status, int) and -128 <= msg.status < 128):
+            kind = OBJECT
+        if kind == OBJECT:
+            # Keep a copy so that later changes to the message don't reach the log
+            self.extras[len(self.kinds)] = copy.copy(msg)
+            self.seqs.append(-1)
+            self.times.append(0)
+            self.senders.append(0)
+            self.recipients.append(0)
+            self.sessions.append(0)
+            self.statuses.append(0)
+        else:
+            self.seqs.append(-1 if msg.seq is None else msg.seq)
+            self.times.append(_micros(msg.timestamp))
+            self.senders.append(self._id(msg.sender))
+            self.recipients.append(self._id(msg.recipient))
+            if kind == SERVER:
+                self.sessions.append(0 if msg.session is None else self._id(msg.session) + 1)
+                self.statuses.append(msg.status)
+                if msg.metadata is not None:
+                    self.extras[len(self.kinds)] = msg.metadata
+            else:
+                self.sessions.append(0)
+                self.statuses.append(0)
+            self.arena += msg.content.encode()
+        self.kinds.append(kind)
+        self.ends.append(len(self.arena))
+
+    def extend(self, msgs) -> None:
+        for msg in msgs:
+            self.append(msg)
+
+    def _columns(self):
+        return (
+            self.names, self.extras, self.seqs, self.times, self.kinds, self.senders,
+            self.recipients, self.sessions, self.statuses, self.ends, self.arena,
+        )
+
+    def _parts(self, start: int, stop: int):
+        """Yield (columns, local start, local stop) of the segments and memory holding messages start to stop"""
+        if start < self.offset:
+            k = bisect.bisect_right(self.starts, start) - 1
+            while start < min(stop, self.offset):
+                first, segment = self.starts[k], self.cold[k]
+                end = min(stop, first + segment.count)
+                yield segment.columns(), start - first, end - first
+                start = end
+                k += 1
+        if start < stop:
+            yield self._columns(), start - self.offset, stop - self.offset
+
+    def _range(self, start: int, stop: int) -> list:
+        msgs = []
+        for columns, first, end in self._parts(start, stop):
+            msgs += _build(columns, range(first, end))
+        return msgs
+
+    def contents(self, start: int = 0):
+        """Sequence numbers and contents of the messages from index start, without building messages"""
+        for columns, first, end in self._parts(start, len(self)):
+            yield from _contents(columns, first, end)
+
+    def micros(self, index: int) -> int:
+        """Timestamp of a message in microseconds since the epoch, without building it"""
+        for (_, extras, _, times, kinds, *_), i, _ in self._parts(index, index + 1):
+            if kinds[i] == OBJECT:
+                return _micros(extras[i].timestamp)
+            return times[i]
+        raise IndexError("chat log index out of range")
+
+    def __len__(self) -> int:
+        return self.offset + len(self.kinds)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            indices = range(*index.indices(len(self)))
+            if indices.step == 1:
+                return self._range(indices.start, max(indices.start, indices.stop))
+            return [self._range(i, i + 1)[0] for i in indices]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chat log index out of range")
+        return self._range(index, index + 1)[0]
+
+    def __iter__(self):
+        # Build messages in batches rather than all at once
+        for start in range(0, len(self), 1024):
+            yield from self._range(start, min(start + 1024, len(self)))
+
+    def __repr__(self):
+        return f"ChatLog({len(self)} messages)"
+
+    def nbytes(self) -> int:
+        """Approximate bytes held in memory by the columns and arena"""
+        columns = (self.seqs, self.times, self.kinds, self.senders, self.recipients, self.sessions, self.statuses, self.ends)
+        return sum(column.itemsize * len(column) for column in columns) + len(self.arena)
+
+    def older_than(self, timestamp: datetime.datetime) -> int:
+        """Number of the oldest messages in memory that are older than timestamp"""
+        cutoff = _micros(timestamp)
+        count = 0
+        for time in self.times:
+            if time >= cutoff:
+                break
+            count += 1
+        return count
+
+    def seal(self, count: int, path: str) -> ColdSegment:
+        """Move the oldest count messages in memory to a new segment file at path"""
+        assert 0 < count <= len(self.kinds), "Can only seal messages held in memory"
+        return self.attach(ColdSegment.write(path, self, count))
+
+    def attach(self, segment: ColdSegment) -> ColdSegment:
+        """Drop the oldest messages in memory, already written to a segment, and read them from it instead"""
+        count = segment.count
+        assert 0 < count <= len(self.kinds), "Can only seal messages held in memory"
+        self.cold.append(segment)
+        self.starts.append(self.offset)
+        self.offset += count
+        base = self.ends[count - 1]
+        for name, _ in COLUMNS[:-1]:
+            del getattr(self, name)[:count]
+        self.ends = array.array("Q", (end - base for end in self.ends[count:]))
+        del self.arena[:base]
+        self.extras = {i - count: v for i, v in self.extras.items() if i >= count}
+        return segment
+
+    def __getstate__(self):
+        # The name index is rebuilt on load, segments are mapped once read
+        return (self.names, self.seqs, self.times, self.kinds, self.senders, self.recipients,
+                self.sessions, self.statuses, self.ends, bytes(self.arena), self.extras,
+                [(segment.path, segment.count) for segment in self.cold])
+
+    def __setstate__(self, state):
+        # Logs pickled before cold segments have none
+        if len(state) == 11:
+            state = (*state, [])
+        (self.names, self.seqs, self.times, self.kinds, self.senders, self.recipients,
+         self.sessions, self.statuses, self.ends, arena, self.extras, cold) = state
+        self.arena = bytearray(arena)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.cold = [ColdSegment(path, count) for path, count in cold]
+        self.starts = []
+        self.offset = 0
+        for segment in self.cold:
+            self.starts.append(self.offset)
+            self.offset += segment.count
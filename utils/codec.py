@@ -0,0 +1,326 @@
+import datetime
+import functools
+import pickle
+import struct
+
+
+# Binary frames start with a magic byte that pickle payloads never start with
+MAGIC = 0xC7
+VERSION = 2
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+FLOAT = struct.Struct("!d")
+TIMESTAMP = struct.Struct("!q")  # Microseconds since the epoch
+
+# Wire type tags of message classes and their fields after the common ones. Fields
+# added after the first version carry the version they appeared in, and decode
+# as None from older frames.
+MESSAGE_TYPES = {
+    "RegisterRequest": (1, [("password", "str")]),
+    "LoginRequest": (2, [("password", "str"), ("last_seen", "value")]),
+    "UserMessage": (3, [("content", "str"), ("client_id", "optint", 2)]),
+    "ServerMessage": (
+        4,
+        [("content", "str"), ("status", "int"), ("session", "value"), ("metadata", "value")],
+    ),
+    "HistoryRequest": (5, [("peer", "str"), ("before", "value"), ("limit", "int")]),
+    "RoomRequest": (6, [("action", "str"), ("room", "str")]),
+    "MessageBatch": (7, [("messages", "value")]),
+    "ResumeRequest": (8, [("token", "str"), ("last_seen", "value")]),
+    "SearchRequest": (9, [("query", "str"), ("peer", "optstr"), ("offset", "int"), ("limit", "int")]),
+    "LogoutRequest": (10, []),
+}
+
+# Fields common to all messages. The recipient comes first so that a frame
+# body can be shared by many recipients.
+COMMON_FIELDS = [("recipient", "optstr"), ("sender", "str"), ("timestamp", "time"), ("seq", "optint")]
+
+# Tags of generically encoded values
+(
+    V_NONE, V_FALSE, V_TRUE, V_INT, V_FLOAT, V_STR, V_BYTES,
+    V_LIST, V_TUPLE, V_DICT, V_SET, V_MESSAGE, V_TIME,
+) = range(13)
+
+
+# Primitive writers
+def _varint(out: bytearray, n: int) -> None:
+    if n < 0x80:
+        out.append(n)
+        return
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _sint(out: bytearray, n: int) -> None:
+    # Zigzag encoding keeps small negative numbers short
+    _varint(out, (n << 1) if n >= 0 else ((-n << 1) - 1))
+
+
+def _str(out: bytearray, s: str) -> None:
+    data = s.encode()
+    _varint(out, len(data))
+    out += data
+
+
+def _value(out: bytearray, v) -> None:
+    if v is None:
+        out.append(V_NONE)
+    elif v is True or v is False:
+        out.append(V_TRUE if v else V_FALSE)
+    elif isinstance(v, int):
+        out.append(V_INT)
+        _sint(out, v)
+    elif isinstance(v, float):
+        out.append(V_FLOAT)
+        out += FLOAT.pack(v)
+    elif isinstance(v, str):
+        out.append(V_STR)
+        _str(out, v)
+    elif isinstance(v, (bytes, bytearray, memoryview)):
+        out.append(V_BYTES)
+        _varint(out, len(v))
+        out += v
+    elif isinstance(v, (list, tuple, set, frozenset)):
+        out.append(V_LIST if isinstance(v, list) else V_TUPLE if isinstance(v, tuple) else V_SET)
+        _varint(out, len(v))
+        for item in v:
+            _value(out, item)
+    elif isinstance(v, dict):
+        out.append(V_DICT)
+        _varint(out, len(v))
+        for key, item in v.items():
+            _value(out, key)
+            _value(out, item)
+    elif type(v).__name__ in MESSAGE_TYPES:
+        out.append(V_MESSAGE)
+        _message(out, v)
+    elif isinstance(v, datetime.datetime):
+        out.append(V_TIME)
+        _field(out, "time", v)
+    else:
+        raise TypeError(f"Cannot encode value of type {type(v).__name__}")
+
+
+def _field(out: bytearray, kind: str, v) -> None:
+    if kind == "str":
+        _str(out, v)
+    elif kind == "optstr":
+        if v is None:
+            out.append(0)
+        else:
+            data = v.encode()
+            _varint(out, len(data) + 1)
+            out += data
+    elif kind == "int":
+        _sint(out, v)
+    elif kind == "optint":
+        _varint(out, 0 if v is None else v + 1)
+    elif kind == "time":
+        out += TIMESTAMP.pack((v - EPOCH) // datetime.timedelta(microseconds=1))
+    else:
+        _value(out, v)
+
+
+def _message(out: bytearray, msg) -> None:
+    tag, fields = MESSAGE_TYPES[type(msg).__name__]
+    out.append(tag)
+    for name, kind, *_ in COMMON_FIELDS + fields:
+        _field(out, kind, getattr(msg, name, None))
+
+
+class _Reader:
+    """Cursor over a memoryview, decoding without copying the buffer"""
+
+    __slots__ = ("buf", "pos", "version")
+
+    def __init__(self, buf, pos=0, version=VERSION):
+        self.buf = memoryview(buf)
+        self.pos = pos
+        self.version = version  # Version of the frame, deciding the fields of its messages
+
+    def byte(self) -> int:
+        b = self.buf[self.pos]
+        self.pos += 1
+        return b
+
+    def varint(self) -> int:
+        b = self.buf[self.pos]
+        self.pos += 1
+        if b < 0x80:
+            return b
+        n, shift = b & 0x7F, 7
+        while True:
+            b = self.buf[self.pos]
+            self.pos += 1
+            n |= (b & 0x7F) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def sint(self) -> int:
+        n = self.varint()
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1)
+
+    def raw(self, length: int) -> memoryview:
+        if self.pos + length > len(self.buf):
+            raise ValueError("Truncated binary frame")
+        view = self.buf[self.pos: self.pos + length]
+        self.pos += length
+        return view
+
+    def str(self) -> str:
+        return str(self.raw(self.varint()), "utf-8")
+
+    def optstr(self):
+        length = self.varint()
+        return None if length == 0 else str(self.raw(length - 1), "utf-8")
+
+    def optint(self):
+        n = self.varint()
+        return None if n == 0 else n - 1
+
+    def time(self) -> datetime.datetime:
+        micros = TIMESTAMP.unpack_from(self.buf, self.pos)[0]
+        self.pos += TIMESTAMP.size
+        return EPOCH + datetime.timedelta(microseconds=micros)
+
+    def value(self):
+        tag = self.byte()
+        if tag == V_NONE:
+            return None
+        elif tag == V_FALSE:
+            return False
+        elif tag == V_TRUE:
+            return True
+        elif tag == V_INT:
+            return self.sint()
+        elif tag == V_FLOAT:
+            return FLOAT.unpack(self.raw(FLOAT.size))[0]
+        elif tag == V_STR:
+            return self.str()
+        elif tag == V_BYTES:
+            return bytes(self.raw(self.varint()))
+        elif tag in (V_LIST, V_TUPLE, V_SET):
+            items = [self.value() for _ in range(self.varint())]
+            return items if tag == V_LIST else tuple(items) if tag == V_TUPLE else set(items)
+        elif tag == V_DICT:
+            d = {}
+            for _ in range(self.varint()):
+                key = self.value()
+                d[key] = self.value()
+            return d
+        elif tag == V_MESSAGE:
+            return self.message()
+        elif tag == V_TIME:
+            return self.time()
+        raise ValueError(f"Unknown value tag {tag}")
+
+    def message(self):
+        tag = self.byte()
+        schema = _decoders(self.version).get(tag)
+        if schema is None:
+            raise ValueError(f"Unknown message type tag {tag}")
+        cls, names, readers, missing = schema
+        # Bypass __init__ since all attributes come from the wire
+        msg = cls.__new__(cls)
+        for name, read in zip(names, readers):
+            setattr(msg, name, read(self))
+        for name in missing:
+            setattr(msg, name, None)
+        return msg
+
+
+FIELD_READERS = {
+    "str": _Reader.str,
+    "optstr": _Reader.optstr,
+    "int": _Reader.sint,
+    "optint": _Reader.optint,
+    "time": _Reader.time,
+    "value": _Reader.value,
+}
+
+
+@functools.cache
+def _decoders(version: int) -> dict:
+    # Type tag -> (class, field names, field readers, fields missing from frames of a version),
+    # resolved lazily since utils.messaging imports this module
+    from utils import messaging
+
+    decoders = {}
+    for name, (tag, fields) in MESSAGE_TYPES.items():
+        fields = COMMON_FIELDS + fields
+        present, missing = [], []
+        for field, kind, *since in fields:
+            if since and since[0] > version:
+                missing.append(field)
+            else:
+                present.append((field, kind))
+        readers = [FIELD_READERS[kind] for _, kind in present]
+        decoders[tag] = (getattr(messaging, name), [n for n, _ in present], readers, missing)
+    return decoders
+
+
+class PickleCodec:
+    """Legacy codec pickling whole message objects. Only use with trusted peers."""
+
+    name = "pickle"
+
+    @staticmethod
+    def encode(msg) -> bytes:
+        return pickle.dumps(msg)
+
+    @staticmethod
+    def decode(payload):
+        return pickle.loads(payload)
+
+
+class BinaryCodec:
+    """Versioned schema-based binary codec
+
+    Frame: magic byte, version byte, message type tag, then the message's
+    fields in schema order. Strings are varint-length-prefixed utf-8,
+    integers are zigzag varints and timestamps are int64 microseconds since
+    the epoch.
+    """
+
+    name = "binary"
+
+    @staticmethod
+    def encode(msg) -> bytes:
+        out = bytearray((MAGIC, VERSION))
+        _message(out, msg)
+        return bytes(out)
+
+    @staticmethod
+    def encode_head(msg, recipient) -> bytes:
+        """Frame start up to and including the recipient field"""
+        out = bytearray((MAGIC, VERSION, MESSAGE_TYPES[type(msg).__name__][0]))
+        _field(out, "optstr", recipient)
+        return bytes(out)
+
+    @staticmethod
+    def encode_body(msg) -> bytes:
+        """Frame bytes after the recipient field, shareable by all recipients"""
+        out = bytearray()
+        for name, kind, *_ in COMMON_FIELDS[1:] + MESSAGE_TYPES[type(msg).__name__][1]:
+            _field(out, kind, getattr(msg, name, None))
+        return bytes(out)
+
+    @staticmethod
+    def decode(payload):
+        reader = _Reader(payload)
+        if reader.byte() != MAGIC:
+            raise ValueError("Not a binary frame")
+        reader.version = reader.byte()
+        if reader.version > VERSION:
+            raise ValueError(f"Unsupported binary frame version {reader.version}")
+        return reader.message()
+
+
+CODECS = {codec.name: codec for codec in (PickleCodec, BinaryCodec)}
+
+
+def detect_codec(payload) -> str:
+    """Name of the codec that produced a frame payload"""
+    return BinaryCodec.name if (len(payload) > 0 and payload[0] == MAGIC) else PickleCodec.name
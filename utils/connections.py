@@ -1,13 +1,117 @@
 import asyncio
-from utils.constants import SERVER_NAME
+import collections
+
+from utils.constants import SERVER_NAME, DEFAULT_CODEC, SEND_BUFFER_HIGH, SEND_BUFFER_LOW
+from utils.messaging import encode_frame
+
+
+class SessionWriter:
+    """Outbound side of a session, writing frames from a bounded buffer in its own task
+
+    Senders queue frames without ever waiting on the session's socket. Once
+    the bytes buffered here and in the transport reach the high watermark,
+    the session is slow and refuses frames until it drains down to the low
+    watermark, when on_drained is called.
+    """
+
+    def __init__(self, writer, codec: str = DEFAULT_CODEC, high: int = SEND_BUFFER_HIGH, low: int = SEND_BUFFER_LOW, on_drained=None):
+        assert low <= high, "The low watermark of a send buffer must not exceed its high watermark"
+        self.writer = writer
+        self.codec = codec
+        self.high = high
+        self.low = low
+        self.on_drained = on_drained
+        self.frames = collections.deque()  # Lists of buffers making up each frame
+        self.buffered = 0  # Bytes in frames
+        self.slow = False
+        self.closed = False
+        self.wakeup = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.drained.set()
+        # Let drain() in the write loop wait whenever the transport holds more than the low watermark
+        writer.transport.set_write_buffer_limits(high=low)
+        self.task = asyncio.get_running_loop().create_task(self._write_loop())
+
+    def pending(self) -> int:
+        """Bytes waiting to be sent"""
+        return self.buffered + self.writer.transport.get_write_buffer_size()
+
+    def put(self, parts, force: bool = False) -> bool:
+        """Queue the buffers of a frame, False if the session is slow or closed and refuses it
+
+        Forced frames are queued even by slow sessions, for replies the
+        session's own task waits to flush.
+        """
+        if self.closed:
+            return False
+        if not force:
+            if (not self.slow) and (self.pending() >= self.high):
+                self.slow = True
+            if self.slow:
+                return False
+        self.frames.append(parts)
+        self.buffered += sum(len(part) for part in parts)
+        self.wakeup.set()
+        return True
+
+    def send(self, msg, force: bool = False) -> bool:
+        return self.put([encode_frame(msg, self.codec)], force)
+
+    async def flush(self) -> None:
+        """Wait until the buffered bytes are down to the low watermark"""
+        while (not self.closed) and (self.pending() > self.low):
+            self.drained.clear()
+            await self.drained.wait()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.frames:
+                    parts = self.frames.popleft()
+                    self.buffered -= sum(len(part) for part in parts)
+                    self.writer.writelines(parts)
+                    await self.writer.drain()
+                    if self.pending() <= self.low:
+                        self._set_drained()
+        except (ConnectionError, RuntimeError):
+            self.stop()
+            self.writer.close()
+
+    def _set_drained(self) -> None:
+        self.drained.set()
+        if self.slow:
+            self.slow = False
+            if self.on_drained is not None:
+                self.on_drained()
+
+    def stop(self) -> None:
+        """Stop writing, dropping buffered frames"""
+        self.closed = True
+        self.frames.clear()
+        self.buffered = 0
+        self.drained.set()
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+
+    def close(self) -> None:
+        """Stop writing and close the connection, so that the session's reader ends it"""
+        self.stop()
+        self.writer.close()
 
 
 class ConnectionManager:
-    """Connection manager class"""
+    """Connection manager class
+
+    Holds the sessions of users connected to this node and a routing table
+    of the node holding every online user, kept up to date by the broker.
+    """
 
     def __init__(self):
         self.lock = asyncio.Lock()
-        self.online = {SERVER_NAME: (None, None)}
+        self.online = {SERVER_NAME: (None, None, None)}
+        self.routes = {}  # username -> node
 
         # Ensure server is online
         assert self.is_online(SERVER_NAME), f"{SERVER_NAME} must be online at launch time!"
@@ -15,10 +119,10 @@ class ConnectionManager:
     def is_online(self, username: str) -> bool:
         return username in self.online
 
-    async def login(self, username: str, reader, writer) -> bool:
+    async def login(self, username: str, reader, writer, codec: str = DEFAULT_CODEC) -> bool:
         if not self.is_online(username):
             async with self.lock:
-                self.online[username] = (reader, writer)
+                self.online[username] = (reader, writer, codec)
             return True
         else:
             return False
@@ -34,5 +138,32 @@ class ConnectionManager:
             return self.online[username][0]
 
     def get_writer(self, username: str):
+        # Session writer of the user's connection
         if self.is_online(username):
             return self.online[username][1]
+
+    def get_codec(self, username: str):
+        # Wire codec negotiated with the user's session
+        if self.is_online(username):
+            return self.online[username][2]
+
+    def send_buffers(self) -> dict:
+        """Bytes waiting in the send buffers of all sessions and how many of them are slow"""
+        sessions = [writer for _, writer, _ in self.online.values() if writer is not None]
+        pending = [session.pending() for session in sessions]
+        return {
+            "sessions": len(sessions),
+            "slow": sum(session.slow for session in sessions),
+            "pending_bytes": sum(pending),
+            "max_pending_bytes": max(pending, default=0),
+        }
+
+    def set_route(self, username: str, node) -> None:
+        if node is None:
+            self.routes.pop(username, None)
+        else:
+            self.routes[username] = node
+
+    def get_route(self, username: str):
+        # Node holding an online user, None if they are offline
+        return self.routes.get(username)
@@ -14,6 +14,63 @@ SERVER_DEFAULT_HOST: str = "localhost"
 SERVER_DEFAULT_PORT: str = 10000
 
 
+# Group chat names start with this prefix, which usernames can't
+ROOM_PREFIX: str = "#"
+
+
+# Wire constants
+DEFAULT_CODEC: str = "binary"
+
+
+# Persistence constants
+DURABILITY_MODES = ("immediate", "batched", "async")
+
+
+# Offline queue constants
+OVERFLOW_POLICIES = ("drop-oldest", "reject-sender")
+OUTGOING_BATCH_SIZE: int = 100
+
+
+# Send buffers of client sessions
+SEND_BUFFER_HIGH: int = 1024 * 1024  # Bytes buffered before a session counts as a slow consumer
+SEND_BUFFER_LOW: int = 256 * 1024  # Bytes buffered once a slow session is fed again
+SLOW_CONSUMER_POLICIES = ("spill", "drop", "disconnect")
+
+
+# History sync constants
+HISTORY_PAGE_SIZE: int = 50
+HISTORY_MAX_PAGE_SIZE: int = 500
+
+# Search result pages
+SEARCH_PAGE_SIZE: int = 20
+SEARCH_MAX_PAGE_SIZE: int = 100
+
+# Shards of the server chat graph, each with its own lock and persistence files
+CHAT_GRAPH_SHARDS: int = 8
+
+# Hot/cold tiering of chat histories: the newest messages of every chat stay in memory,
+# older ones move to immutable memory-mapped segment files when their shard is snapshotted
+CHAT_HOT_MESSAGES: int = 1000  # Messages of every chat kept in memory
+COLD_SEGMENT_MESSAGES: int = 256  # Fewest messages moved to a new segment at once
+COLD_OPEN_SEGMENTS: int = 128  # Segments kept mapped at once
+
+# Seconds a session can be resumed for after its connection dropped
+RESUME_TOKEN_TTL: float = 300.0
+
+
+# Authentication constants
+SCRYPT_PARAMS = {"n": 2**14, "r": 8, "p": 1}  # 16 MiB of memory per password hash
+AUTH_WORKERS: int = 4  # Threads hashing passwords
+SESSION_TOKEN_TTL: float = 30 * 24 * 3600.0  # Seconds a signed session token logs its user in for
+
+
+# Observability constants
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+LOG_RATE: float = 20.0  # Log records per second of each kind once the burst is used up
+LOG_BURST: int = 100
+STATS_INTERVAL: float = 60.0  # Seconds between dumps of the server's metrics
+
+
 # Status codes
 STATUS_CODES = {-1: "N/A", 0: "SUCCESS", 1: "FAILURE"}
 
@@ -25,4 +82,11 @@ class AppStates(Enum):
     REG_USER = 3
     LOGIN_START = 4
     LOGIN_USER = 5
-    LOGIN = 6
\ No newline at end of file
+    LOGIN = 6
+
+# Client constants
+CLIENT_INBOX_SIZE: int = 1000  # Received messages waiting for the UI before reading pauses
+CLIENT_SCROLLBACK: int = 1000  # Entries kept in the message view
+CLIENT_MAX_FPS: int = 30  # Screen redraws per second at most
+CLIENT_OUTBOX_SIZE: int = 1000  # Sent messages kept for replay after a reconnect
+CLIENT_RECONNECT_DELAYS = (0.5, 30.0)  # Min and max seconds between reconnect attempts
@@ -1,32 +1,179 @@
+import abc
+import asyncio
+import logging
 import os
-from openai import OpenAI
+import time
 
+from utils.metrics import metrics
+from utils.tasks import spawn
 
-class LLM:
+
+log = logging.getLogger(__name__)
+
+
+class RateLimitError(Exception):
+    """Raised when a user exceeds their LLM request rate"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded. Try again in {retry_after:.1f}s.")
+        self.retry_after = retry_after
+
+
+class LLMBackend(abc.ABC):
+    """Base class for async LLM backends"""
+
+    @abc.abstractmethod
+    async def complete(self, requests):
+        """Complete a batch of (sys_prompt, instruction) requests and return the responses in order
+
+        A response may be an exception instance if only that request failed.
+        """
+
+
+class OpenAIBackend(LLMBackend):
     """OpenAI GPT model"""
 
-    def __init__(self):
-        """Initialize the LLM"""
+    def __init__(self, model="gpt-4o"):
         # Check OpenAI API Key
         if "OPENAI_API_KEY" not in os.environ:
             raise Exception(
                 "Please export your OpenAI API key in the OPENAI_API_KEY variable before running the program."
             )
-        self.client = OpenAI()
+        from openai import AsyncOpenAI
 
-    async def query(self, instruction, sys_prompt="", **kwargs):
-        """Query the LLM with a system prompt and user instructions"""
-        # Prompt the LLM
-        response = (
-            self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": sys_prompt},
-                    {"role": "user", "content": instruction},
-                ],
-            )
-            .choices[0]
-            .message.content
+        self.client = AsyncOpenAI()
+        self.model = model
+
+    async def _complete_one(self, sys_prompt, instruction):
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": sys_prompt},
+                {"role": "user", "content": instruction},
+            ],
         )
+        return response.choices[0].message.content
+
+    async def complete(self, requests):
+        # The chat completions API has no batch endpoint, so fan out concurrently
+        return await asyncio.gather(*[self._complete_one(s, i) for s, i in requests], return_exceptions=True)
+
+
+class StubBackend(LLMBackend):
+    """Offline deterministic backend for running and load-testing without network access"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay  # Simulated model latency in seconds
 
+    async def complete(self, requests):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return [f"[stub] You said: {instruction}" for _, instruction in requests]
+
+
+LLM_BACKENDS = {"openai": OpenAIBackend, "stub": StubBackend}
+
+
+class LLM:
+    """LLM frontend with a bounded concurrency pool, per-user rate limiting and request coalescing/batching"""
+
+    def __init__(
+        self,
+        backend="openai",
+        max_concurrency=8,
+        max_batch=16,
+        batch_window=0.01,
+        rate=1.0,
+        burst=5,
+        cache=None,
+    ):
+        """Initialize the LLM"""
+        self.backend = LLM_BACKENDS[backend]() if isinstance(backend, str) else backend
+        self.cache = cache  # Optional ResponseCache in front of the backend
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+        # Per-user token buckets: username -> (tokens, last refill time)
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+
+        # In-flight requests keyed on (sys_prompt, instruction) and requests waiting for a batch
+        self.inflight = {}
+        self.pending = []
+        self.batcher = None
+        self.batches = set()  # Tasks of batches sent to the backend
+
+    def _acquire_token(self, username):
+        # Refill the user's bucket and take a token from it
+        now = time.monotonic()
+        tokens, last = self.buckets.get(username, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[username] = (tokens, now)
+            raise RateLimitError((1 - tokens) / self.rate)
+        self.buckets[username] = (tokens - 1, now)
+
+    async def query(self, instruction, sys_prompt="", username=None, **kwargs):
+        """Query the LLM with a system prompt and user instructions"""
+        # Answer repeated queries from the cache without using up the rate limit
+        if self.cache is not None:
+            cache_key = self.cache.make_key(instruction, sys_prompt)
+            response = await self.cache.get(cache_key)
+            if response is not None:
+                metrics.inc("llm.cache_hits")
+                return response
+
+        if username is not None:
+            self._acquire_token(username)
+
+        with metrics.timer("llm.latency"):
+            response = await self._query_backend(instruction, sys_prompt)
+        if self.cache is not None:
+            await self.cache.put(cache_key, response)
         return response
+
+    async def _query_backend(self, instruction, sys_prompt):
+        # Coalesce identical in-flight requests
+        key = (sys_prompt, instruction)
+        if key not in self.inflight:
+            loop = asyncio.get_running_loop()
+            self.inflight[key] = loop.create_future()
+            self.pending.append(key)
+            if self.batcher is None or self.batcher.done():
+                self.batcher = loop.create_task(self._batch_loop())
+        return await asyncio.shield(self.inflight[key])
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+
+    async def _batch_loop(self):
+        # Gather requests over a short window and dispatch them in batches
+        while self.pending:
+            await asyncio.sleep(self.batch_window)
+            while self.pending:
+                batch, self.pending = self.pending[: self.max_batch], self.pending[self.max_batch:]
+                await self.semaphore.acquire()
+                spawn(self._run_batch(batch), self.batches, log)
+
+    async def _run_batch(self, batch):
+        try:
+            responses = await self.backend.complete(batch)
+            for key, response in zip(batch, responses):
+                future = self.inflight.pop(key)
+                if isinstance(response, Exception):
+                    future.set_exception(response)
+                    future.exception()
+                else:
+                    future.set_result(response)
+        except Exception as e:
+            for key in batch:
+                future = self.inflight.pop(key, None)
+                if future is None:
+                    continue
+                future.set_exception(e)
+                future.exception()  # Coalesced waiters may all be gone
+        finally:
+            self.semaphore.release()
@@ -0,0 +1,42 @@
+import logging
+import sys
+import time
+
+from utils.constants import LOG_RATE, LOG_BURST
+
+
+class RateLimitFilter(logging.Filter):
+    """Let through bursts of up to burst records of each kind, then rate records per second
+
+    Records are of the same kind if they share their logger, level and
+    format string. The first record let through after some were dropped
+    says how many.
+    """
+
+    def __init__(self, rate: float = LOG_RATE, burst: int = LOG_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # kind -> [tokens, last refill time, suppressed records]
+
+    def filter(self, record) -> bool:
+        now = time.monotonic()
+        bucket = self.buckets.setdefault((record.name, record.levelno, record.msg), [self.burst, now, 0])
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.msg = f"{record.msg} ({bucket[2]} similar messages suppressed)"
+            bucket[2] = 0
+        return True
+
+
+def setup_logging(level="INFO", rate: float = LOG_RATE, burst: int = LOG_BURST, path: str | None = None) -> None:
+    """Log to stdout, or to a file at path, at level, rate limiting every kind of record"""
+    handler = logging.StreamHandler(sys.stdout) if path is None else logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    handler.addFilter(RateLimitFilter(rate, burst))
+    logging.basicConfig(level=level, handlers=[handler], force=True)
@@ -1,45 +1,109 @@
+import copy
 import datetime
-import pickle
 import struct
 
 from typing import Any, Optional
-from utils.constants import SERVER_NAME, SERVER_DISPLAY_NAME, STATUS_CODES
+from utils.codec import CODECS, BinaryCodec, detect_codec
+from utils.constants import SERVER_NAME, SERVER_DISPLAY_NAME, STATUS_CODES, DEFAULT_CODEC, SEARCH_PAGE_SIZE
 
 
 # Helpful transmission methods
-async def send_message(msg, writer):
+def encode_frame(msg, codec: str = DEFAULT_CODEC) -> bytes:
     # Serialize the message
-    msg = pickle.dumps(msg)
-    
-    # Create a header with the length of the message
-    header = struct.pack('!I', len(msg))
-    
-    # Write the header followed by the message
-    writer.write(header + msg)
+    msg = CODECS[codec].encode(msg)
+
+    # Prefix it with a header holding its length
+    return struct.pack('!I', len(msg)) + msg
+
+
+async def send_message(msg, writer, codec: str = DEFAULT_CODEC):
+    writer.write(encode_frame(msg, codec))
     await writer.drain()
 
 
-async def receive_message(reader):
+async def receive_message(reader, return_codec: bool = False, allowed_codecs=None):
     # Read the fixed-size header (4 bytes for int)
     header = await reader.readexactly(4)
     msg_len = struct.unpack('!I', header)[0]
-    
+
     # Read the full message based on length from header
     msg = await reader.readexactly(msg_len)
     if msg:
-        return pickle.loads(msg)
+        # Decode with whichever codec the peer used
+        codec = detect_codec(msg)
+        if (allowed_codecs is not None) and (codec not in allowed_codecs):
+            raise ValueError(f"Codec {codec} is not allowed.")
+        msg = CODECS[codec].decode(memoryview(msg))
+        return (msg, codec) if return_codec else msg
     else:
         raise ValueError("None message received likely due to a disconnect.")
 
 
+class FanoutFrame:
+    """A message encoded once and written to many recipients
+
+    With the binary codec only the small frame head holding the recipient
+    differs per recipient while the body is shared. Pickle frames can't be
+    split, so they are shared only when every recipient gets the message's
+    own recipient field (e.g. a group chat).
+    """
+
+    def __init__(self, msg, per_recipient: bool = True):
+        self.msg = msg
+        self.per_recipient = per_recipient
+        self.cache = {}  # (codec, recipient or None) -> encoded buffer
+
+    def parts(self, recipient: str, codec: str) -> list:
+        """Buffers making up the length-prefixed frame for a recipient"""
+        if codec == BinaryCodec.name:
+            body = self.cache.get((codec, None))
+            if body is None:
+                body = self.cache[(codec, None)] = BinaryCodec.encode_body(self.msg)
+            head = BinaryCodec.encode_head(self.msg, recipient if self.per_recipient else self.msg.recipient)
+            return [struct.pack('!I', len(head) + len(body)) + head, body]
+
+        key = (codec, recipient if self.per_recipient else None)
+        frame = self.cache.get(key)
+        if frame is None:
+            msg = self.msg
+            if self.per_recipient:
+                msg = copy.copy(msg)
+                msg.recipient = recipient
+            payload = CODECS[codec].encode(msg)
+            frame = self.cache[key] = struct.pack('!I', len(payload)) + payload
+        return [frame]
+
+    def write(self, writer, recipient: str, codec: str) -> None:
+        # Queue the frame without draining so that many writers can drain together
+        writer.writelines(self.parts(recipient, codec))
+
+
 # Message base class
 class Message:
-    """Message base class to be derived from"""
+    """Message base class to be derived from
+
+    Messages have slots rather than a __dict__ since the server holds many
+    of them. Subclasses declare their own fields as slots too.
+    """
+
+    # seq is the per-chat sequence number, assigned by the server when the message is logged
+    __slots__ = ("sender", "recipient", "timestamp", "seq")
 
     def __init__(self, sender: str, recipient: str):
         self.sender = sender
         self.recipient = recipient
         self.timestamp = datetime.datetime.now(datetime.timezone.utc)
+        self.seq = None
+
+    def __setstate__(self, state):
+        # Messages pickled before slots hold a __dict__, possibly without seq
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **state[1]}
+        self.seq = None
+        if isinstance(self, UserMessage):
+            self.client_id = None
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def __repr__(self):
         sdr = SERVER_DISPLAY_NAME if self.sender == SERVER_NAME else self.sender
@@ -51,6 +115,8 @@ class Message:
 class RegisterRequest(Message):
     """Message class to support new user registration"""
 
+    __slots__ = ("password",)
+
     def __init__(self, sender: str, recipient: str, password: str):
         assert recipient == SERVER_NAME
         super().__init__(sender, recipient)
@@ -63,18 +129,102 @@ class RegisterRequest(Message):
 class LoginRequest(Message):
     """Message class to support user login"""
 
-    def __init__(self, sender: str, recipient: str, password: str):
+    __slots__ = ("password", "last_seen")
+
+    def __init__(self, sender: str, recipient: str, password: str, last_seen: Optional[dict] = None):
         assert recipient == SERVER_NAME
         super().__init__(sender, recipient)
         self.password = password
+        self.last_seen = last_seen  # (owner, peer) -> seq of the newest cached message
 
     def __repr__(self):
         return super().__repr__() + ": Login Request."
 
 
+class ResumeRequest(Message):
+    """Message class to resume a session after a dropped connection"""
+
+    __slots__ = ("token", "last_seen")
+
+    def __init__(self, sender: str, recipient: str, token: str, last_seen: Optional[dict] = None):
+        assert recipient == SERVER_NAME
+        super().__init__(sender, recipient)
+        self.token = token  # Resume token issued at login
+        self.last_seen = last_seen  # (owner, peer) -> seq of the newest cached message
+
+    def __repr__(self):
+        return super().__repr__() + ": Resume Request."
+
+
+class LogoutRequest(Message):
+    """Message class to end a session and revoke its tokens"""
+
+    __slots__ = ()
+
+    def __init__(self, sender: str, recipient: str):
+        assert recipient == SERVER_NAME
+        super().__init__(sender, recipient)
+
+    def __repr__(self):
+        return super().__repr__() + ": Logout Request."
+
+
+class HistoryRequest(Message):
+    """Message class to fetch older pages of a chat history"""
+
+    __slots__ = ("peer", "before", "limit")
+
+    def __init__(self, sender: str, recipient: str, peer: str, before: dict, limit: int):
+        assert recipient == SERVER_NAME
+        super().__init__(sender, recipient)
+        self.peer = peer
+        self.before = before  # (owner, peer) -> index of the oldest message already held
+        self.limit = limit
+
+    def __repr__(self):
+        return super().__repr__() + f": History Request with {self.peer}."
+
+
+class SearchRequest(Message):
+    """Message class to search the chats of a user for keywords"""
+
+    __slots__ = ("query", "peer", "offset", "limit")
+
+    def __init__(self, sender: str, recipient: str, query: str, peer: Optional[str] = None, offset: int = 0, limit: int = SEARCH_PAGE_SIZE):
+        assert recipient == SERVER_NAME
+        super().__init__(sender, recipient)
+        self.query = query
+        self.peer = peer  # Only search the chat with this user or room
+        self.offset = offset
+        self.limit = limit
+
+    def __repr__(self):
+        return super().__repr__() + f": Search Request for {self.query}."
+
+
+class RoomRequest(Message):
+    """Message class to create, join or leave a group chat room"""
+
+    __slots__ = ("action", "room")
+
+    ACTIONS = ("create", "join", "leave")
+
+    def __init__(self, sender: str, recipient: str, action: str, room: str):
+        assert recipient == SERVER_NAME
+        assert action in self.ACTIONS
+        super().__init__(sender, recipient)
+        self.action = action
+        self.room = room
+
+    def __repr__(self):
+        return super().__repr__() + f": Room Request to {self.action} {self.room}."
+
+
 class ServerMessage(Message):
     """Message from server"""
 
+    __slots__ = ("content", "status", "session", "metadata")
+
     def __init__(
         self,
         sender: str,
@@ -102,11 +252,29 @@ class ServerMessage(Message):
         )
 
 
+class MessageBatch(Message):
+    """Many messages from server coalesced into a single frame"""
+
+    __slots__ = ("messages",)
+
+    def __init__(self, sender: str, recipient: str, messages: list):
+        assert sender == SERVER_NAME
+        super().__init__(sender, recipient)
+        self.messages = messages
+
+    def __repr__(self):
+        return super().__repr__() + f": Batch of {len(self.messages)} messages."
+
+
 class UserMessage(Message):
     """Message from a user"""
-    def __init__(self, sender: str, recipient: str, content: str):
+
+    __slots__ = ("content", "client_id")
+
+    def __init__(self, sender: str, recipient: str, content: str, client_id: Optional[int] = None):
         super().__init__(sender, recipient)
         self.content = content
+        self.client_id = client_id  # Numbers the messages a client sends, to replay them after a reconnect
 
     def __repr__(self):
         return super().__repr__() + f": {self.content}"
\ No newline at end of file
@@ -0,0 +1,117 @@
+import bisect
+import contextlib
+import json
+import os
+import time
+
+
+# Histogram bucket bounds in seconds, growing by sqrt(2) from 10 microseconds to about 100 seconds
+BUCKETS = tuple(1e-5 * 2 ** (i / 2) for i in range(47))
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n: int = 1) -> None:
+        self.value += n
+
+
+class Histogram:
+    """Distribution of durations in exponential buckets
+
+    Quantiles are read off the bucket bounds, so they are within a factor
+    of sqrt(2) of the true value, in constant memory per histogram.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": 1000 * self.total / self.count if self.count else 0.0,
+            "p50_ms": 1000 * self.quantile(0.5),
+            "p99_ms": 1000 * self.quantile(0.99),
+            "max_ms": 1000 * self.max,
+        }
+
+
+class Metrics:
+    """Counters, duration histograms and gauges of a process, by name
+
+    Gauges are functions read whenever a snapshot is taken, so components
+    only register them once and pay nothing on their hot paths.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name: str, n: int = 1) -> None:
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = Counter()
+        counter.inc(n)
+
+    def observe(self, name: str, seconds: float) -> None:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def gauge(self, name: str, read) -> None:
+        self.gauges[name] = read
+
+    def snapshot(self) -> dict:
+        return {
+            "uptime_s": time.monotonic() - self.started,
+            "counters": {name: counter.value for name, counter in sorted(self.counters.items())},
+            "gauges": {name: read() for name, read in sorted(self.gauges.items())},
+            "histograms": {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+        }
+
+    @staticmethod
+    def write(path: str, snapshot: dict) -> None:
+        """Atomically write a snapshot to path as JSON, safe to run off the event loop"""
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshot, f, indent=2, default=str)
+        os.replace(path + ".tmp", path)
+
+    def dump(self, path: str) -> dict:
+        """Atomically write a snapshot to path as JSON and return it"""
+        snapshot = self.snapshot()
+        self.write(path, snapshot)
+        return snapshot
+
+
+# Metrics of this process
+metrics = Metrics()
@@ -1,24 +1,272 @@
 import asyncio
+import collections
+import logging
+import os
+import urllib.parse
 
-from utils.constants import SERVER_NAME
+from utils.constants import DURABILITY_MODES, OVERFLOW_POLICIES
+from utils.metrics import metrics
+from utils.storage import encode_record, read_records
+
+
+log = logging.getLogger(__name__)
+
+
+QUEUE_SUFFIX = ".q"
 
 
 class OutgoingManager:
-    """Outgoing messages manager class for server"""
+    """Outgoing messages manager class for server
 
-    def __init__(self):
-        self.lock = asyncio.Lock()
-        self.outgoing_msgs = {}
+    Keeps a bounded queue of undelivered messages per recipient. Each queue
+    is backed by an append-only file of ("put", msg) and ("pop", n) records
+    so that queued messages survive restarts. Queues are locked per user.
 
-    async def put(self, msg):
-        async with self.lock:
-            if msg.recipient not in self.outgoing_msgs:
-                self.outgoing_msgs[msg.recipient] = asyncio.Queue()
-            await self.outgoing_msgs[msg.recipient].put(msg)
+    Queued messages are numbered in the order they were queued, so that
+    acknowledging a peeked batch never removes messages queued after it,
+    even if older ones were dropped in the meantime.
 
-    async def get(self, username):
-        async with self.lock:
-            if len(self.outgoing_msgs.get(username, [])) == 0:
-                return None
+    Like the chat graph's message log, file writes are committed off the
+    event loop by a flusher task, and durability picks whether callers wait
+    for each fsync ("immediate"), for a group commit ("batched") or not at
+    all ("async").
+    """
+
+    def __init__(
+        self,
+        dirpath: str | None = None,
+        max_per_user: int = 1000,
+        overflow: str = "drop-oldest",
+        durability: str = "immediate",
+        batch_window: float = 0.005,
+    ):
+        assert overflow in OVERFLOW_POLICIES, f"Unknown overflow policy: {overflow}"
+        assert durability in DURABILITY_MODES, f"Unknown durability mode: {durability}"
+        self.dirpath = dirpath
+        self.max_per_user = max_per_user
+        self.overflow = overflow
+        self.durability = durability
+        self.batch_window = batch_window
+        self.outgoing_msgs = {}  # username -> deque of messages
+        self.heads = {}  # username -> number of the oldest queued message
+        self.locks = {}  # username -> asyncio.Lock
+        self.files = {}  # username -> open queue file, only touched by _write
+        self.pops = {}  # username -> pop records since the file was last rewritten
+        # Pending (username, kind, data, future) writes and the flusher task
+        self.pending = []
+        self.wakeup = None
+        self.flusher = None
+        self.dropped = 0
+        self.rejected = 0
+
+        # Load queues persisted by a previous run
+        if self.dirpath is not None:
+            os.makedirs(self.dirpath, exist_ok=True)
+            for name in os.listdir(self.dirpath):
+                if name.endswith(QUEUE_SUFFIX):
+                    username = urllib.parse.unquote(name[: -len(QUEUE_SUFFIX)])
+                    queue = collections.deque()
+                    for op, arg in read_records(os.path.join(self.dirpath, name)):
+                        if op == "put":
+                            queue.append(arg)
+                        else:
+                            for _ in range(min(arg, len(queue))):
+                                queue.popleft()
+                    self.outgoing_msgs[username] = queue
+                    self._rewrite(username)
+
+    def _path(self, username: str) -> str:
+        return os.path.join(self.dirpath, urllib.parse.quote(username, safe="") + QUEUE_SUFFIX)
+
+    def _lock(self, username: str) -> asyncio.Lock:
+        return self.locks.setdefault(username, asyncio.Lock())
+
+    def _append(self, username: str, *records) -> asyncio.Future | None:
+        # Serialize right away so later in-memory mutations don't leak in
+        return self._enqueue(username, "append", b"".join(encode_record(r) for r in records))
+
+    def _rewrite(self, username: str) -> asyncio.Future | None:
+        """Compact a user's queue file down to its queued messages, removing it once empty"""
+        self.pops[username] = 0
+        queue = self.outgoing_msgs.get(username)
+        if not queue:
+            self.outgoing_msgs.pop(username, None)
+            return self._enqueue(username, "rewrite", None)
+        # Copy the queue now, the flusher encodes it
+        return self._enqueue(username, "rewrite", tuple(queue))
+
+    def _enqueue(self, username: str, kind: str, data) -> asyncio.Future | None:
+        """Queue a write for the flusher and return a future for its commit
+
+        Writes right away, returning None, if there is no running event loop.
+        """
+        if self.dirpath is None:
+            return None
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write([(username, kind, data)])
+            return None
+        if self.flusher is None or self.flusher.done():
+            self.wakeup = asyncio.Event()
+            self.flusher = loop.create_task(self._flush_loop())
+        future = loop.create_future()
+        self.pending.append((username, kind, data, future))
+        self.wakeup.set()
+        # Callers in async mode never wait for the commit
+        return None if self.durability == "async" else future
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+
+            # Wait for more writes to gather a group commit
+            if self.durability != "immediate":
+                await asyncio.sleep(self.batch_window)
+            if not self.pending:
+                continue
+            batch, self.pending = self.pending, []
+
+            try:
+                with metrics.timer("outgoing.write"):
+                    await loop.run_in_executor(None, self._write, [(u, kind, data) for u, kind, data, _ in batch])
+                error = None
+            except Exception as e:
+                log.error("Offline queue commit failed: %s", e)
+                error = e
+
+            for _, _, _, future in batch:
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+                    future.exception()  # Nobody may be waiting in async mode
+
+    def _write(self, items) -> None:
+        """Apply a batch of queue file writes, fsyncing every touched file once"""
+        appended = {}
+        for username, kind, data in items:
+            if kind == "sync":
+                continue
+            path = self._path(username)
+            if kind == "append":
+                f = self.files.get(username)
+                if f is None:
+                    f = self.files[username] = open(path, "ab")
+                f.write(data)
+                appended[username] = f
+                continue
+            # Rewrites start the file over, pending appends to the old one are moot
+            appended.pop(username, None)
+            f = self.files.pop(username, None)
+            if f is not None:
+                f.close()
+            if data is None:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            tmppath = path + ".tmp"
+            with open(tmppath, "wb") as f:
+                f.write(b"".join(encode_record(("put", msg)) for msg in data))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmppath, path)
+        for f in appended.values():
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def put(self, msg, recipient=None) -> bool:
+        """Queue a message, returning False if the recipient's queue is full and rejects it"""
+        # Room messages are queued per member rather than for the room
+        recipient = recipient or msg.recipient
+        async with self._lock(recipient):
+            queue = self.outgoing_msgs.setdefault(recipient, collections.deque())
+            records = []
+            if len(queue) >= self.max_per_user:
+                if self.overflow == "reject-sender":
+                    self.rejected += 1
+                    return False
+                # Drop the oldest queued message
+                queue.popleft()
+                self.heads[recipient] = self.heads.get(recipient, 0) + 1
+                records.append(("pop", 1))
+                self.dropped += 1
+            queue.append(msg)
+            records.append(("put", msg))
+            committed = self._append(recipient, *records)
+        # Wait for the commit without holding up the recipient's other operations
+        if committed is not None:
+            await committed
+        return True
+
+    async def get_batch(self, username, n: int) -> tuple:
+        """Peek at up to n of a user's oldest queued messages without removing them
+
+        Returns the number of the first message with the messages.
+        """
+        async with self._lock(username):
+            head = self.heads.get(username, 0)
+            queue = self.outgoing_msgs.get(username)
+            if not queue:
+                return head, []
+            return head, [queue[i] for i in range(min(n, len(queue)))]
+
+    async def ack(self, username, end: int) -> None:
+        """Remove a user's queued messages numbered below end once delivered"""
+        async with self._lock(username):
+            queue = self.outgoing_msgs.get(username)
+            head = self.heads.get(username, 0)
+            # Messages dropped since the batch was peeked are already gone
+            n = min(end - head, len(queue or ()))
+            if n <= 0:
+                return
+            for _ in range(n):
+                queue.popleft()
+            self.heads[username] = head + n
+            self.pops[username] = self.pops.get(username, 0) + 1
+            # Rewrite the file once it is mostly pop records or fully drained
+            if (not queue) or (self.pops[username] > max(64, len(queue))):
+                committed = self._rewrite(username)
             else:
-                return self.outgoing_msgs[username].get()
+                committed = self._append(username, ("pop", n))
+        if committed is not None:
+            await committed
+
+    async def get(self, username):
+        """Pop a user's oldest queued message"""
+        head, batch = await self.get_batch(username, 1)
+        if not batch:
+            return None
+        await self.ack(username, head + 1)
+        return batch[0]
+
+    def depth(self, username) -> int:
+        return len(self.outgoing_msgs.get(username, ()))
+
+    def stats(self) -> dict:
+        """Depths of the offline queues and counters of messages they turned away"""
+        depths = [len(queue) for queue in self.outgoing_msgs.values()]
+        return {
+            "queues": len(depths),
+            "queued": sum(depths),
+            "max_depth": max(depths, default=0),
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+        }
+
+    async def close(self) -> None:
+        """Commit all pending writes and close the queue files"""
+        if self.flusher is not None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending.append((None, "sync", None, future))
+            self.wakeup.set()
+            await future
+            self.flusher.cancel()
+            self.flusher = None
+        for f in self.files.values():
+            f.close()
+        self.files = {}
@@ -0,0 +1,105 @@
+import math
+import os
+import pickle
+import re
+
+from utils.chatlog import ChatLog
+
+
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text) -> set:
+    """Distinct casefolded words of a text"""
+    return set(TOKEN.findall(text.casefold())) if isinstance(text, str) else set()
+
+
+class SearchIndex:
+    """Inverted index of message contents
+
+    Maps every term to posting lists of the sequence numbers of the
+    messages containing it, per chat key. Messages are indexed in sequence
+    order and each chat remembers the next sequence number to index, so
+    adding a message twice is a no-op and an index saved at any point can
+    catch up with the graph it belongs to.
+    """
+
+    def __init__(self):
+        self.postings = {}  # term -> {chat key -> [seq, ...]}
+        self.df = {}  # term -> number of messages containing it
+        self.indexed = {}  # chat key -> next seq to index
+        self.counts = {}  # chat key -> number of messages indexed
+        self.messages = 0
+
+    def add(self, key, msg) -> None:
+        self.add_content(key, msg.seq, getattr(msg, "content", None))
+
+    def add_content(self, key, seq: int, content) -> None:
+        if seq < self.indexed.get(key, 0):
+            return
+        self.indexed[key] = seq + 1
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.messages += 1
+        for term in tokenize(content):
+            self.postings.setdefault(term, {}).setdefault(key, []).append(seq)
+            self.df[term] = self.df.get(term, 0) + 1
+
+    def catch_up(self, chats) -> None:
+        """Index messages of (chat key, message list) pairs added since the index was saved"""
+        for key, msgs in chats:
+            start = self.indexed.get(key, 0)
+            if isinstance(msgs, ChatLog):
+                for seq, content in msgs.contents(start):
+                    self.add_content(key, seq, content)
+            else:
+                for msg in msgs[start:]:
+                    self.add(key, msg)
+
+    def drop(self, keys) -> None:
+        """Forget deleted chats"""
+        keys = set(keys) & set(self.indexed)
+        if not keys:
+            return
+        for term in list(self.postings):
+            chats = self.postings[term]
+            for key in keys & set(chats):
+                self.df[term] -= len(chats.pop(key))
+            if not chats:
+                del self.postings[term]
+                del self.df[term]
+        for key in keys:
+            del self.indexed[key]
+            self.messages -= self.counts.pop(key, 0)
+
+    def query(self, terms, keys) -> dict:
+        """Scores of the messages of some chats matching any term, by (chat key, seq)
+
+        Every matched term adds its inverse document frequency, so messages
+        matching more and rarer terms rank first.
+        """
+        scores = {}
+        for term in terms:
+            chats = self.postings.get(term)
+            if not chats:
+                continue
+            idf = math.log(1 + self.messages / self.df[term])
+            for key in keys:
+                for seq in chats.get(key, ()):
+                    scores[(key, seq)] = scores.get((key, seq), 0.0) + idf
+        return scores
+
+    def save(self, path: str) -> None:
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump((self.postings, self.df, self.indexed, self.counts, self.messages), f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "SearchIndex":
+        index = cls()
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+            # Indexes saved without per chat counts are rebuilt by catching up from scratch
+            if len(state) == 5:
+                index.postings, index.df, index.indexed, index.counts, index.messages = state
+        return index
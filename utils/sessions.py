@@ -0,0 +1,46 @@
+import secrets
+import time
+
+from utils.constants import RESUME_TOKEN_TTL
+
+
+class SessionTokens:
+    """Resume tokens of user sessions
+
+    A token is issued at login and stays valid while its session is live.
+    Once the session's connection drops, it can be redeemed within ttl
+    seconds to resume the session, along with the client id of the last
+    message received from the client. Tokens are single use.
+    """
+
+    def __init__(self, ttl: float = RESUME_TOKEN_TTL):
+        self.ttl = ttl
+        self.tokens = {}  # token -> [username, expiry or None while live, client id of the last message received]
+
+    def issue(self, username) -> str:
+        self.purge()
+        token = secrets.token_urlsafe(16)
+        self.tokens[token] = [username, None, None]
+        return token
+
+    def suspend(self, token, received) -> None:
+        entry = self.tokens.get(token)
+        if entry is not None:
+            entry[1] = time.monotonic() + self.ttl
+            entry[2] = received
+
+    def check(self, username, token) -> bool:
+        """Whether a token can resume a suspended session of a user, without redeeming it"""
+        entry = self.tokens.get(token)
+        return (entry is not None) and (entry[0] == username) and (entry[1] is not None) and (entry[1] >= time.monotonic())
+
+    def redeem(self, username, token) -> dict | None:
+        """State of a suspended session, None if the token is unknown, live or expired"""
+        if not self.check(username, token):
+            return None
+        return {"received": self.tokens.pop(token)[2]}
+
+    def purge(self) -> None:
+        now = time.monotonic()
+        for token in [t for t, (_, expiry, _) in self.tokens.items() if (expiry is not None) and (expiry < now)]:
+            del self.tokens[token]
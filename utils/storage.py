@@ -0,0 +1,294 @@
+import asyncio
+import logging
+import os
+import pickle
+import struct
+import time
+import zlib
+
+from utils.constants import DURABILITY_MODES
+from utils.metrics import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+# Record header: payload length and crc32 of the payload
+RECORD_HEADER = struct.Struct("!II")
+SEGMENT_SUFFIX = ".seg"
+
+# Version tag stored at the start of every snapshot file
+SNAPSHOT_VERSION = 2
+
+
+def encode_record(record) -> bytes:
+    """Serialize a record with its length and checksum header"""
+    payload = pickle.dumps(record)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path: str):
+    """Yield all intact records of a file, stopping at a torn or corrupt tail"""
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        payload = data[offset + RECORD_HEADER.size: offset + RECORD_HEADER.size + length]
+        # Stop at a torn or corrupt tail left behind by a crash
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            log.warning("Ignoring torn record in %s", path)
+            break
+        yield pickle.loads(payload)
+        offset += RECORD_HEADER.size + length
+
+
+def load_snapshot(path: str):
+    """Load a snapshot file and return (first segment to replay, payload)"""
+    with open(path, "rb") as f:
+        header = pickle.load(f)
+        # Oldest snapshots hold the bare payload without a log position
+        if isinstance(header, dict):
+            return 0, header
+        # Version 1 snapshots hold a single (version, segment, payload) tuple
+        if isinstance(header, tuple):
+            return header[1], header[2]
+        segment = pickle.load(f)
+        return segment, pickle.load(f)
+
+
+def write_snapshot(path: str, segment: int, data: bytes) -> None:
+    """Atomically write a pickled snapshot payload recording the first segment to replay after it"""
+    tmppath = path + ".tmp"
+    with open(tmppath, "wb") as f:
+        pickle.dump(SNAPSHOT_VERSION, f)
+        pickle.dump(segment, f)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmppath, path)
+
+
+class MessageLog:
+    """Append-only segmented log of chat graph mutations with group commit
+
+    Durability modes:
+    - immediate: commits start as soon as records arrive, records queued
+      while a commit is in flight go into the next one
+    - batched: appends are gathered over a time/size window and committed
+      together with a single fsync
+    - async: like batched, but callers do not wait for the commit
+
+    All disk I/O runs in an executor so the event loop never blocks on it.
+    """
+
+    def __init__(
+        self,
+        dirpath: str,
+        segment_size: int = 4 * 1024 * 1024,
+        durability: str = "immediate",
+        batch_window: float = 0.005,
+        batch_size: int = 512,
+    ):
+        assert durability in DURABILITY_MODES, f"Unknown durability mode: {durability}"
+        self.dirpath = dirpath
+        self.segment_size = segment_size
+        self.durability = durability
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        os.makedirs(self.dirpath, exist_ok=True)
+
+        # Never append after a possibly torn tail, always start a fresh segment
+        segments = self.segments()
+        self.segment = (segments[-1] + 1) if segments else 0
+        self.file = None
+
+        # Pending (kind, data, enqueue time, future) items and the flusher task
+        self.pending = []
+        self.wakeup = None
+        self.flusher = None
+
+        # Commit counters
+        self.commits = 0
+        self.records = 0
+        self.max_batch = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.dirpath, f"{segment:08d}{SEGMENT_SUFFIX}")
+
+    def segments(self) -> list:
+        """List the ids of all segments on disk in ascending order"""
+        return sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.dirpath)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def _enqueue(self, kind: str, data) -> asyncio.Future:
+        """Queue an item for the flusher and return a future for its commit"""
+        loop = asyncio.get_running_loop()
+        if self.flusher is None or self.flusher.done():
+            self.wakeup = asyncio.Event()
+            self.flusher = loop.create_task(self._flush_loop())
+        future = loop.create_future()
+        self.pending.append((kind, data, time.perf_counter(), future))
+        self.wakeup.set()
+        return future
+
+    def _committed(self, future: asyncio.Future) -> asyncio.Future:
+        # Callers in async mode never wait for the commit
+        if self.durability == "async":
+            done = asyncio.get_running_loop().create_future()
+            done.set_result(None)
+            return done
+        return future
+
+    def append(self, record) -> asyncio.Future:
+        """Append a record and return a future resolved once it is durable"""
+        # Serialize right away so later in-memory mutations don't leak in
+        payload = pickle.dumps(record)
+        try:
+            return self._committed(self._enqueue("record", payload))
+        except RuntimeError:  # No running event loop
+            self._write([("record", payload)])
+
+    def snapshot(self, path: str, payload) -> asyncio.Future:
+        """Atomically write a snapshot after all pending records and drop the segments it covers"""
+        data = pickle.dumps(payload)
+        try:
+            return self._committed(self._enqueue("snapshot", (path, data)))
+        except RuntimeError:  # No running event loop
+            self._write([("snapshot", (path, data))])
+
+    def write_file(self, path: str, data: bytes) -> asyncio.Future | None:
+        """Write and sync a new file, returning a future resolved once it is durable
+
+        Unlike records, the future always waits for the write, since callers
+        only switch over to the file once it is complete. Writes right away,
+        returning None, if there is no running event loop.
+        """
+        try:
+            return self._enqueue("file", (path, data))
+        except RuntimeError:  # No running event loop
+            self._write([("file", (path, data))])
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+
+            # Wait for more appends to gather a group commit
+            if self.durability != "immediate":
+                deadline = loop.time() + self.batch_window
+                while len(self.pending) < self.batch_size and loop.time() < deadline:
+                    await asyncio.sleep(min(0.001, self.batch_window))
+            if not self.pending:
+                continue
+            batch, self.pending = self.pending, []
+
+            # Commit the whole batch off the event loop
+            try:
+                with metrics.timer("storage.write"):
+                    await loop.run_in_executor(None, self._write, [(kind, data) for kind, data, _, _ in batch])
+                error = None
+            except Exception as e:
+                log.error("Message log commit failed: %s", e)
+                error = e
+
+            # Update counters and notify waiters
+            now = time.perf_counter()
+            latency = now - batch[0][2]
+            self.commits += 1
+            self.records += len(batch)
+            self.max_batch = max(self.max_batch, len(batch))
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            metrics.observe("storage.commit", latency)
+            for _, _, _, future in batch:
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+                    future.exception()  # Nobody may be waiting in async mode
+
+    def _write(self, items) -> None:
+        """Write a batch of records and snapshots to disk, fsyncing once"""
+        for kind, data in items:
+            if kind == "sync":
+                continue
+            elif kind == "record":
+                if self.file is None:
+                    self.file = open(self._segment_path(self.segment), "ab")
+                self.file.write(RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data)
+                # Roll over to a new segment once the current one is full
+                if self.file.tell() >= self.segment_size:
+                    self._sync()
+                    self.rotate()
+            elif kind == "file":
+                path, data = data
+                with open(path, "xb") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+            else:
+                path, data = data
+                self._sync()
+                segment = self.rotate()
+                started = time.perf_counter()
+                write_snapshot(path, segment, data)
+                metrics.observe("storage.snapshot", time.perf_counter() - started)
+                self.remove_segments(before=segment)
+        self._sync()
+
+    def _sync(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def rotate(self) -> int:
+        """Seal the current segment and return the id of the next one"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.segment += 1
+        return self.segment
+
+    def replay(self, start: int = 0):
+        """Yield all intact records from segments with id >= start"""
+        for segment in self.segments():
+            if segment >= start:
+                yield from read_records(self._segment_path(segment))
+
+    def remove_segments(self, before: int) -> None:
+        """Delete all sealed segments with id < before"""
+        for segment in self.segments():
+            if segment < before:
+                os.remove(self._segment_path(segment))
+
+    def stats(self) -> dict:
+        """Commit counters: latency is from the first enqueue of a batch until it is durable"""
+        return {
+            "durability": self.durability,
+            "commits": self.commits,
+            "records": self.records,
+            "pending": len(self.pending),
+            "avg_batch_size": self.records / self.commits if self.commits else 0.0,
+            "max_batch_size": self.max_batch,
+            "avg_commit_latency_ms": 1000 * self.latency_total / self.commits if self.commits else 0.0,
+            "max_commit_latency_ms": 1000 * self.latency_max,
+        }
+
+    async def close(self) -> None:
+        """Commit all pending items and close the current segment"""
+        if self.flusher is not None:
+            await self._enqueue("sync", None)
+            self.flusher.cancel()
+            self.flusher = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
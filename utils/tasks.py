@@ -0,0 +1,20 @@
+import asyncio
+import logging
+
+
+def spawn(coro, tasks: set, log: logging.Logger) -> asyncio.Task:
+    """Run a coroutine in the background, logging its failure
+
+    The event loop only keeps weak references to tasks, so the task is held
+    in tasks until it is done.
+    """
+    task = asyncio.get_running_loop().create_task(coro)
+    tasks.add(task)
+
+    def done(task):
+        tasks.discard(task)
+        if (not task.cancelled()) and (task.exception() is not None):
+            log.error("Background task %s failed", task.get_coro().__qualname__, exc_info=task.exception())
+
+    task.add_done_callback(done)
+    return task